@@ -21,11 +21,13 @@ try:
     import tc_manager
     import generators
     import faq
-    from xui_api import IP_FETCH_API, IP_FETCH_LOG
+    import worker
+    import control
+    from xui_api import IP_FETCH_API, IP_FETCH_LOG, IP_FETCH_HYBRID
 except ImportError as e:
     # Выводим ошибку без использования common.Color, т.к. он мог не импортироваться
     print(f"\033[91mОшибка: Не удалось импортировать модуль: {e}\033[0m")
-    print("Убедитесь, что все файлы (.py): common.py, config_manager.py, system_utils.py, xui_api.py, tc_manager.py, generators.py, faq.py")
+    print("Убедитесь, что все файлы (.py): common.py, config_manager.py, system_utils.py, xui_api.py, tc_manager.py, generators.py, faq.py, log_utils.py, worker.py, control.py")
     print("находятся в той же директории, что и MK_XSL.py")
     sys.exit(1)
 
@@ -65,15 +67,31 @@ def configure_api_menu():
     config = config_manager.load_config()
 
     current_ip_method = config.get('ip_fetch_method', IP_FETCH_API)
+    current_worker_mode = config.get('worker_mode', worker.WORKER_MODE_TIMER)
+    current_limit_source = config.get('limit_source', worker.LIMIT_SOURCE_FILE)
 
     print("Текущие настройки:")
     print(f"  URL панели: {config.get('api_url', f'{common.Color.YELLOW}Не задан{common.Color.RESET}')}")
     print(f"  Логин API:  {config.get('api_user', f'{common.Color.YELLOW}Не задан{common.Color.RESET}')}")
     print(f"  Пароль API: {common.Color.GREEN}********{common.Color.RESET}" if config.get("api_pass") else f"{common.Color.YELLOW}Не задан{common.Color.RESET}")
     print(f"  Интерфейс:  {config.get('iface', f'{common.Color.YELLOW}Не задан{common.Color.RESET}')}")
+    if config.get('interfaces'):
+        interface_list = ', '.join(f"{item['name']} ({item['capacity_mbit']} Мбит/с, {item['backend']})"
+                                   for item in worker.configured_interfaces(config))
+        print(f"  Интерфейсы: {interface_list} {common.Color.DIM}(из 'interfaces', 'iface' не используется){common.Color.RESET}")
+    print(f"     {common.Color.DIM}Несколько интерфейсов: 'interfaces': [{{'name', 'capacity_mbit', 'backend': 'ip' | 'mark'}}]{common.Color.RESET}")
     # Отображаем текущий метод получения IP
-    method_display = "API (рекомендовано)" if current_ip_method == IP_FETCH_API else "Парсинг лога (fallback)"
+    method_names = {
+        IP_FETCH_API: "API (рекомендовано)",
+        IP_FETCH_LOG: "Парсинг лога (fallback)",
+        IP_FETCH_HYBRID: "Гибридный (API + лог)",
+    }
+    method_display = method_names.get(current_ip_method, method_names[IP_FETCH_API])
     print(f"  Метод IP:   {common.Color.CYAN}{method_display}{common.Color.RESET}")
+    mode_display = "Демон (постоянный процесс)" if current_worker_mode == worker.WORKER_MODE_DAEMON else "Таймер systemd"
+    print(f"  Воркер:     {common.Color.CYAN}{mode_display}{common.Color.RESET}")
+    source_display = "Панель X-UI + user_limits.json" if current_limit_source == worker.LIMIT_SOURCE_PANEL else "user_limits.json"
+    print(f"  Лимиты:     {common.Color.CYAN}{source_display}{common.Color.RESET}")
     common.print_separator("-")
 
     import getpass # Импортируем здесь, т.к. нужен только тут
@@ -116,10 +134,16 @@ def configure_api_menu():
     print(f"\n{common.Color.BOLD}Выберите метод получения IP адресов клиентов:{common.Color.RESET}")
     print(f"  {common.Color.CYAN}1.{common.Color.RESET} Через API панели X-UI ({common.Color.GREEN}Рекомендуется{common.Color.RESET})")
     print(f"  {common.Color.CYAN}2.{common.Color.RESET} Парсинг access.log ({common.Color.YELLOW}Fallback, если API не работает{common.Color.RESET})")
-    current_method_choice = '1' if current_ip_method == IP_FETCH_API else '2'
+    print(f"  {common.Color.CYAN}3.{common.Color.RESET} Гибридный: API, а при медленном/пустом ответе - параллельно access.log")
+    print(f"     {common.Color.DIM}Задержка запуска поиска в логе: 'ip_hedge_delay_sec' в config.json (по умолчанию {xui_api.DEFAULT_HEDGE_DELAY} сек, 0 - сразу){common.Color.RESET}")
+    print(f"     {common.Color.DIM}Отбрасывать IP без живых соединений к inbound: 'ip_liveness': 'sock_diag' или 'conntrack' в config.json (порты - 'xray_inbound_ports' или из панели){common.Color.RESET}")
+    print(f"     {common.Color.DIM}sock_diag видит только TCP: клиентов UDP inbound (mKCP, QUIC, Hysteria; вручную - '443/udp' в 'xray_inbound_ports') проверяет conntrack, без него они не отбрасываются{common.Color.RESET}")
+    print(f"     {common.Color.DIM}Общие IP (CGNAT) у пользователей с разными лимитами: 'shared_ip_mode': 'connection' - правила по соединениям из access.log{common.Color.RESET}")
+    print(f"     {common.Color.DIM}Свертка IP пользователя в префиксы: 'ip_aggregation': 'exact' или 'prefix' ('ip_aggregation_ipv4_prefix', по умолчанию /24){common.Color.RESET}")
+    print(f"     {common.Color.DIM}IPv6 клиенты ограничиваются по сети: 'ipv6_match_prefix' (по умолчанию /64, 128 - по точному адресу){common.Color.RESET}")
     new_ip_method = current_ip_method # По умолчанию оставляем текущий
     while True:
-        ip_choice = input(f"Ваш выбор [1-2] (Enter - оставить '{method_display}'): ").strip()
+        ip_choice = input(f"Ваш выбор [1-3] (Enter - оставить '{method_display}'): ").strip()
         if not ip_choice:
             break # Оставляем текущий
         if ip_choice == '1':
@@ -128,10 +152,55 @@ def configure_api_menu():
         elif ip_choice == '2':
             new_ip_method = IP_FETCH_LOG
             break
+        elif ip_choice == '3':
+            new_ip_method = IP_FETCH_HYBRID
+            break
         else:
-            print(f"{common.Color.RED}Неверный выбор. Введите 1 или 2.{common.Color.RESET}")
+            print(f"{common.Color.RED}Неверный выбор. Введите 1, 2 или 3.{common.Color.RESET}")
 
     # --- Конец выбора метода IP ---
+
+    # --- Выбор источника лимитов ---
+    limit_field = config.get('panel_limit_field', xui_api.DEFAULT_PANEL_LIMIT_FIELD)
+    limit_tag = config.get('panel_limit_tag', xui_api.DEFAULT_PANEL_LIMIT_TAG)
+    print(f"\n{common.Color.BOLD}Выберите источник лимитов скорости:{common.Color.RESET}")
+    print(f"  {common.Color.CYAN}1.{common.Color.RESET} Только user_limits.json (меню 'Управление лимитами')")
+    print(f"  {common.Color.CYAN}2.{common.Color.RESET} Настройки клиентов панели: поле '{limit_field}' или метка '{limit_tag}=N' в комментарии")
+    print(f"     {common.Color.DIM}Записи user_limits.json переопределяют лимиты панели (значение 0 в файле - снять лимит панели).{common.Color.RESET}")
+    new_limit_source = current_limit_source
+    while True:
+        source_choice = input(f"Ваш выбор [1-2] (Enter - оставить '{source_display}'): ").strip()
+        if not source_choice:
+            break
+        if source_choice == '1':
+            new_limit_source = worker.LIMIT_SOURCE_FILE
+            break
+        elif source_choice == '2':
+            new_limit_source = worker.LIMIT_SOURCE_PANEL
+            break
+        else:
+            print(f"{common.Color.RED}Неверный выбор. Введите 1 или 2.{common.Color.RESET}")
+    # --- Конец выбора источника лимитов ---
+
+    # --- Выбор режима запуска воркера ---
+    print(f"\n{common.Color.BOLD}Выберите режим запуска воркера:{common.Color.RESET}")
+    print(f"  {common.Color.CYAN}1.{common.Color.RESET} Таймер systemd (полный цикл каждые 'timer_interval_sec', по умолчанию {worker.DEFAULT_TIMER_INTERVAL_SEC} сек)")
+    print(f"  {common.Color.CYAN}2.{common.Color.RESET} Демон (постоянный процесс с адаптивным интервалом, быстрее реагирует на изменения)")
+    new_worker_mode = current_worker_mode
+    while True:
+        mode_choice = input(f"Ваш выбор [1-2] (Enter - оставить '{mode_display}'): ").strip()
+        if not mode_choice:
+            break
+        if mode_choice == '1':
+            new_worker_mode = worker.WORKER_MODE_TIMER
+            break
+        elif mode_choice == '2':
+            new_worker_mode = worker.WORKER_MODE_DAEMON
+            break
+        else:
+            print(f"{common.Color.RED}Неверный выбор. Введите 1 или 2.{common.Color.RESET}")
+    # --- Конец выбора режима воркера ---
+
     config_changed = False
     if new_url: config['api_url'] = new_url.rstrip('/'); config_changed = True
     if new_user: config['api_user'] = new_user; config_changed = True
@@ -141,15 +210,22 @@ def configure_api_menu():
     if new_ip_method != current_ip_method:
         config['ip_fetch_method'] = new_ip_method
         config_changed = True
-        # Добавляем уведомление о необходимости переустановки службы
+        # Воркер сам перечитывает config.json: демон - сразу (inotify), таймер - при следующем запуске
         print(f"\n{common.Color.YELLOW}ВНИМАНИЕ: Метод получения IP изменен.{common.Color.RESET}")
-        print(f"{common.Color.YELLOW}Чтобы изменения вступили в силу, необходимо {common.Color.BOLD}переустановить службу{common.Color.RESET}{common.Color.YELLOW} (опция 3 в предыдущем меню).{common.Color.RESET}")
+        print(f"{common.Color.DIM}Воркер применит изменение автоматически (в режиме демона - сразу, по таймеру - при следующем запуске).{common.Color.RESET}")
+    if new_limit_source != current_limit_source:
+        config['limit_source'] = new_limit_source
+        config_changed = True
+    if new_worker_mode != current_worker_mode:
+        config['worker_mode'] = new_worker_mode
+        config_changed = True
+        print(f"\n{common.Color.YELLOW}ВНИМАНИЕ: Режим воркера изменен. {common.Color.BOLD}Переустановите службу{common.Color.RESET}{common.Color.YELLOW} (опция 3 в предыдущем меню).{common.Color.RESET}")
 
 
     # Проверяем, все ли обязательные параметры заданы (URL, user, pass, iface)
     # Параметр ip_fetch_method не является строго обязательным, т.к. есть дефолт
     required_api_keys = ["api_url", "api_user", "api_pass", "iface"]
-    missing_keys = [k for k in required_api_keys if not config.get(k)]
+    missing_keys = [k for k in required_api_keys if not config.get(k) and not (k == "iface" and config.get("interfaces"))]
 
     if missing_keys:
          print(f"\n{common.Color.YELLOW}Внимание: Не все основные параметры заданы: {', '.join(missing_keys)}.{common.Color.RESET}")
@@ -166,12 +242,48 @@ def configure_api_menu():
         print("\nИзменений не было.")
     common.pause()
 
+def _save_limit_change(limits, email, limit):
+    """
+    Сохраняет изменение лимита. Если запущен воркер-демон, изменение отправляется через
+    управляющий сокет и применяется к правилам tc сразу; иначе - просто пишется user_limits.json.
+
+    Args:
+        limits (dict): Текущие лимиты (уже с примененным изменением) - для записи в файл.
+        email (str): Email/Тег пользователя.
+        limit (int): Новый лимит в Мбит/с (0 - удалить).
+
+    Returns:
+        bool: True, если изменение сохранено.
+    """
+    timeout = worker.control_timeout(config_manager.load_config())
+    if limit == 0:
+        response = control.send_command('remove_limit', timeout=timeout, email=email)
+    else:
+        response = control.send_command('set_limit', timeout=timeout, email=email, limit=limit)
+    if response is not None:
+        if response.get('ok'):
+            if response.get('applied'):
+                print(f"{common.Color.DIM}Правила tc обновлены воркером ({response.get('rules', 0)} IP).{common.Color.RESET}")
+            elif response.get('cycle_scheduled'):
+                print(f"{common.Color.DIM}Воркер применит лимит внеочередным циклом.{common.Color.RESET}")
+            return True
+        if response.get('timeout'):
+            # Команда уже у демона: он сам сохранит user_limits.json, повторная запись не нужна
+            print(f"{common.Color.YELLOW}{response.get('error')}{common.Color.RESET}")
+            return True
+        print(f"{common.Color.RED}Воркер отклонил изменение: {response.get('error')}{common.Color.RESET}")
+        return False
+    # Демон не запущен - воркер подхватит файл при следующем запуске
+    return config_manager.save_user_limits(limits)
+
 def manage_user_limits_menu():
     """Отображает меню управления лимитами пользователей (API)."""
     while True:
         common.clear_screen()
         common.print_header("Управление Лимитами Пользователей (API)")
         limits = config_manager.load_user_limits()
+        if config_manager.load_config().get('limit_source') == worker.LIMIT_SOURCE_PANEL:
+            print(f"{common.Color.DIM}Источник лимитов - панель X-UI. Записи ниже переопределяют лимиты панели.{common.Color.RESET}")
 
         if not limits:
             print(f"{common.Color.YELLOW}Лимиты пользователей не настроены.{common.Color.RESET}")
@@ -204,7 +316,7 @@ def manage_user_limits_menu():
                  else: print(f"{common.Color.YELLOW}Пользователь '{email}' не найден.{common.Color.RESET}"); time.sleep(1.5); continue
             else: limits[email] = limit
 
-            if config_manager.save_user_limits(limits):
+            if _save_limit_change(limits, email, limit):
                  if limit == 0:
                      print(f"{common.Color.YELLOW}Лимит для '{email}' удален из списка.{common.Color.RESET}")
                  else:
@@ -215,21 +327,49 @@ def manage_user_limits_menu():
             email = input("Email/Тег пользователя для удаления лимита: ").strip()
             if email in limits:
                  del limits[email]
-                 if config_manager.save_user_limits(limits): print(f"{common.Color.GREEN}Лимит для '{email}' удален.{common.Color.RESET}")
+                 if _save_limit_change(limits, email, 0): print(f"{common.Color.GREEN}Лимит для '{email}' удален.{common.Color.RESET}")
             else: print(f"{common.Color.YELLOW}Пользователь '{email}' не найден.{common.Color.RESET}")
             time.sleep(1.5)
         else: print(f"{common.Color.RED}Неверное действие '{choice}'.{common.Color.RESET}"); time.sleep(1.5)
 
+def mark_classification_menu():
+    """Переключение классификации по меткам сокета Xray и генерация фрагмента маршрутизации Xray."""
+    common.clear_screen()
+    common.print_header("Классификация по меткам сокета Xray")
+    config = config_manager.load_config()
+    mark_mode = config.get('classification') == worker.CLASSIFICATION_MARK
+    mode_display = "По меткам (fw)" if mark_mode else "По IP клиентов (u32)"
+    print(f"Текущий режим: {common.Color.CYAN}{mode_display}{common.Color.RESET}")
+    print(f"{common.Color.DIM}В режиме меток Xray направляет пользователей в outbound уровня скорости (sockopt.mark),")
+    print("а tc ограничивает трафик по метке - без поиска IP. Лимит уровня общий для всех его пользователей.")
+    print(f"Нужны модули ядра cls_fw и act_connmark и iptables (CONNMARK --save-mark).{common.Color.RESET}")
+    common.print_separator("-")
+
+    limits = config_manager.load_user_limits() or {}
+    snippet = tc_manager.build_xray_mark_config(limits)
+    if config_manager.save_xray_mark_snippet(snippet):
+        print(f"{common.Color.GREEN}✓ Фрагмент конфигурации Xray ({len(snippet['outbounds'])} уровней) сохранен: {common.XRAY_MARK_SNIPPET_FILE}{common.Color.RESET}")
+        print(f"{common.Color.DIM}Добавьте 'outbounds' к outbounds Xray, а 'routing_rules' - в начало routing.rules (после правила API).{common.Color.RESET}")
+
+    prompt = "Вернуться к классификации по IP? (да/нет): " if mark_mode else "Включить классификацию по меткам? (да/нет): "
+    answer = input(f"\n{prompt}").strip().lower()
+    if answer.startswith('д') or answer.startswith('y'):
+        config['classification'] = worker.CLASSIFICATION_IP if mark_mode else worker.CLASSIFICATION_MARK
+        if config_manager.save_config(config):
+            print(f"{common.Color.GREEN}✓ Режим изменен. Воркер применит его автоматически.{common.Color.RESET}")
+    common.pause()
+
 def install_user_worker_service():
     """Установка/переустановка службы для лимитов пользователей (API)."""
     common.clear_screen()
     common.print_header("Установка Службы Лимитов Пользователей (API)")
     config = config_manager.load_config()
-    if not config or not all(k in config for k in ["api_url", "api_user", "api_pass", "iface"]):
+    if not config or not all(k in config for k in ["api_url", "api_user", "api_pass"]) or not worker.configured_interfaces(config):
         print(f"{common.Color.RED}Ошибка: Конфигурация API неполная.{common.Color.RESET}")
         print(f"{common.Color.YELLOW}Настройте API в пункте 1 этого меню.{common.Color.RESET}")
         common.pause(); return
-    iface = config['iface']
+    interfaces = worker.configured_interfaces(config)
+    iface = ', '.join(item['name'] for item in interfaces)
     print(f"Интерфейс: {common.Color.WHITE}{iface}{common.Color.RESET}, API: {common.Color.WHITE}{config['api_url']}{common.Color.RESET}")
     common.print_separator("-")
     confirm = input(f"Начать установку/переустановку службы? (да/нет): ").strip().lower()
@@ -243,22 +383,45 @@ def install_user_worker_service():
     except OSError as e: print(f"{common.Color.RED}Ошибка создания директорий: {e}{common.Color.RESET}"); common.pause(); return
     print(f"{common.Color.GREEN}✓ OK.{common.Color.RESET}")
     print(f"\n{common.Color.CYAN}2: Генерация файлов...{common.Color.RESET}")
-    if not generators.create_base_tc_script(common.BASE_TC_SCRIPT_PATH, iface): common.pause(); return
+    if not generators.create_base_tc_script(common.BASE_TC_SCRIPT_PATH, common.WORKER_SCRIPT_PATH): common.pause(); return
     if not generators.create_base_tc_service(common.BASE_TC_SERVICE_PATH, common.BASE_TC_SCRIPT_PATH): common.pause(); return
     if not generators.create_worker_script(common.WORKER_SCRIPT_PATH, common.CONFIG_FILE, common.USER_LIMITS_FILE): common.pause(); return
-    if not generators.create_worker_service_files(common.WORKER_TIMER_PATH, common.WORKER_SERVICE_PATH, common.WORKER_SCRIPT_PATH): common.pause(); return
+    worker_mode = config.get('worker_mode', worker.WORKER_MODE_TIMER)
+    if not generators.create_worker_service_files(common.WORKER_TIMER_PATH, common.WORKER_SERVICE_PATH, common.WORKER_SCRIPT_PATH,
+                                                  worker_mode=worker_mode, timer_interval=worker.timer_interval(config)): common.pause(); return
     print(f"\n{common.Color.CYAN}3: Systemd reload...{common.Color.RESET}")
     if not system_utils.run_command(['systemctl', 'daemon-reload'], check=True, success_msg="OK"): common.pause(); return
     print(f"\n{common.Color.CYAN}4: Запуск базы TC...{common.Color.RESET}")
     if system_utils.manage_service("enable", common.BASE_TC_SERVICE_NAME, check_status=False):
         if not system_utils.manage_service("restart", common.BASE_TC_SERVICE_NAME): print(f"{common.Color.YELLOW}WARN: Не удалось запустить {common.BASE_TC_SERVICE_NAME}.{common.Color.RESET}")
     else: print(f"{common.Color.RED}Не удалось включить {common.BASE_TC_SERVICE_NAME}.{common.Color.RESET}"); common.pause(); return
+    if worker_mode == worker.WORKER_MODE_DAEMON:
+        print(f"\n{common.Color.CYAN}5: Запуск воркера в режиме демона...{common.Color.RESET}")
+        # Таймер от прошлой установки больше не нужен
+        if os.path.exists(common.WORKER_TIMER_PATH):
+            system_utils.manage_service("stop", common.WORKER_TIMER_NAME, check_status=False, quiet=True)
+            system_utils.manage_service("disable", common.WORKER_TIMER_NAME, check_status=False, quiet=True)
+            try: os.remove(common.WORKER_TIMER_PATH)
+            except OSError as e: print(f"{common.Color.YELLOW}WARN: Не удалось удалить {common.WORKER_TIMER_PATH}: {e}{common.Color.RESET}")
+            system_utils.run_command(['systemctl', 'daemon-reload'], check=False, show_error=False)
+        if system_utils.manage_service("enable", common.WORKER_SERVICE_NAME, check_status=False) and \
+           system_utils.manage_service("restart", common.WORKER_SERVICE_NAME, check_status=True):
+            common.print_separator("-"); print(f"{common.Color.GREEN}{common.Color.BOLD}УСПЕХ!{common.Color.RESET} Служба установлена и запущена (демон).")
+            print(f"Ограничения для пользователей будут применяться на интерфейсах: {iface}.")
+            print(f"\nПолезные команды:")
+            print(f" Воркер: {common.Color.DIM}systemctl status {common.WORKER_SERVICE_NAME}{common.Color.RESET}")
+            print(f" Логи:   {common.Color.DIM}journalctl -u {common.WORKER_SERVICE_NAME} -f{common.Color.RESET}")
+        else: print(f"{common.Color.RED}{common.Color.BOLD}ОШИБКА:{common.Color.RESET}{common.Color.RED} Не удалось запустить воркер.{common.Color.RESET}")
+        common.pause(); return
     print(f"\n{common.Color.CYAN}5: Запуск таймера воркера...{common.Color.RESET}")
     system_utils.manage_service("stop", common.WORKER_TIMER_NAME, check_status=False, quiet=True)
+    # Воркер-демон от прошлой установки должен быть остановлен, его запускает таймер
+    system_utils.manage_service("disable", common.WORKER_SERVICE_NAME, check_status=False, quiet=True)
+    system_utils.manage_service("stop", common.WORKER_SERVICE_NAME, check_status=False, quiet=True)
     if system_utils.manage_service("enable", common.WORKER_TIMER_NAME, check_status=True):
         if system_utils.manage_service("restart", common.WORKER_TIMER_NAME, check_status=True):
             common.print_separator("-"); print(f"{common.Color.GREEN}{common.Color.BOLD}УСПЕХ!{common.Color.RESET} Служба установлена и запущена.")
-            print(f"Ограничения для пользователей будут применяться на интерфейсе '{iface}'.")
+            print(f"Ограничения для пользователей будут применяться на интерфейсах: {iface}.")
             print(f"\nПолезные команды:")
             print(f" Таймер: {common.Color.DIM}systemctl status {common.WORKER_TIMER_NAME}{common.Color.RESET}")
             print(f" Воркер: {common.Color.DIM}systemctl status {common.WORKER_SERVICE_NAME}{common.Color.RESET}")
@@ -302,6 +465,12 @@ def uninstall_user_worker_service():
         for err in errors: print(f"{common.Color.RED}- {err}{common.Color.RESET}")
     common.pause()
 
+def is_user_worker_active():
+    """Проверяет, запущен ли воркер: таймер (режим 'timer') или сервис-демон (режим 'daemon')."""
+    if os.path.exists(common.WORKER_TIMER_PATH) and system_utils.manage_service('is-active', common.WORKER_TIMER_NAME, quiet=True):
+        return True
+    return os.path.exists(common.WORKER_SERVICE_PATH) and system_utils.manage_service('is-active', common.WORKER_SERVICE_NAME, quiet=True)
+
 # === Функции для режима "Лимиты Портов (Старый режим)" ===
 
 def find_port_limits():
@@ -526,7 +695,7 @@ def main_menu():
     """Главное меню скрипта с выбором режима."""
     while True:
         common.clear_screen(); print(ASCII_LOGO); common.print_header("xraySpeedLimit Utility by MKultra69")
-        api_timer_active = os.path.exists(common.WORKER_TIMER_PATH) and system_utils.manage_service('is-active', common.WORKER_TIMER_NAME, quiet=True)
+        api_timer_active = is_user_worker_active()
         api_status_color = common.Color.GREEN if api_timer_active else common.Color.RED
         api_status_text = "Активна" if api_timer_active else "Неактивна"
         port_limits_count = len(find_port_limits())
@@ -550,14 +719,15 @@ def user_limits_submenu():
     """Подменю для управления лимитами пользователей (API)."""
     while True:
         common.clear_screen(); common.print_header("Режим: Лимиты Пользователей (API)")
-        api_timer_active = os.path.exists(common.WORKER_TIMER_PATH) and system_utils.manage_service('is-active', common.WORKER_TIMER_NAME, quiet=True)
+        api_timer_active = is_user_worker_active()
         status_color = common.Color.GREEN if api_timer_active else common.Color.RED
         status_text = "Активна" if api_timer_active else "Неактивна/Не установлена"
         print(f" Статус службы воркера: {status_color}{status_text}{common.Color.RESET}"); common.print_separator("-")
         print(f" {common.Color.YELLOW}1){common.Color.RESET} Настроить API и Интерфейс"); print(f" {common.Color.GREEN}2){common.Color.RESET} Управление списком лимитов")
         print(f" {common.Color.CYAN}3){common.Color.RESET} Установить / Переустановить службу"); print(f" {common.Color.RED}4){common.Color.RESET} Удалить службу")
-        print(f" {common.Color.BLUE}5){common.Color.RESET} Проверить статус служб"); print(f" {common.Color.YELLOW}N){common.Color.RESET} Назад в главное меню"); common.print_separator()
-        choice = input("Выберите опцию [1-5, N]: ").strip().upper()
+        print(f" {common.Color.BLUE}5){common.Color.RESET} Проверить статус служб"); print(f" {common.Color.CYAN}6){common.Color.RESET} Классификация по меткам Xray")
+        print(f" {common.Color.YELLOW}N){common.Color.RESET} Назад в главное меню"); common.print_separator()
+        choice = input("Выберите опцию [1-6, N]: ").strip().upper()
 
         if choice == '1': configure_api_menu()
         elif choice == '2': manage_user_limits_menu()
@@ -570,6 +740,7 @@ def user_limits_submenu():
                  print(f"{common.Color.CYAN}Статус {svc}...{common.Color.RESET}")
                  system_utils.run_command(['systemctl', 'status', svc], check=False, capture_output=False); common.print_separator("-")
              common.pause()
+        elif choice == '6': mark_classification_menu()
         elif choice == 'N': return
         else: print(f"\n{common.Color.RED}Неверная опция '{choice}'.{common.Color.RESET}"); common.pause()
 
@@ -0,0 +1,71 @@
+"""
+Замер tc_manager.aggregate_ip_prefixes() на сгенерированных кластерах IP:
+пользователи с адресами в нескольких /24 (IPv4) и /64 (IPv6), часть сетей общая
+для пользователей с разными лимитами.
+
+Запуск из корня репозитория:
+    python benchmarks/aggregate_ip_prefixes.py [--users 5000] [--ips 8] [--repeat 5]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tc_manager # noqa: E402
+
+
+def generate_clusters(users, ips_per_user, seed=1):
+    """
+    { email: [ip, ...] } и { email: limit }: IP каждого пользователя - в 1-3 сетях /24 или /64,
+    каждая десятая сеть делится с соседним пользователем (лимит может отличаться).
+    """
+    rng = random.Random(seed)
+    user_ips, user_limits = {}, {}
+    networks = []
+    for index in range(users):
+        email = f'user{index}@bench'
+        user_limits[email] = rng.choice((5, 10, 20, 50))
+        ips = []
+        for _ in range(rng.randint(1, 3)):
+            if networks and rng.random() < 0.1:
+                network = rng.choice(networks[-20:])
+            else:
+                network = ('v6', rng.getrandbits(64)) if rng.random() < 0.3 else ('v4', rng.getrandbits(24))
+                networks.append(network)
+            for _ in range(max(1, ips_per_user // 2)):
+                if network[0] == 'v4':
+                    value = network[1] << 8 | rng.getrandbits(8)
+                    ips.append('.'.join(str(value >> shift & 0xFF) for shift in (24, 16, 8, 0)))
+                else:
+                    value = network[1] << 64 | rng.getrandbits(64)
+                    ips.append(':'.join(f'{value >> shift & 0xFFFF:x}' for shift in range(112, -16, -16)))
+        user_ips[email] = ips
+    return user_ips, user_limits
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер aggregate_ip_prefixes()")
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--ips', type=int, default=8, help="IP пользователя в одной сети")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    user_ips, user_limits = generate_clusters(args.users, args.ips)
+    total_ips = sum(len(ips) for ips in user_ips.values())
+    print(f"Пользователей: {args.users}, IP: {total_ips}")
+    for mode in (tc_manager.AGGREGATION_EXACT, tc_manager.AGGREGATION_PREFIX):
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            result = tc_manager.aggregate_ip_prefixes(user_ips, user_limits, mode=mode)
+            timings.append(time.perf_counter() - started)
+        rules = sum(len(prefixes) for prefixes in result.values())
+        print(f"{mode:>7}: лучшее {min(timings) * 1000:.1f} мс, медиана {sorted(timings)[len(timings) // 2] * 1000:.1f} мс, "
+              f"правил {rules} ({rules / total_ips:.2f} на IP)")
+
+
+if __name__ == '__main__':
+    main()
@@ -37,6 +37,14 @@ WORKER_SERVICE_NAME = "xray-limit-worker.service"
 WORKER_SERVICE_PATH = os.path.join(SERVICE_DIR, WORKER_SERVICE_NAME)
 WORKER_TIMER_NAME = "xray-limit-worker.timer"
 WORKER_TIMER_PATH = os.path.join(SERVICE_DIR, WORKER_TIMER_NAME)
+# Состояние воркера между запусками (не конфигурация, поэтому отдельно от CONFIG_DIR)
+STATE_DIR = "/var/lib/xraySpeedLimit"
+WORKER_STATE_FILE = os.path.join(STATE_DIR, "worker_state.json")
+APPLIED_PLAN_FILE = os.path.join(STATE_DIR, "applied_plan.json")
+IP_CACHE_FILE = os.path.join(STATE_DIR, "ip_cache.json")
+XRAY_MARK_SNIPPET_FILE = os.path.join(STATE_DIR, "xray_mark_routing.json") # Фрагмент конфигурации Xray для classification='mark'
+# Управляющий сокет воркера-демона
+CONTROL_SOCKET_PATH = "/run/xraySpeedLimit/control.sock"
 
 # --- Константы для TC ---
 # Предопределенные классы TC HTB (ID -> Мбит/с) для Upload
@@ -55,7 +63,27 @@ PREDEFINED_LIMIT_CLASSES = {
 }
 
 TC_PRIO = '5000'
-TC_HANDLE_BASE = 0x5000
+TC_PRIO_V6 = '5001' # IPv6-правила по IP (flower: хэш по адресу/маске, handle 1..TC_FLOWER_MAX_HANDLE)
+# Правила по IPv4 (u32) - в собственных таблицах приоритета TC_PRIO, на них ссылаются фильтры-ссылки корневой
+# таблицы. Корневые таблицы ядро выдает по порядку создания приоритетов u32 (800:, 801:, ...), поэтому handle
+# правил от них не зависят. Адреса (/32) - в хэш-таблице TC_U32_HTID из TC_U32_DIVISOR корзин по последнему октету
+# адреса ('<TC_U32_HTID>:<корзина>:<узел>'), префиксы агрегации - в таблице TC_U32_PREFIX_HTID ('<...>::<узел>'),
+# ее ядро проверяет, если в корзине адреса правила не нашлось. Узел 1..TC_U32_MAX_NODE в каждой корзине и таблице.
+TC_U32_HTID = '500'        # Вне диапазона 800:-fff:, который ядро выдает автоматически
+TC_U32_PREFIX_HTID = '501'
+TC_U32_DIVISOR = 256
+TC_U32_MAX_NODE = 0xFFF
+TC_FLOWER_MAX_HANDLE = 0xFFFF
+# Фильтры по соединению (IP + порт клиента) для IP, общих для пользователей с разными лимитами
+# (shared_ip_mode='connection'); приоритет выше фильтров по IP, поэтому они срабатывают первыми.
+TC_CONN_PRIO = '4950'
+TC_CONN_PRIO_V6 = '4951'
+# Классификация по метке сокета (classification='mark'): метка уровня = TC_MARK_BASE + ID класса HTB.
+# ID классов должны быть меньше 0x400, чтобы все метки попадали под маску TC_MARK_MASK.
+TC_MARK_PRIO = '4900'      # fw-фильтры по меткам (egress и ingress)
+TC_CONNMARK_PRIO = '4800'  # ingress: восстановление метки из conntrack перед fw-фильтрами
+TC_MARK_BASE = 0x5800
+TC_MARK_MASK = 0xFC00
 TC_PATH = '/sbin/tc'
 
 # --- Константы API ---
@@ -2,6 +2,7 @@
 Модуль для управления конфигурационными файлами xraySpeedLimit.
 - config.json: Настройки API и интерфейса.
 - user_limits.json: Лимиты скорости для пользователей.
+- worker_state.json: Состояние воркера между циклами (в common.STATE_DIR).
 """
 
 import os
@@ -80,7 +81,8 @@ def load_config():
 
         # Мягкая проверка ключей - просто предупреждаем, если чего-то нет
         required_keys = ["api_url", "api_user", "api_pass", "iface"]
-        missing_keys = [key for key in required_keys if key not in config_data]
+        missing_keys = [key for key in required_keys if key not in config_data
+                        and not (key == "iface" and config_data.get("interfaces"))] # Список интерфейсов заменяет 'iface'
         if missing_keys:
              print(f"{common.Color.YELLOW}[ПРЕДУПРЕЖДЕНИЕ] В файле {config_path} отсутствуют ключи: {', '.join(missing_keys)}. Рекомендуется перенастроить API.{common.Color.RESET}")
 
@@ -209,4 +211,125 @@ def save_user_limits(limits_data):
                 os.remove(temp_limits_path)
             except OSError:
                 pass
-        return False
\ No newline at end of file
+        return False
+
+# --- Состояние воркера ---
+
+def _load_state_file(state_path):
+    """Читает JSON-объект из файла состояния. Отсутствие или повреждение файла - пустой словарь."""
+    if not os.path.isfile(state_path):
+        return {}
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state_data = json.load(f)
+        return state_data if isinstance(state_data, dict) else {}
+    except (json.JSONDecodeError, OSError):
+        return {}
+
+def _save_state_file(state_path, state_data, description, indent=None):
+    """Атомарно сохраняет JSON-объект в файл состояния (права 600, директория 700)."""
+    temp_state_path = state_path + ".tmp"
+    try:
+        os.makedirs(common.STATE_DIR, mode=0o700, exist_ok=True)
+        with open(temp_state_path, 'w', encoding='utf-8') as f:
+            if indent is None:
+                json.dump(state_data, f, ensure_ascii=False, separators=(',', ':'))
+            else:
+                json.dump(state_data, f, ensure_ascii=False, indent=indent)
+        os.chmod(temp_state_path, 0o600)
+        os.replace(temp_state_path, state_path)
+        return True
+    except (OSError, TypeError, ValueError) as e:
+        print(f"{common.Color.RED}[ОШИБКА] Ошибка сохранения {description} {state_path}: {e}{common.Color.RESET}")
+        if os.path.exists(temp_state_path):
+            try:
+                os.remove(temp_state_path)
+            except OSError:
+                pass
+        return False
+
+def load_worker_state():
+    """
+    Загружает состояние воркера (результаты прошлых циклов) из worker_state.json.
+    Отсутствие или повреждение файла не является ошибкой - воркер начнет с чистого состояния.
+
+    Returns:
+        dict: Словарь состояния или пустой словарь.
+    """
+    return _load_state_file(common.WORKER_STATE_FILE)
+
+def save_worker_state(state_data):
+    """
+    Атомарно сохраняет состояние воркера в worker_state.json (права 600, директория 700).
+
+    Args:
+        state_data (dict): Словарь состояния.
+
+    Returns:
+        bool: True при успехе, False при ошибке.
+    """
+    return _save_state_file(common.WORKER_STATE_FILE, state_data, "состояния воркера")
+
+def load_applied_plan():
+    """
+    Загружает последний примененный план правил (applied_plan.json).
+    Нужен, чтобы удерживать правила при недоступности панели и после перезапуска воркера.
+
+    Returns:
+        dict: Сохраненный план или пустой словарь.
+    """
+    return _load_state_file(common.APPLIED_PLAN_FILE)
+
+def save_applied_plan(plan_data):
+    """
+    Атомарно сохраняет примененный план правил в applied_plan.json.
+
+    Args:
+        plan_data (dict): План и метаданные (IP пользователей, время последнего ответа панели).
+
+    Returns:
+        bool: True при успехе, False при ошибке.
+    """
+    return _save_state_file(common.APPLIED_PLAN_FILE, plan_data, "примененного плана")
+
+def load_ip_cache():
+    """
+    Загружает сохраненный кэш результатов получения IP (ip_cache.json) для теплого старта воркера.
+
+    Returns:
+        dict: Данные кэша или пустой словарь.
+    """
+    return _load_state_file(common.IP_CACHE_FILE)
+
+def save_ip_cache(cache_data):
+    """
+    Атомарно сохраняет кэш результатов получения IP в ip_cache.json.
+
+    Args:
+        cache_data (dict): Данные кэша (xui_api.IpResolutionCache.to_dict()).
+
+    Returns:
+        bool: True при успехе, False при ошибке.
+    """
+    return _save_state_file(common.IP_CACHE_FILE, cache_data, "кэша IP")
+
+def load_xray_mark_snippet():
+    """
+    Загружает последний сгенерированный фрагмент конфигурации Xray для режима меток.
+
+    Returns:
+        dict: Фрагмент или пустой словарь.
+    """
+    return _load_state_file(common.XRAY_MARK_SNIPPET_FILE)
+
+def save_xray_mark_snippet(snippet_data):
+    """
+    Сохраняет фрагмент конфигурации Xray (outbounds и правила маршрутизации по меткам) в читаемом виде.
+
+    Args:
+        snippet_data (dict): Результат tc_manager.build_xray_mark_config().
+
+    Returns:
+        bool: True при успехе, False при ошибке.
+    """
+    return _save_state_file(common.XRAY_MARK_SNIPPET_FILE, snippet_data, "фрагмента конфигурации Xray", indent=2)
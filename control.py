@@ -0,0 +1,246 @@
+"""
+Управляющий Unix-сокет воркера-демона xraySpeedLimit.
+- Протокол: одна JSON-строка запроса -> одна JSON-строка ответа, по одному соединению
+  можно отправить любое количество запросов подряд.
+- Сервер (ControlServer) встраивается в select()-цикл демона, команды обрабатываются
+  между циклами, ответ отправляется только после обновления правил в ядре.
+- Клиент (send_command) используется меню MK_XSL.py и автоматизацией.
+
+Команды: ping, set_limit, set_limits, remove_limit, cycle, dump, timings.
+"""
+
+import json
+import os
+import socket
+import stat
+
+# Импортируем общие константы
+try:
+    import common
+    import log_utils
+except ImportError:
+    print("Ошибка: Не удалось импортировать common.py.")
+    import sys
+    sys.exit(1)
+
+# --- Константы ---
+CONTROL_TIMEOUT = 30        # Секунды ожидания ответа клиентом, если не задан таймаут по бюджету цикла
+CONTROL_APPLY_MARGIN = 30   # Запас сверх бюджета цикла: применение правил в бюджет не входит
+CONTROL_UNBOUNDED_TIMEOUT = 600 # Таймаут ответа, если бюджет цикла не ограничен
+MAX_REQUEST_SIZE = 1 << 20  # Максимальная длина одной строки запроса (байт)
+SEND_TIMEOUT = 5            # Секунды на отправку ответа медленному клиенту
+
+_logger = log_utils.get_logger('control')
+
+
+class ControlError(Exception):
+    """Ошибка выполнения команды (сообщение уходит клиенту в поле 'error')."""
+
+
+# --- Сервер ---
+
+class ControlServer:
+    """
+    Неблокирующий сервер управляющего сокета для select()-цикла.
+
+    Использование:
+        server = ControlServer(handlers)
+        ready, _, _ = select.select(server.fds() + other_fds, [], [], timeout)
+        server.process(ready)
+    """
+
+    def __init__(self, handlers, socket_path=None):
+        """
+        Args:
+            handlers (dict): { 'команда': функция(params: dict) -> dict }.
+                             Функция может бросить ControlError для ответа с ошибкой.
+            socket_path (str, optional): Путь к сокету (по умолчанию common.CONTROL_SOCKET_PATH).
+
+        Raises:
+            OSError: Если сокет не удалось создать.
+        """
+        self.handlers = handlers
+        self.socket_path = socket_path or common.CONTROL_SOCKET_PATH
+        self._clients = {} # socket -> bytearray (буфер недочитанного запроса)
+
+        socket_dir = os.path.dirname(self.socket_path)
+        os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+        # Удаляем "осиротевший" сокет от прошлого запуска (но не чужой файл)
+        if os.path.exists(self.socket_path):
+            if not stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+                raise OSError(f"{self.socket_path} существует и не является сокетом")
+            os.unlink(self.socket_path)
+
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600) # Управлять воркером может только root
+        self._listener.listen(16)
+        self._listener.setblocking(False)
+
+    def fds(self):
+        """Сокеты для select(): слушающий и все открытые соединения."""
+        return [self._listener] + list(self._clients)
+
+    def process(self, ready):
+        """Обрабатывает готовые к чтению сокеты из результата select()."""
+        for sock in ready:
+            if sock is self._listener:
+                self._accept()
+            elif sock in self._clients:
+                self._read(sock)
+
+    def close(self):
+        for client in list(self._clients):
+            self._drop(client)
+        self._listener.close()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+    def _accept(self):
+        try:
+            client, _ = self._listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        client.setblocking(False)
+        self._clients[client] = bytearray()
+
+    def _drop(self, client):
+        self._clients.pop(client, None)
+        try:
+            client.close()
+        except OSError:
+            pass
+
+    def _read(self, client):
+        try:
+            data = client.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._drop(client)
+            return
+        buffer = self._clients[client]
+        buffer.extend(data)
+        while b'\n' in buffer:
+            line, _, rest = bytes(buffer).partition(b'\n')
+            buffer[:] = rest
+            if line.strip() and not self._respond(client, self._dispatch(line)):
+                return
+        if len(buffer) > MAX_REQUEST_SIZE:
+            self._respond(client, {'ok': False, 'error': 'Слишком длинный запрос'})
+            self._drop(client)
+
+    def _dispatch(self, line):
+        """Разбирает строку запроса и вызывает обработчик команды."""
+        try:
+            request = json.loads(line)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return {'ok': False, 'error': 'Некорректный JSON'}
+        if not isinstance(request, dict) or not isinstance(request.get('cmd'), str):
+            return {'ok': False, 'error': "Ожидается объект с полем 'cmd'"}
+        command = request['cmd']
+        handler = self.handlers.get(command)
+        if handler is None:
+            return {'ok': False, 'error': f"Неизвестная команда '{command}'", 'commands': sorted(self.handlers)}
+        _logger.debug("Команда '%s' через управляющий сокет", command)
+        try:
+            response = handler(request)
+        except ControlError as e:
+            return {'ok': False, 'error': str(e)}
+        except Exception as e:
+            _logger.exception("Ошибка обработки команды '%s'", command)
+            return {'ok': False, 'error': f"Внутренняя ошибка: {e}"}
+        return dict(response or {}, ok=True)
+
+    def _respond(self, client, response):
+        """Отправляет ответ. Возвращает False, если клиент отключен."""
+        payload = json.dumps(response, ensure_ascii=False, default=str).encode('utf-8') + b'\n'
+        try:
+            client.settimeout(SEND_TIMEOUT)
+            client.sendall(payload)
+            client.setblocking(False)
+            return True
+        except OSError:
+            self._drop(client)
+            return False
+
+
+# --- Клиент ---
+
+def send_command(cmd, socket_path=None, timeout=CONTROL_TIMEOUT, **params):
+    """
+    Отправляет одну команду воркеру-демону и ждет ответ.
+
+    Args:
+        cmd (str): Команда ('set_limit', 'cycle', ...).
+        socket_path (str, optional): Путь к сокету.
+        timeout (float): Таймаут ожидания ответа в секундах.
+        **params: Параметры команды (напр. email='user', limit=10).
+
+    Returns:
+        dict or None: Ответ демона ('ok': True/False, ...) или None, если демон не запущен
+                      (сокета нет или соединение отклонено) либо оборвал соединение.
+                      Если демон принял команду, но не ответил за timeout, - {'ok': False,
+                      'timeout': True, 'error': ...}: команда может быть еще выполнена.
+    """
+    path = socket_path or common.CONTROL_SOCKET_PATH
+    if not os.path.exists(path):
+        return None
+    request = json.dumps(dict(params, cmd=cmd), ensure_ascii=False).encode('utf-8') + b'\n'
+    sent = False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(request)
+            sent = True
+            response = bytearray()
+            while b'\n' not in response:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                response.extend(chunk)
+        return json.loads(bytes(response).partition(b'\n')[0])
+    except socket.timeout:
+        if not sent:
+            return None
+        return {'ok': False, 'timeout': True,
+                'error': f"Демон не ответил за {timeout:.0f} сек (команда принята и может быть выполнена позже)"}
+    except (OSError, json.JSONDecodeError, UnicodeDecodeError):
+        return None
+
+
+def _parse_cli_value(value):
+    """Значение параметра из командной строки: JSON, если разбирается (числа, объекты), иначе строка."""
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        return value
+
+
+def main_cli(args, timeout=CONTROL_TIMEOUT):
+    """
+    Консольный клиент: 'xray_limit_worker.py --ctl <команда> [ключ=значение ...]'.
+    Печатает ответ в JSON. Код выхода 0 - успех, 1 - ошибка команды, 2 - демон недоступен.
+    timeout - секунды ожидания ответа (воркер передает бюджет цикла с запасом).
+    """
+    if not args:
+        print("Использование: --ctl <команда> [ключ=значение ...]")
+        return 2
+    params = {}
+    for arg in args[1:]:
+        key, sep, value = arg.partition('=')
+        if not sep:
+            print(f"Некорректный параметр '{arg}', ожидается ключ=значение")
+            return 2
+        params[key] = _parse_cli_value(value)
+    response = send_command(args[0], timeout=timeout, **params)
+    if response is None:
+        print(f"Воркер-демон недоступен ({common.CONTROL_SOCKET_PATH}).")
+        return 2
+    print(json.dumps(response, ensure_ascii=False, indent=2))
+    return 0 if response.get('ok') else 1
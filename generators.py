@@ -7,6 +7,7 @@
 
 import os, stat, json
 from xui_api import IP_FETCH_API, IP_FETCH_LOG
+import worker
 
 # Импортируем общие константы и цвета
 try:
@@ -24,16 +25,14 @@ def create_worker_script(worker_script_path, config_file_path, limits_file_path)
     abs_limits_path = os.path.abspath(limits_file_path)
     project_dir = os.path.dirname(os.path.abspath(__file__))
 
-    # Окончательно исправленный код воркера
+    # Вся логика воркера находится в модуле worker.py, скрипт только подключает модули проекта
     worker_code = f"""#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # Скрипт воркера xraySpeedLimit (генерируется автоматически)
+# Запуск: без аргументов - однократный цикл (таймер), '--daemon' - постоянный процесс.
 
 import sys
-import os
-import time
 from datetime import datetime
-import traceback # Для детального логирования ошибок
 
 # --- Добавляем путь к директории с модулями ---
 project_path = '{project_dir}'
@@ -42,12 +41,7 @@ if project_path not in sys.path:
 
 # --- Импорт наших модулей ---
 try:
-    import common
-    import config_manager
-    import xui_api
-    import tc_manager
-    # Импортируем константы для метода получения IP
-    from xui_api import IP_FETCH_API, IP_FETCH_LOG
+    import worker
 except ImportError as e:
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     # Используем двойные фигурные скобки для экранирования внутри f-строки
@@ -55,188 +49,13 @@ except ImportError as e:
     sys.exit(1)
 
 # --- Константы Воркера ---
-# Пути к файлам больше не используются напрямую для load_config/load_user_limits,
-# но оставим их для информации или будущих нужд.
+# Пути к файлам берутся из common.py, здесь оставлены для информации.
 CONFIG_FILE = '{abs_config_path}'
 USER_LIMITS_FILE = '{abs_limits_path}'
-DEFAULT_LOG_PATH = "/usr/local/x-ui/access.log" # Стандартный путь, если не задан в конфиге
-DEFAULT_LOG_LINES = 500                     # Стандартное кол-во строк, если не задано
-
-# --- Логирование Воркера ---
-def log_worker(level, message):
-    \"\"\"Логирование сообщений воркера с временной меткой.\"\"\"
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    # Проверяем наличие common.Color перед использованием
-    color = getattr(common, 'Color', None)
-    reset_color = getattr(color, 'RESET', '') if color else ''
-    level_upper = level.upper()
-
-    color_map = {{
-        'ERROR': getattr(color, 'RED', '') if color else '',
-        'WARNING': getattr(color, 'YELLOW', '') if color else '',
-        'INFO': getattr(color, 'GREEN', '') if color else '',
-        'DEBUG': getattr(color, 'DIM', '') if color else '',
-        'CRITICAL': (getattr(color, 'RED', '') + getattr(color, 'BOLD', '')) if color else ''
-    }}
-    log_color = color_map.get(level_upper, reset_color)
-
-    # Используем двойные фигурные скобки для экранирования внутри f-строки
-    print(f"{{timestamp}} {{log_color}}[{{level_upper}}] {{message}}{{reset_color}}")
-    sys.stdout.flush()
-
-# --- Основная логика Воркера ---
-def run_worker_cycle():
-    log_worker('info', "Запуск цикла обновления правил TC...")
-
-    # 1. Загрузка конфигурации и лимитов (используются пути по умолчанию из common.py)
-    config = config_manager.load_config() # <-- БЕЗ АРГУМЕНТА
-    user_limits = config_manager.load_user_limits() # <-- БЕЗ АРГУМЕНТА
-
-    if not config:
-        # Используем common.CONFIG_FILE для сообщения об ошибке
-        log_worker('critical', f"Ошибка: Конфигурационный файл {{common.CONFIG_FILE}} отсутствует или пуст.")
-        return
-    required_keys = ["api_url", "api_user", "api_pass", "iface"]
-    if not all(k in config for k in required_keys):
-        missing = [k for k in required_keys if k not in config]
-        # Используем common.CONFIG_FILE для сообщения об ошибке
-        log_worker('critical', f"Ошибка: Конфигурационный файл {{common.CONFIG_FILE}} неполный. Отсутствуют ключи: {{', '.join(missing)}}")
-        return
-    if user_limits is None: # Проверяем на None (ошибка загрузки)
-        # Используем common.USER_LIMITS_FILE для сообщения об ошибке
-        log_worker('critical', f"Ошибка: Не удалось загрузить файл лимитов {{common.USER_LIMITS_FILE}}.")
-        return # Выходим, если лимиты не загрузились
-
-    network_interface = config['iface']
-    # Получаем метод получения IP из конфига, по умолчанию - API
-    ip_fetch_method = config.get('ip_fetch_method', IP_FETCH_API)
-    # Получаем параметры для парсинга логов (если они есть в конфиге)
-    log_file_path = config.get('log_file_path', DEFAULT_LOG_PATH)
-    log_read_lines = config.get('log_read_lines', DEFAULT_LOG_LINES)
-
-    # Используем двойные фигурные скобки для экранирования внутри f-строки
-    log_worker('info', f"Используется интерфейс: {{network_interface}}")
-    # Используем f-string для вычисления выражения *во время выполнения* воркера
-    log_worker('info', f"Метод получения IP: {{'API' if ip_fetch_method == IP_FETCH_API else 'Парсинг лога'}}")
-    if ip_fetch_method == IP_FETCH_LOG:
-        # Используем двойные фигурные скобки для экранирования внутри f-строки
-        log_worker('info', f"Параметры лога: Путь={{log_file_path}}, Строк={{log_read_lines}}")
-
-    # Проверка, есть ли вообще лимиты пользователей
-    if not user_limits:
-        log_worker('info', "Список лимитов пользователей пуст. Очистка динамических правил TC...")
-        tc_manager.clear_dynamic_tc_rules(network_interface)
-        log_worker('info', "Работа завершена (нет настроенных лимитов).")
-        return
-
-    # 2. Инициализация API клиента
-    try:
-        # Используем двойные фигурные скобки для экранирования внутри f-строки
-        log_worker('debug', f"Попытка инициализации API клиента для {{config['api_url']}}")
-        api_client = xui_api.XUIApiClient(
-            panel_url=config['api_url'],
-            username=config['api_user'],
-            password=config['api_pass'],
-            log_file_path=log_file_path,  # Передаем параметры лога
-            log_read_lines=log_read_lines # в клиент
-        )
-        log_worker('info', f"API клиент успешно инициализирован.")
-    except ConnectionError as e:
-        # Используем двойные фигурные скобки для экранирования внутри f-строки
-        log_worker('critical', f"Критическая ошибка: Не удалось подключиться/войти в API X-UI: {{e}}")
-        log_worker('info', "Очистка динамических правил TC из-за ошибки инициализации API...")
-        tc_manager.clear_dynamic_tc_rules(network_interface) # Очищаем правила при ошибке входа
-        return # Прерываем цикл, т.к. без API не получить онлайн (если метод API)
-    except Exception as e: # Отступ этой строки проверен
-        # Используем двойные фигурные скобки для экранирования внутри f-строки
-        log_worker('critical', f"!!! Непредвиденная ошибка при инициализации API (Generic Exception): {{e}}")
-        # log_worker('critical', "Трейсбек временно отключен для отладки синтаксиса.")
-        return # Прерываем цикл
-
-    # 3. Получение онлайн пользователей (нужно для сверки)
-    online_users_set = api_client.get_online_users_emails()
-    if online_users_set is None:
-        log_worker('error', "Не удалось получить список онлайн пользователей из API. Обновление правил отложено.")
-        return
-    if not online_users_set:
-        log_worker('info', "Нет активных онлайн пользователей по данным API. Очистка правил...")
-        tc_manager.clear_dynamic_tc_rules(network_interface)
-        log_worker('info', "Работа завершена (нет онлайн пользователей).")
-        return
-
-    # 4. Определение релевантных пользователей и сбор их IP
-    users_with_limits_set = set(user_limits.keys())
-    relevant_online_users = online_users_set.intersection(users_with_limits_set)
-
-    if not relevant_online_users:
-        log_worker('info', "Нет онлайн пользователей с настроенными лимитами. Очистка правил...")
-        tc_manager.clear_dynamic_tc_rules(network_interface)
-        log_worker('info', "Работа завершена (нет релевантных онлайн).")
-        return
-
-    # Используем двойные фигурные скобки для экранирования внутри f-строки
-    log_worker('info', f"Обнаружено {{len(relevant_online_users)}} онлайн пользователей с лимитами: {{', '.join(sorted(list(relevant_online_users)))}}")
-    active_ips_to_limit = {{}} # Словарь {{ip: limit_mbps}} # Отступ этой строки проверен
-    processed_users_count = 0
-
-    for user_email in relevant_online_users:
-        limit = user_limits.get(user_email) # Получаем лимит из загруженного словаря
-        if not limit or limit <= 0:
-            # Используем двойные фигурные скобки для экранирования внутри f-строки
-            log_worker('debug', f"Пропуск пользователя '{{user_email}}' с недействительным лимитом: {{limit}}")
-            continue
-
-        # Получаем IP выбранным методом!
-        user_ip_list = api_client.get_client_ip_addresses(user_email, method=ip_fetch_method)
-
-        if user_ip_list is None:
-            # Используем двойные фигурные скобки для экранирования внутри f-строки
-            log_worker('warning', f"Не удалось получить IP для пользователя '{{user_email}}' (метод: {{ip_fetch_method}}). Пропускаем.")
-            continue # Пропускаем пользователя, но продолжаем с другими
-
-        if user_ip_list: # Если список не пустой (IP найдены)
-            # Используем двойные фигурные скобки для экранирования внутри f-строки
-            log_worker('debug', f"Пользователь '{{user_email}}' ({{limit}} Мбит/с) -> IP: {{', '.join(user_ip_list)}} (метод: {{ip_fetch_method}})")
-            processed_users_count += 1
-            for ip in user_ip_list:
-                 if ip in active_ips_to_limit and active_ips_to_limit[ip] != limit:
-                     # Используем двойные фигурные скобки для экранирования внутри f-строки
-                     log_worker('warning', f"IP {{ip}} используется несколькими пользователями. Лимит будет перезаписан: {{active_ips_to_limit[ip]}} -> {{limit}} (для '{{user_email}}')")
-                 active_ips_to_limit[ip] = limit
-        else:
-            # Используем двойные фигурные скобки для экранирования внутри f-строки
-            log_worker('debug', f"IP для пользователя '{{user_email}}' не найдены методом '{{ip_fetch_method}}'.")
-
-    # 5. Применение правил TC
-    # Используем двойные фигурные скобки для экранирования внутри f-строки
-    log_worker('info', f"Собраны IP для {{processed_users_count}} пользователей. Всего IP для ограничения: {{len(active_ips_to_limit)}}.")
-    if active_ips_to_limit:
-        applied_count = tc_manager.apply_tc_rules(network_interface, active_ips_to_limit)
-        # Используем двойные фигурные скобки для экранирования внутри f-строки
-        log_worker('info', f"Применение правил TC завершено. Успешно применено/обновлено правил: {{applied_count}}.")
-    else:
-        log_worker('info', "Нет активных IP для применения правил. Очистка динамических правил...")
-        tc_manager.clear_dynamic_tc_rules(network_interface)
-
-    log_worker('info', "Цикл обновления правил TC завершен.")
-
 
 # --- Точка входа скрипта воркера ---
 if __name__ == "__main__":
-    try:
-        run_worker_cycle()
-    except Exception as e:
-        # Используем двойные фигурные скобки для экранирования внутри f-строки
-        log_worker('critical', f"Неперехваченное исключение в главном цикле воркера: {{e}}")
-        try:
-            # Форматируем трейсбек БЕЗ экранирования для f-string
-            tb_str = traceback.format_exc()
-            # Выводим трейсбек как отдельное сообщение, НЕ используя f-string для него
-            log_worker('critical', "Traceback:\\n" + tb_str) # <-- УПРОЩЕННОЕ ЛОГИРОВАНИЕ ТРЕЙСБЕКА
-        except Exception:
-            log_worker('error', "Не удалось отформатировать трейсбек.")
-        sys.exit(1)
-    sys.exit(0)
+    sys.exit(worker.main(sys.argv[1:]))
 """  # Конец f-строки worker_code
 
     # Комментарий теперь на отдельной строке (или его можно просто удалить)
@@ -255,79 +74,34 @@ if __name__ == "__main__":
 
 # --- Генерация базовой TC настройки (Shell-скрипт) ---
 
-def create_base_tc_script(script_path, iface):
-    """Создает shell-скрипт для начальной настройки TC (qdisc, классы)."""
-    print(f"{common.Color.CYAN}Генерация скрипта базовой настройки TC ({common.BASE_TC_SCRIPT_NAME})...{common.Color.RESET}")
+def create_base_tc_script(script_path, worker_script_path):
+    """
+    Создает shell-скрипт для начальной настройки TC (qdisc, классы).
 
-    # Генерируем команды для создания предопределенных HTB классов
-    class_commands = ""
-    # Сортируем классы по ID для порядка в скрипте
-    for class_id, limit_mbps in sorted(common.PREDEFINED_LIMIT_CLASSES.items()):
-         # rate и ceil одинаковые
-         class_commands += f"echo '   - Создание класса 1:{class_id} ({limit_mbps} Мбит/с)...'\n"
-         # Используем common.TC_PATH
-         # Добавляем || true для игнорирования ошибок, если класс уже существует
-         class_commands += f"{common.TC_PATH} class add dev $IFACE parent 1:1 classid 1:{class_id} htb rate {limit_mbps}mbit ceil {limit_mbps}mbit || echo '    (Предупреждение: Класс 1:{class_id} уже существует или ошибка создания)'\n"
+    Структура базы описана данными (tc_manager.base_tree_spec) и приводится к нужному виду воркером
+    ('--base-tc'): интерфейсы и их пропускная способность читаются из config.json при запуске,
+    меняется только то, что отличается. Повторный запуск ничего не удаляет и не прерывает трафик.
+
+    Args:
+        script_path (str): Путь к скрипту.
+        worker_script_path (str): Путь к скрипту воркера.
+    """
+    print(f"{common.Color.CYAN}Генерация скрипта базовой настройки TC ({common.BASE_TC_SCRIPT_NAME})...{common.Color.RESET}")
 
     # Содержимое shell-скрипта
-    # --- ИЗМЕНЕНИЕ: default 30 вместо default 1 ---
     script_content = f"""#!/bin/bash
 # Скрипт базовой настройки TC для xraySpeedLimit
+# Интерфейсы - из config.json ('interfaces' или 'iface'), изменяются только отличия от нужной структуры.
 
-IFACE="{iface}"
 TC_CMD="{common.TC_PATH}" # Используем путь из common.py
 
-echo "-----------------------------------------------------"
-echo "[TC BASE] Настройка базовой структуры TC для: $IFACE"
-echo "-----------------------------------------------------"
-
 # Проверка наличия tc
 if ! command -v $TC_CMD &> /dev/null; then
     echo "[TC BASE ERROR] Утилита '$TC_CMD' не найдена. Установите iproute2." >&2
     exit 1
 fi
 
-# 1. Очистка существующих qdisc (игнорируем ошибки)
-echo "[TC BASE] 1. Очистка qdisc root и ingress..."
-$TC_CMD qdisc del dev $IFACE root > /dev/null 2>&1
-$TC_CMD qdisc del dev $IFACE ingress > /dev/null 2>&1
-
-# 2. Добавляем корневой qdisc HTB (egress)
-# --- ИЗМЕНЕНО ЗДЕСЬ: default 30 ---
-echo "[TC BASE] 2. Добавление root qdisc HTB (handle 1:, default 30)..."
-if ! $TC_CMD qdisc add dev $IFACE root handle 1: htb default 30; then
-    echo "[TC BASE ERROR] Не удалось добавить root qdisc HTB." >&2
-    exit 1
-fi
-
-# 3. Добавляем основной класс 1:1
-# Rate/Ceil можно сделать большими, они ограничивают сумму дочерних
-# и трафик по умолчанию (default 30 теперь)
-main_rate="1000mbit" # Можно сделать настраиваемым позже
-echo "[TC BASE] 3. Добавление основного класса 1:1 (rate $main_rate)..."
-if ! $TC_CMD class add dev $IFACE parent 1: classid 1:1 htb rate $main_rate ceil $main_rate; then
-    echo "[TC BASE ERROR] Не удалось добавить основной класс 1:1." >&2
-    $TC_CMD qdisc del dev $IFACE root > /dev/null 2>&1 # Попытка очистки
-    exit 1
-fi
-
-# 4. Добавляем предопределенные классы скорости
-echo "[TC BASE] 4. Добавление предопределенных классов HTB..."
-{class_commands}
-echo "[TC BASE]    Добавление классов завершено."
-
-# 5. Добавляем qdisc ingress
-echo "[TC BASE] 5. Добавление ingress qdisc (handle ffff:)..."
-if ! $TC_CMD qdisc add dev $IFACE handle ffff: ingress; then
-    echo "[TC BASE ERROR] Не удалось добавить ingress qdisc." >&2
-    $TC_CMD qdisc del dev $IFACE root > /dev/null 2>&1 # Попытка очистки
-    exit 1
-fi
-
-echo "-----------------------------------------------------"
-echo "[TC BASE] Базовая настройка TC для $IFACE завершена."
-echo "-----------------------------------------------------"
-exit 0
+exec /usr/bin/env python3 "{worker_script_path}" --base-tc
 """
     try:
         # Записываем скрипт и делаем его исполняемым (755)
@@ -377,9 +151,18 @@ WantedBy=multi-user.target
         print(f"{common.Color.RED}[ОШИБКА] Не удалось записать systemd сервис базы TC {service_path}: {e}{common.Color.RESET}")
         return False
 
-def create_worker_service_files(timer_path, service_path, worker_script_path):
-    """Создает systemd .timer и .service файлы для периодического запуска воркера."""
-    print(f"{common.Color.CYAN}Генерация systemd файлов воркера ({common.WORKER_SERVICE_NAME}, {common.WORKER_TIMER_NAME})...{common.Color.RESET}")
+def create_worker_service_files(timer_path, service_path, worker_script_path,
+                                worker_mode=worker.WORKER_MODE_TIMER,
+                                timer_interval=worker.DEFAULT_TIMER_INTERVAL_SEC):
+    """
+    Создает systemd файлы воркера.
+    - Режим 'timer': .timer с шагом timer_interval (каждый запуск - полный цикл) и .service для однократного запуска.
+    - Режим 'daemon': только .service с постоянным процессом (--daemon) и адаптивным интервалом, таймер не нужен.
+    """
+    is_daemon = worker_mode == worker.WORKER_MODE_DAEMON
+    unit_names = common.WORKER_SERVICE_NAME if is_daemon else f"{common.WORKER_SERVICE_NAME}, {common.WORKER_TIMER_NAME}"
+    print(f"{common.Color.CYAN}Генерация systemd файлов воркера ({unit_names})...{common.Color.RESET}")
+    timer_step = max(1, int(timer_interval))
 
     # --- Таймер ---
     timer_content = f"""[Unit]
@@ -389,10 +172,10 @@ Documentation=https://github.com/MKultra6969/xraySpeedLimit
 Requires={common.WORKER_SERVICE_NAME}
 
 [Timer]
-# Запуск через 1 минуту после загрузки и каждые 60 сек после активации
+# Запуск через 1 минуту после загрузки и каждые {timer_step} сек после активации, с небольшой рандомизацией
 OnBootSec=1min
-OnUnitActiveSec=60s
-RandomizedDelaySec=10s # Небольшая рандомизация
+OnUnitActiveSec={timer_step}s
+RandomizedDelaySec=10s
 AccuracySec=1s
 Unit={common.WORKER_SERVICE_NAME}
 
@@ -412,12 +195,12 @@ Requires={common.BASE_TC_SERVICE_NAME}
 [Service]
 Type=simple
 # Используем /usr/bin/env для поиска python3
-ExecStart=/usr/bin/env python3 {worker_script_path}
+ExecStart=/usr/bin/env python3 {worker_script_path}{' --daemon' if is_daemon else ''}
 User=root
 Group=root
-# Перезапуск при сбое
-Restart=on-failure
-RestartSec=30s
+# Перезапуск при сбое (демон перезапускается всегда)
+Restart={'always' if is_daemon else 'on-failure'}
+RestartSec={'5s' if is_daemon else '30s'}
 # Логирование в journald
 StandardOutput=journal+console
 StandardError=journal+console
@@ -430,11 +213,12 @@ TimeoutStopSec=30s
 WantedBy=multi-user.target
 """
     try:
-        # Записываем таймер
-        with open(timer_path, 'w', encoding='utf-8') as f:
-            f.write(timer_content)
-        os.chmod(timer_path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH) # 644
-        print(f"{common.Color.GREEN}✓ Файл таймера воркера сохранен: {timer_path}{common.Color.RESET}")
+        # Записываем таймер (в режиме демона он не нужен)
+        if not is_daemon:
+            with open(timer_path, 'w', encoding='utf-8') as f:
+                f.write(timer_content)
+            os.chmod(timer_path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH) # 644
+            print(f"{common.Color.GREEN}✓ Файл таймера воркера сохранен: {timer_path}{common.Color.RESET}")
 
         # Записываем сервис
         with open(service_path, 'w', encoding='utf-8') as f:
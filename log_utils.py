@@ -0,0 +1,206 @@
+"""
+Единый слой логирования для xraySpeedLimit (воркер, xui_api, tc_manager).
+- Уровни настраиваются в config.json: 'log_level' (общий) и 'log_levels' (по компонентам).
+- Сообщения форматируются лениво: аргументы подставляются только если уровень включен.
+- Форматы вывода: 'text' (по умолчанию), 'json' (одна JSON-строка на событие)
+  и 'journal' (нативная запись в journald через python3-systemd, если установлен).
+- Сводные строки по циклу (log_summary) вместо построчного вывода по каждому IP.
+"""
+
+import json
+import logging
+import sys
+import time
+
+# Импортируем общие константы и цвета
+try:
+    import common
+except ImportError:
+    print("Ошибка: Не удалось импортировать common.py.")
+    sys.exit(1)
+
+# python3-systemd - опциональная зависимость (только для формата 'journal')
+try:
+    from systemd import journal as systemd_journal
+except ImportError:
+    systemd_journal = None
+
+# --- Константы логирования ---
+ROOT_LOGGER_NAME = 'xsl'
+DEFAULT_LOG_LEVEL = 'info'
+LOG_FORMAT_TEXT = 'text'
+LOG_FORMAT_JSON = 'json'
+LOG_FORMAT_JOURNAL = 'journal'
+JOURNAL_IDENTIFIER = 'xray-limit-worker'
+
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'critical': logging.CRITICAL,
+}
+
+_LEVEL_COLORS = {
+    logging.DEBUG: common.Color.DIM,
+    logging.INFO: common.Color.CYAN,
+    logging.WARNING: common.Color.YELLOW,
+    logging.ERROR: common.Color.RED,
+    logging.CRITICAL: common.Color.RED + common.Color.BOLD,
+}
+
+
+def _parse_level(level_name, default=logging.INFO):
+    """Преобразует имя уровня ('debug', 'INFO', ...) в числовой уровень logging."""
+    if isinstance(level_name, int):
+        return level_name
+    if not isinstance(level_name, str):
+        return default
+    return LOG_LEVELS.get(level_name.strip().lower(), default)
+
+
+def _component_of(record):
+    """Возвращает имя компонента ('api', 'tc', 'worker') из имени логгера."""
+    name = record.name
+    prefix = ROOT_LOGGER_NAME + '.'
+    return name[len(prefix):] if name.startswith(prefix) else name
+
+
+# --- Форматтеры ---
+
+class _TextFormatter(logging.Formatter):
+    """Текстовый формат: '[время] [COMPONENT-LEVEL] сообщение', с цветами только для TTY."""
+
+    def __init__(self, use_color, with_timestamps):
+        super().__init__()
+        self.use_color = use_color
+        self.with_timestamps = with_timestamps
+
+    def format(self, record):
+        message = record.getMessage() # Здесь происходит отложенная подстановка аргументов
+        prefix = f"[{_component_of(record).upper()}-{record.levelname}]"
+        line = f"{prefix} {message}"
+        if self.with_timestamps:
+            line = f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.created))} {line}"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        if self.use_color:
+            color = _LEVEL_COLORS.get(record.levelno, '')
+            line = f"{color}{line}{common.Color.RESET}"
+        return line
+
+
+class _JsonFormatter(logging.Formatter):
+    """JSON-формат: одна строка на событие, дополнительные поля из log_summary сохраняются как есть."""
+
+    def format(self, record):
+        payload = {
+            'ts': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'component': _component_of(record),
+            'msg': record.getMessage(),
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            payload.update(fields)
+        if record.exc_info:
+            payload['exc'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class _JournalFieldsFilter(logging.Filter):
+    """Переносит поля log_summary в верхний регистр для journald (XSL_<FIELD>=...)."""
+
+    def filter(self, record):
+        fields = getattr(record, 'fields', None)
+        if fields:
+            for key, value in fields.items():
+                setattr(record, f"XSL_{key.upper()}", value)
+        return True
+
+
+# --- Настройка ---
+
+def setup_logging(config=None, with_timestamps=False):
+    """
+    Настраивает логирование по параметрам из config.json. Можно вызывать повторно
+    (например, после перечитывания конфигурации) - старые обработчики заменяются.
+
+    Параметры config (все опциональные):
+        log_level (str): Общий уровень ('debug', 'info', 'warning', 'error'). По умолчанию 'info'.
+        log_levels (dict): Уровни по компонентам, напр. {"api": "debug", "tc": "warning"}.
+        log_format (str): 'text', 'json' или 'journal'.
+
+    Args:
+        config (dict, optional): Загруженная конфигурация.
+        with_timestamps (bool): Добавлять время в текстовый формат (для воркера).
+    """
+    config = config or {}
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    root.setLevel(_parse_level(config.get('log_level', DEFAULT_LOG_LEVEL)))
+    root.propagate = False
+
+    # Уровни компонентов: сбрасываем старые, ставим новые
+    for name, logger in list(logging.Logger.manager.loggerDict.items()):
+        if isinstance(logger, logging.Logger) and name.startswith(ROOT_LOGGER_NAME + '.'):
+            logger.setLevel(logging.NOTSET)
+    component_levels = config.get('log_levels') or {}
+    if isinstance(component_levels, dict):
+        for component, level_name in component_levels.items():
+            get_logger(component).setLevel(_parse_level(level_name))
+
+    log_format = str(config.get('log_format', LOG_FORMAT_TEXT)).lower()
+    handler = None
+    if log_format == LOG_FORMAT_JOURNAL:
+        if systemd_journal is not None:
+            handler = systemd_journal.JournalHandler(SYSLOG_IDENTIFIER=JOURNAL_IDENTIFIER)
+            handler.addFilter(_JournalFieldsFilter())
+        else:
+            log_format = LOG_FORMAT_JSON # Без python3-systemd пишем JSON в stdout (journald его сохранит)
+    if handler is None:
+        handler = logging.StreamHandler(sys.stdout)
+        if log_format == LOG_FORMAT_JSON:
+            handler.setFormatter(_JsonFormatter())
+        else:
+            use_color = hasattr(sys.stdout, 'isatty') and sys.stdout.isatty()
+            handler.setFormatter(_TextFormatter(use_color, with_timestamps))
+
+    for old_handler in list(root.handlers):
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+
+    if config.get('log_format') == LOG_FORMAT_JOURNAL and systemd_journal is None:
+        root.warning("Формат 'journal' недоступен (нет модуля python3-systemd). Используется JSON.")
+
+
+def get_logger(component):
+    """Возвращает логгер компонента (дочерний для общего логгера 'xsl')."""
+    return logging.getLogger(f"{ROOT_LOGGER_NAME}.{component}")
+
+
+def log_summary(logger, event, level=logging.INFO, **fields):
+    """
+    Пишет одну сводную строку вида 'event: key=value key=value'.
+    В JSON/journald поля передаются структурированно.
+
+    Args:
+        logger (logging.Logger): Логгер компонента.
+        event (str): Название события (напр. 'Цикл завершен').
+        level (int): Уровень logging.
+        **fields: Поля сводки.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    fields_str = ' '.join(f"{key}={_format_field(value)}" for key, value in fields.items())
+    logger.log(level, "%s: %s", event, fields_str, extra={'fields': dict(fields, event=event)})
+
+
+def _format_field(value):
+    """Компактное представление значения поля сводки."""
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    return str(value)
+
+
+# Значения по умолчанию до чтения config.json (интерактивное меню)
+setup_logging()
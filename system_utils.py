@@ -4,20 +4,29 @@
 - Управление службами systemd.
 - Получение списка сетевых интерфейсов.
 - Проверка наличия необходимых утилит.
+- Отслеживание изменений файлов через inotify.
+- Отслеживание событий интерфейсов и qdisc (netlink RTNLGRP_LINK/RTNLGRP_TC).
+- Чтение таблицы соединений conntrack и сокетов (NETLINK_SOCK_DIAG) - живые IP клиентов.
 """
 
+import errno
 import os
+import ipaddress
+import socket
+import sys
 import subprocess
 import shlex
 import re
 import time
+import struct
+import ctypes
+import ctypes.util
 
 # Импортируем общие константы и цвета
 try:
     import common
 except ImportError:
     print("Ошибка: Не удалось импортировать common.py.")
-    import sys
     sys.exit(1)
 
 # --- Запуск внешних команд ---
@@ -116,6 +125,252 @@ def run_command(command, check=True, capture_output=True, show_error=True, succe
         return False
 
 
+def run_command_output(command, input_text=None, timeout=None):
+    """
+    Выполняет команду без вывода на экран и возвращает ее результат для разбора вызывающим кодом.
+    Используется в неинтерактивных местах (воркер, tc_manager), где ошибки пишутся в лог.
+
+    Args:
+        command (list): Команда для выполнения.
+        input_text (str, optional): Данные для stdin (например, для 'tc -batch -').
+        timeout (float, optional): Таймаут выполнения в секундах.
+
+    Returns:
+        tuple: (returncode, stdout, stderr). returncode = None, если команду не удалось запустить
+               (не найдена, нет прав, таймаут); в этом случае stderr содержит описание ошибки.
+    """
+    try:
+        result = subprocess.run(command,
+                                input=input_text,
+                                capture_output=True,
+                                text=True,
+                                encoding='utf-8',
+                                errors='ignore',
+                                timeout=timeout)
+        return result.returncode, result.stdout, result.stderr
+    except (FileNotFoundError, PermissionError, subprocess.TimeoutExpired) as e:
+        return None, '', str(e)
+
+
+# --- Таблица соединений (conntrack) ---
+
+CONNTRACK_PROC_FILE = '/proc/net/nf_conntrack'
+CONNTRACK_PROTOCOLS = ('tcp', 'udp')
+
+def parse_conntrack_client_ips(text, ports, protocols=CONNTRACK_PROTOCOLS):
+    """
+    Извлекает IP клиентов из дампа conntrack (формат /proc/net/nf_conntrack или 'conntrack -L').
+    Учитываются TCP в состоянии ESTABLISHED и UDP с ответным трафиком, направленные
+    на один из портов inbound Xray; клиент - src исходного направления.
+
+    Args:
+        text (str): Текст дампа (по записи на строку).
+        ports (iterable): Порты inbound Xray.
+        protocols (iterable): Учитываемые протоколы ('tcp', 'udp').
+
+    Returns:
+        set: IP клиентов в нормализованной записи (ipaddress, IPv6 - сокращенная форма).
+    """
+    ports = {int(port) for port in ports}
+    live_ips = set()
+    for line in text.splitlines():
+        fields = line.split()
+        proto = next((field for field in fields[:3] if field in ('tcp', 'udp')), None)
+        if proto not in protocols or '[UNREPLIED]' in fields:
+            continue
+        if proto == 'tcp' and 'ESTABLISHED' not in fields[:8]:
+            continue
+        src = dport = None
+        for field in fields:
+            key, sep, value = field.partition('=')
+            if key == 'src' and sep and src is None:
+                src = value
+            elif key == 'dport' and sep:
+                dport = value
+                break # Первые src/dport - исходное направление (клиент -> inbound)
+        if src is None or dport is None or not dport.isdigit() or int(dport) not in ports:
+            continue
+        try:
+            live_ips.add(str(ipaddress.ip_address(src)))
+        except ValueError:
+            continue
+    return live_ips
+
+def read_conntrack_client_ips(ports, timeout=10, protocols=CONNTRACK_PROTOCOLS):
+    """
+    Читает таблицу conntrack и возвращает IP клиентов с живыми соединениями к портам inbound.
+    Источник - /proc/net/nf_conntrack, при его отсутствии - утилита conntrack (IPv4 и IPv6).
+    protocols - учитываемые протоколы, как в parse_conntrack_client_ips().
+
+    Returns:
+        set or None: IP клиентов или None, если таблица недоступна (модуль не загружен, нет утилиты).
+    """
+    try:
+        with open(CONNTRACK_PROC_FILE, 'r', encoding='utf-8', errors='ignore') as f:
+            return parse_conntrack_client_ips(f.read(), ports, protocols)
+    except OSError:
+        pass
+    dumps = []
+    for family in ('ipv4', 'ipv6'):
+        returncode, stdout, _ = run_command_output(['conntrack', '-L', '-f', family], timeout=timeout)
+        if returncode == 0:
+            dumps.append(stdout)
+    if not dumps:
+        return None
+    return parse_conntrack_client_ips('\n'.join(dumps), ports, protocols)
+
+
+# --- Сокеты inbound Xray (NETLINK_SOCK_DIAG) ---
+
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+INET_DIAG_REQ_BYTECODE = 1
+INET_DIAG_BC_JMP = 1
+INET_DIAG_BC_S_GE = 2
+INET_DIAG_BC_S_LE = 3
+TCP_ESTABLISHED = 1
+
+_NLMSG_HEADER = struct.Struct('=IHHII')                      # len, type, flags, seq, pid
+_INET_DIAG_REQ_V2 = struct.Struct('=BBBxI4x32sI8x')          # family, protocol, ext, states, sockid(sport, dport, src, dst, if, cookie)
+_INET_DIAG_MSG = struct.Struct('=BBBBHH16s16s')             # family, state, timer, retrans, sport, dport (сетевой порядок), src, dst
+_INET_DIAG_MSG_SIZE = 72
+_BC_OP = struct.Struct('=BBH')                               # code, yes, no
+_SOCK_DIAG_RECV_SIZE = 1 << 20
+
+def build_sport_bytecode(ports):
+    """
+    Байт-код inet_diag: сокет проходит, если его локальный порт входит в ports.
+    Фильтр выполняется в ядре, поэтому в userspace попадают только сокеты inbound.
+
+    Каждый порт - блок (sport >= p, sport <= p, JMP в конец - принять). Ядро проверяет программу
+    по цепочке переходов 'yes', поэтому совпадение идет дальше по порядку, а промах ('no')
+    переходит к следующему блоку; промах в последнем блоке - за конец программы (отклонить).
+    """
+    ports = sorted({int(port) for port in ports})
+    block = 5 * _BC_OP.size
+    total = block * len(ports)
+    code = bytearray()
+    for index, port in enumerate(ports):
+        remaining = total - index * block
+        last = index == len(ports) - 1
+        code += _BC_OP.pack(INET_DIAG_BC_S_GE, 2 * _BC_OP.size, remaining + 4 if last else block)
+        code += _BC_OP.pack(0, 0, port)
+        code += _BC_OP.pack(INET_DIAG_BC_S_LE, 2 * _BC_OP.size,
+                            remaining - 2 * _BC_OP.size + 4 if last else block - 2 * _BC_OP.size)
+        code += _BC_OP.pack(0, 0, port)
+        code += _BC_OP.pack(INET_DIAG_BC_JMP, _BC_OP.size, remaining - 4 * _BC_OP.size)
+    return bytes(code)
+
+def parse_inet_diag_messages(data):
+    """
+    Разбирает ответ дампа sock_diag.
+
+    Returns:
+        tuple: (список (family, локальный порт, порт собеседника, IP собеседника в байтах),
+                True если встречен NLMSG_DONE).
+
+    Raises:
+        OSError: Если ядро вернуло NLMSG_ERROR.
+    """
+    sockets = []
+    offset = 0
+    while offset + _NLMSG_HEADER.size <= len(data):
+        msg_len, msg_type, _, _, _ = _NLMSG_HEADER.unpack_from(data, offset)
+        if msg_len < _NLMSG_HEADER.size:
+            break
+        payload = offset + _NLMSG_HEADER.size
+        if msg_type == NLMSG_DONE:
+            return sockets, True
+        if msg_type == NLMSG_ERROR:
+            error = -struct.unpack_from('=i', data, payload)[0]
+            raise OSError(error, f"sock_diag: {os.strerror(error)}")
+        if msg_type == SOCK_DIAG_BY_FAMILY and msg_len >= _NLMSG_HEADER.size + _INET_DIAG_MSG_SIZE:
+            family, _, _, _, sport, dport, _, dst = _INET_DIAG_MSG.unpack_from(data, payload)
+            sockets.append((family, socket.ntohs(sport), socket.ntohs(dport),
+                            dst[:4] if family == socket.AF_INET else dst))
+        offset += (msg_len + 3) & ~3
+    return sockets, False
+
+def _peer_ip(family, raw_address):
+    address = ipaddress.ip_address(raw_address)
+    if family == socket.AF_INET6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped # v4-клиент на dual-stack сокете
+    return str(address)
+
+def _dump_inbound_sockets(ports, protocols):
+    """
+    Дамп установленных сокетов с локальным портом из ports: один netlink-сокет,
+    по одному дампу на семейство/протокол; отбор по порту и состоянию - в ядре.
+    Возвращает пачки из parse_inet_diag_messages().
+
+    Raises:
+        OSError: Если sock_diag недоступен.
+    """
+    bytecode = build_sport_bytecode(ports)
+    attribute = struct.pack('=HH', 4 + len(bytecode), INET_DIAG_REQ_BYTECODE) + bytecode
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_SOCK_DIAG) as sock:
+        sock.settimeout(5)
+        sequence = 0
+        for family in (socket.AF_INET, socket.AF_INET6):
+            for protocol in protocols:
+                sequence += 1
+                request = _INET_DIAG_REQ_V2.pack(family, protocol, 0, 1 << TCP_ESTABLISHED, b'', 0) + attribute
+                header = _NLMSG_HEADER.pack(_NLMSG_HEADER.size + len(request), SOCK_DIAG_BY_FAMILY,
+                                            NLM_F_REQUEST | NLM_F_DUMP, sequence, 0)
+                sock.send(header + request)
+                done = False
+                while not done:
+                    sockets, done = parse_inet_diag_messages(sock.recv(_SOCK_DIAG_RECV_SIZE))
+                    yield sockets
+
+def read_socket_peer_ips(ports, protocols=(socket.IPPROTO_TCP, socket.IPPROTO_UDP)):
+    """
+    IP собеседников установленных сокетов с локальным портом из ports (соединения клиентов с inbound Xray).
+    UDP inbound Xray (QUIC, mKCP, Hysteria, WireGuard, UDP Shadowsocks) принимает клиентов одним
+    неподключенным сокетом без собеседника, поэтому такие клиенты в дамп не попадают.
+
+    Returns:
+        set or None: IP клиентов или None, если sock_diag недоступен.
+    """
+    if not ports:
+        return set()
+    raw_peers = set() # (family, адрес в байтах) - преобразование в строку один раз на уникальный IP
+    try:
+        for sockets in _dump_inbound_sockets(ports, protocols):
+            raw_peers.update((family, raw_address) for family, _, _, raw_address in sockets)
+    except OSError:
+        return None
+    return {_peer_ip(family, raw_address) for family, raw_address in raw_peers}
+
+def read_socket_peer_endpoints(ports, protocols=(socket.IPPROTO_TCP, socket.IPPROTO_UDP)):
+    """
+    Адреса собеседников (IP, порт) установленных сокетов inbound - отдельные соединения клиентов,
+    в т.ч. нескольких клиентов за одним IP (CGNAT).
+
+    Returns:
+        set or None: {(ip, порт)} или None, если sock_diag недоступен.
+    """
+    if not ports:
+        return set()
+    ip_strings = {} # (family, адрес в байтах) -> строка IP
+    endpoints = set()
+    try:
+        for sockets in _dump_inbound_sockets(ports, protocols):
+            for family, _, peer_port, raw_address in sockets:
+                key = (family, raw_address)
+                ip = ip_strings.get(key)
+                if ip is None:
+                    ip = ip_strings[key] = _peer_ip(family, raw_address)
+                endpoints.add((ip, peer_port))
+    except OSError:
+        return None
+    return endpoints
+
+
 # --- Управление службами systemd ---
 
 def manage_service(action, service_name, check_status=True, quiet=False):
@@ -330,4 +585,244 @@ def check_required_utils(utils_to_check=['tc', 'systemctl', 'python3', 'ip']): #
         print(f"\n{common.Color.YELLOW}Установите отсутствующие пакеты и повторите запуск.{common.Color.RESET}")
         return False
     else:
-        return True
\ No newline at end of file
+        return True
+
+# --- Отслеживание изменений файлов (inotify) ---
+
+class InotifyWatcher:
+    """
+    Минимальная обертка над inotify (через ctypes, без внешних зависимостей).
+    Следит за директорией и возвращает имена измененных в ней файлов.
+    Объект можно передавать в select() - у него есть fileno().
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE = 0x00000200
+    # Запись "через временный файл + os.replace" дает IN_MOVED_TO, прямая запись - IN_CLOSE_WRITE
+    DEFAULT_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE
+
+    _EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+
+    def __init__(self, directory, mask=DEFAULT_MASK):
+        """
+        Args:
+            directory (str): Директория для наблюдения.
+            mask (int): Маска событий inotify.
+
+        Raises:
+            OSError: Если inotify недоступен или директорию нельзя отслеживать.
+        """
+        libc_name = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError("inotify не поддерживается в этой системе")
+        self.directory = directory
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            errno_value = ctypes.get_errno()
+            raise OSError(errno_value, f"inotify_init1: {os.strerror(errno_value)}")
+        if libc.inotify_add_watch(self._fd, os.fsencode(directory), ctypes.c_uint32(mask)) < 0:
+            errno_value = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno_value, f"inotify_add_watch({directory}): {os.strerror(errno_value)}")
+
+    def fileno(self):
+        return self._fd
+
+    def read_changed_names(self):
+        """
+        Вычитывает все накопившиеся события без блокировки.
+
+        Returns:
+            set: Имена файлов (без пути), для которых пришли события.
+        """
+        names = set()
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            offset = 0
+            while offset + self._EVENT_HEADER.size <= len(data):
+                _, _, _, name_len = self._EVENT_HEADER.unpack_from(data, offset)
+                offset += self._EVENT_HEADER.size
+                name = data[offset:offset + name_len].rstrip(b'\0')
+                offset += name_len
+                if name:
+                    names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+# --- События интерфейсов и qdisc (netlink, NETLINK_ROUTE) ---
+
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1 # RTNLGRP_LINK
+RTMGRP_TC = 0x8   # RTNLGRP_TC
+RTM_NEWLINK = 16
+RTM_DELQDISC = 37
+IFLA_IFNAME = 3
+TC_H_ROOT = 0xFFFFFFFF
+TC_H_INGRESS = 0xFFFFFFF1
+
+_IFINFOMSG = struct.Struct('=BxHiII')  # family, type, index, flags, change
+_TCMSG = struct.Struct('=BxxxiIII')     # family, ifindex, handle, parent, info
+_RTATTR = struct.Struct('=HH')          # len, type
+
+SO_ATTACH_FILTER = 26
+_SOCK_FILTER = struct.Struct('=HBBI')   # code, jt, jf, k
+_BPF_LD_H_ABS = 0x28
+_BPF_LD_W_ABS = 0x20
+_BPF_JEQ_K = 0x15
+_BPF_RET_K = 0x06
+_NLMSG_TYPE_OFFSET = 4
+_TCMSG_PARENT_OFFSET = 16 + 12 # nlmsghdr + family/pad, ifindex, handle
+
+def _bpf_value(value, size):
+    """Константа для сравнения в BPF: загрузки BPF_ABS читают сетевой порядок, а netlink - порядок хоста."""
+    return int.from_bytes(value.to_bytes(size, sys.byteorder), 'big')
+
+def link_events_filter():
+    """
+    Программа classic BPF для сокета LinkWatcher: ядро пропускает только RTM_NEWLINK и RTM_DELQDISC
+    корневого/ingress qdisc. Изменения фильтров и классов (в т.ч. собственные пакеты tc демона)
+    отбрасываются до очереди сокета - не будят цикл и не переполняют буфер.
+
+    Returns:
+        bytes: Массив struct sock_filter.
+    """
+    program = [
+        (_BPF_LD_H_ABS, 0, 0, _NLMSG_TYPE_OFFSET),
+        (_BPF_JEQ_K, 4, 0, _bpf_value(RTM_NEWLINK, 2)),
+        (_BPF_JEQ_K, 0, 4, _bpf_value(RTM_DELQDISC, 2)),
+        (_BPF_LD_W_ABS, 0, 0, _TCMSG_PARENT_OFFSET),
+        (_BPF_JEQ_K, 1, 0, _bpf_value(TC_H_ROOT, 4)),
+        (_BPF_JEQ_K, 0, 1, _bpf_value(TC_H_INGRESS, 4)),
+        (_BPF_RET_K, 0, 0, 0xFFFFFFFF), # принять сообщение целиком
+        (_BPF_RET_K, 0, 0, 0),          # отбросить
+    ]
+    return b''.join(_SOCK_FILTER.pack(*instruction) for instruction in program)
+
+def _link_name(data, offset, end):
+    """Имя интерфейса из атрибутов RTM_NEWLINK (IFLA_IFNAME) или None."""
+    while offset + _RTATTR.size <= end:
+        attr_len, attr_type = _RTATTR.unpack_from(data, offset)
+        if attr_len < _RTATTR.size:
+            break
+        if attr_type == IFLA_IFNAME:
+            return data[offset + _RTATTR.size:offset + attr_len].split(b'\0', 1)[0].decode(errors='replace')
+        offset += (attr_len + 3) & ~3
+    return None
+
+def parse_link_events(data):
+    """
+    Разбирает сообщения rtnetlink: имена интерфейсов, которые появились/изменились (RTM_NEWLINK)
+    или потеряли корневой/ingress qdisc (RTM_DELQDISC). Остальные сообщения (фильтры, классы) пропускаются.
+
+    Returns:
+        set: Имена интерфейсов (для RTM_DELQDISC уже удаленного интерфейса имя не определяется).
+    """
+    names = set()
+    offset = 0
+    while offset + _NLMSG_HEADER.size <= len(data):
+        msg_len, msg_type, _, _, _ = _NLMSG_HEADER.unpack_from(data, offset)
+        if msg_len < _NLMSG_HEADER.size:
+            break
+        payload = offset + _NLMSG_HEADER.size
+        end = min(offset + msg_len, len(data))
+        if msg_type == RTM_NEWLINK and payload + _IFINFOMSG.size <= end:
+            name = _link_name(data, payload + _IFINFOMSG.size, end)
+            if name:
+                names.add(name)
+        elif msg_type == RTM_DELQDISC and payload + _TCMSG.size <= end:
+            _, ifindex, _, parent, _ = _TCMSG.unpack_from(data, payload)
+            if parent in (TC_H_ROOT, TC_H_INGRESS):
+                try:
+                    names.add(socket.if_indextoname(ifindex))
+                except OSError:
+                    pass
+        offset += (msg_len + 3) & ~3
+    return names
+
+class LinkWatcher:
+    """
+    Подписка на события rtnetlink интерфейсов (RTNLGRP_LINK) и qdisc (RTNLGRP_TC).
+    Объект можно передавать в select() - у него есть fileno().
+    """
+    RECV_BUFFER_SIZE = 1 << 20 # Запас на случай, если BPF-фильтр не подключился и приходят события фильтров tc
+
+    def __init__(self):
+        """
+        Raises:
+            OSError: Если netlink-сокет недоступен.
+        """
+        self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC,
+                                   NETLINK_ROUTE)
+        try:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECV_BUFFER_SIZE)
+            self._attach_filter()
+            self._sock.bind((0, RTMGRP_LINK | RTMGRP_TC))
+        except OSError:
+            self._sock.close()
+            raise
+
+    def _attach_filter(self):
+        """
+        Подключает link_events_filter(). Без фильтра (ядро без CONFIG_BPF) события фильтров tc
+        по-прежнему отсеиваются в parse_link_events(), но будят сокет.
+
+        Returns:
+            bool: True, если фильтр подключен.
+        """
+        program = link_events_filter()
+        buffer = ctypes.create_string_buffer(program) # Ядро копирует программу при подключении
+        fprog = struct.pack('HL', len(program) // _SOCK_FILTER.size, ctypes.addressof(buffer))
+        try:
+            self._sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+            return True
+        except OSError:
+            return False
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def read_changed_links(self):
+        """
+        Вычитывает все накопившиеся события без блокировки.
+
+        Returns:
+            set or None: Имена интерфейсов с событиями; None - буфер сокета переполнился
+                         (часть событий потеряна, проверить нужно все интерфейсы).
+        """
+        names = set()
+        overflow = False
+        while True:
+            try:
+                data = self._sock.recv(_SOCK_DIAG_RECV_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                overflow = True
+                continue
+            if not data:
+                break
+            names |= parse_link_events(data)
+        return None if overflow else names
+
+    def close(self):
+        self._sock.close()
+
+def link_exists(name):
+    """True, если интерфейс с таким именем существует."""
+    try:
+        socket.if_nametoindex(name)
+        return True
+    except OSError:
+        return False
@@ -2,22 +2,77 @@
 Модуль для управления правилами Traffic Control (tc) для шейпинга.
 - Сопоставление лимита скорости с классом HTB.
 - Очистка динамических правил tc.
-- Применение правил tc (HTB для upload, police для download).
+- Применение правил tc (HTB для upload, police для download), пачкой через 'tc -batch'.
+  IPv4 - u32 с постоянными handle, IPv6 - flower (свой приоритет TC_PRIO_V6).
+- Жизненный цикл правил: удержание после ухода пользователя и снятие простаивающих правил.
+- Правила по соединению (IP + порт клиента) для IP, общих для нескольких пользователей (CGNAT).
+- Агрегация IP пользователя в минимальный набор CIDR-префиксов (меньше фильтров).
+- Классификация по метке сокета Xray: статические fw-фильтры по уровням скорости (без поиска IP).
+- Несколько интерфейсов: одни и те же правила применяются на каждом параллельно (run_on_interfaces).
+- Базовая структура (HTB, классы уровней, ingress) описана данными и приводится к нужному виду
+  по разнице с текущим деревом (reconcile_base_tree), без удаления правил пользователей.
 """
 
+import concurrent.futures
+import ipaddress
+import logging
 import re
+import socket
+import time
 
 # Импортируем необходимые модули
 try:
     import common
     import system_utils # Для выполнения команд tc
+    import log_utils
 except ImportError as e:
     print(f"Критическая ошибка: Не удалось импортировать модуль: {e}")
     import sys
     sys.exit(1)
 
-# --- Вспомогательная функция для логирования (если нужна специфичная для TC) ---
-# Пока можно использовать print или добавить логирование в system_utils.run_command
+# --- Логирование TC ---
+_logger = log_utils.get_logger('tc')
+
+def _run_tc(args, failure_msg, quiet_errors=()):
+    """
+    Выполняет команду tc без вывода на экран; ошибки пишутся в лог с текстом stderr.
+
+    Args:
+        args (list): Команда tc целиком.
+        failure_msg (str): Сообщение для лога при ошибке.
+        quiet_errors (tuple): Подстроки stderr, которые считаются ожидаемыми (пишутся только в debug).
+
+    Returns:
+        bool: True при успехе (код 0).
+    """
+    returncode, _, stderr = system_utils.run_command_output(args)
+    if returncode == 0:
+        return True
+    stderr = (stderr or '').strip()
+    if any(marker in stderr for marker in quiet_errors):
+        _logger.debug("%s (код %s): %s", failure_msg, returncode, stderr)
+    else:
+        _logger.warning("%s (код %s): %s", failure_msg, returncode, stderr)
+    return False
+
+# Ожидаемые ошибки tc при удалении отсутствующих фильтров
+_NOT_FOUND_ERRORS = ("No such file or directory", "Cannot find specified filter chain",
+                     "Filter with specified priority/protocol not found", "Specified filter handle not found")
+# Повторное создание таблицы u32 ("Filter already exists") и фильтра-ссылки с тем же handle (ENOSPC)
+_EXISTS_ERRORS = ("Filter already exists", "File exists", "No space left on device")
+
+# --- Жизненный цикл правил (значения по умолчанию для config.json) ---
+DEFAULT_RULE_GRACE_SEC = 120     # 'tc_rule_grace_sec': сколько держать правило после ухода пользователя из онлайн
+DEFAULT_IDLE_RECLAIM_CYCLES = 0  # 'tc_idle_reclaim_cycles': циклов без трафика до снятия правила (0 - не снимать)
+DEFAULT_IDLE_RECHECK_SEC = 600   # 'tc_idle_recheck_sec': через сколько снятое правило ставится снова для проверки
+
+# Смещения IP-адресов в заголовке IPv4 для 'match ip src/dst' в выводе u32
+_U32_OFFSET_SRC = 12
+_U32_OFFSET_DST = 16
+# Handle правила в наших таблицах u32 ('fh 500:2a:1', 'fh 501::3'), без самих таблиц ('fh 500:') и ссылок
+_U32_RULE_HANDLE_RE = re.compile(rf"fh (?:{common.TC_U32_HTID}:[0-9a-f]+|{common.TC_U32_PREFIX_HTID}:):[0-9a-f]+\b")
+_U32_MATCH_RE = re.compile(r"match ([0-9a-f]{8})/([0-9a-f]{8}) at (\d+)")
+_SENT_BYTES_RE = re.compile(r"Sent (\d+) bytes")
 
 # --- Функции управления TC ---
 
@@ -40,11 +95,11 @@ def map_limit_to_classid(limit_mbps):
     """
     predefined_classes = common.PREDEFINED_LIMIT_CLASSES
     if not predefined_classes:
-        print(f"{common.Color.YELLOW}[TC WARN] Словарь PREDEFINED_LIMIT_CLASSES пуст в common.py. Невозможно сопоставить лимит классу HTB.{common.Color.RESET}")
+        _logger.warning("Словарь PREDEFINED_LIMIT_CLASSES пуст в common.py. Невозможно сопоставить лимит классу HTB.")
         return None
 
     if limit_mbps <= 0:
-         print(f"{common.Color.YELLOW}[TC WARN] Запрошен некорректный лимит ({limit_mbps} Мбит/с) для сопоставления с классом HTB.{common.Color.RESET}")
+         _logger.warning("Запрошен некорректный лимит (%s Мбит/с) для сопоставления с классом HTB.", limit_mbps)
          # Можно вернуть самый медленный класс или None. Вернем None.
          return None
 
@@ -62,7 +117,8 @@ def map_limit_to_classid(limit_mbps):
     elif predefined_classes:
         # Если подходящих нет, берем самый быстрый из доступных
         best_class_id = max(predefined_classes, key=predefined_classes.get)
-        print(f"{common.Color.DIM}[TC DEBUG] Лимит {limit_mbps} Мбит/с выше определенных классов. Используется максимальный: 1:{best_class_id} ({predefined_classes[best_class_id]} Мбит/с){common.Color.RESET}")
+        _logger.debug("Лимит %s Мбит/с выше определенных классов. Используется максимальный: 1:%s (%s Мбит/с)",
+                      limit_mbps, best_class_id, predefined_classes[best_class_id])
     # else: # predefined_classes пуст - уже обработано в начале
 
     return f"1:{best_class_id}" if best_class_id is not None else None
@@ -79,115 +135,1116 @@ def clear_dynamic_tc_rules(iface):
         bool: True, если обе команды удаления выполнены (даже если правил не было),
               False, если выполнение команды tc завершилось ошибкой (кроме "не найдено").
     """
-    print(f"{common.Color.CYAN}[TC] Очистка старых динамических правил для {iface} (приоритет {common.TC_PRIO})...{common.Color.RESET}")
+    _logger.debug("Очистка старых динамических правил для %s (приоритеты %s, %s)...", iface, common.TC_PRIO, common.TC_PRIO_V6)
     success = True
 
     # Удаляем все фильтры с нашим приоритетом для egress (parent 1:0)
     # fail_ok=True не используется в system_utils.run_command, поэтому check=False
     # Мы проверяем результат сами. Ошибки "RTNETLINK answers: No such file or directory" (если правил нет) игнорируем.
-    cmd_egress = ['tc', 'filter', 'del', 'dev', iface, 'parent', '1:0', 'prio', common.TC_PRIO]
-    # Запускаем команду, не прерываясь при ошибке, но показывая ее
-    if not system_utils.run_command(cmd_egress, check=False, capture_output=True, show_error=True, failure_msg=None):
-        # Проверим stderr на ожидаемую ошибку "No such file or directory"
-        # Для этого нужно было бы захватить stderr в run_command и вернуть его.
-        # Пока упростим: считаем любую ошибку здесь не фатальной, если это не PermissionError и т.п.
-        # В production можно добавить более тонкую обработку.
-        print(f"{common.Color.DIM}[TC DEBUG] Команда удаления egress фильтров завершилась с ошибкой (возможно, правил не было).{common.Color.RESET}")
-        # success = False # Решаем, считать ли это провалом операции очистки
+    cmd_egress = [common.TC_PATH, 'filter', 'del', 'dev', iface, 'parent', '1:0', 'prio', common.TC_PRIO]
+    # Ошибка "No such file or directory" означает, что правил не было - это не провал очистки
+    _run_tc(cmd_egress, "Команда удаления egress фильтров завершилась с ошибкой", quiet_errors=_NOT_FOUND_ERRORS)
 
     # Удаляем все фильтры с нашим приоритетом для ingress (parent ffff:)
-    cmd_ingress = ['tc', 'filter', 'del', 'dev', iface, 'parent', 'ffff:', 'prio', common.TC_PRIO]
-    if not system_utils.run_command(cmd_ingress, check=False, capture_output=True, show_error=True, failure_msg=None):
-        print(f"{common.Color.DIM}[TC DEBUG] Команда удаления ingress фильтров завершилась с ошибкой (возможно, правил не было).{common.Color.RESET}")
-        # success = False
+    cmd_ingress = [common.TC_PATH, 'filter', 'del', 'dev', iface, 'parent', 'ffff:', 'prio', common.TC_PRIO]
+    _run_tc(cmd_ingress, "Команда удаления ingress фильтров завершилась с ошибкой", quiet_errors=_NOT_FOUND_ERRORS)
+
+    # IPv6-правила (flower) - отдельный приоритет
+    for parent in ('1:0', 'ffff:'):
+        _run_tc([common.TC_PATH, 'filter', 'del', 'dev', iface, 'parent', parent, 'prio', common.TC_PRIO_V6],
+                "Команда удаления IPv6 фильтров завершилась с ошибкой", quiet_errors=_NOT_FOUND_ERRORS)
+
+    clear_connection_rules(iface) # Правила по соединению дополняют правила по IP и без них не нужны
 
     # print(f"{common.Color.CYAN}[TC] Очистка завершена.{common.Color.RESET}") # Сообщение больше для отладки
     return success # Возвращаем общий успех операции
 
-def apply_tc_rules(iface, user_ips_with_limits):
+# --- Агрегация IP в префиксы ---
+# Политика (config.json): 'ip_aggregation' - 'off' | 'exact' (только без потерь: соседние адреса,
+# полностью покрывающие префикс) | 'prefix' (адреса одной сети /ipv4_prefix или /ipv6_prefix
+# объединяются в нее, если их не меньше min_ips). Сеть не расширяется, если в ней есть IP
+# пользователя с другим лимитом, а адрес, общий для разных лимитов, всегда остается отдельным -
+# агрегация никогда не объединяет разные лимиты.
+AGGREGATION_OFF = 'off'
+AGGREGATION_EXACT = 'exact'
+AGGREGATION_PREFIX = 'prefix'
+DEFAULT_AGGREGATION_IPV4_PREFIX = 24
+DEFAULT_AGGREGATION_IPV6_PREFIX = 64
+DEFAULT_AGGREGATION_MIN_IPS = 2
+
+def _parse_ip_int(ip):
+    """(версия, адрес числом) или None для некорректной строки (inet_pton быстрее объектов ipaddress)."""
+    for version, family in ((4, socket.AF_INET), (6, socket.AF_INET6)):
+        try:
+            return version, int.from_bytes(socket.inet_pton(family, ip), 'big')
+        except (OSError, ValueError):
+            continue
+    return None
+
+def _format_prefix(version, start, prefix_len):
+    """Ключ плана: одиночный адрес без длины префикса, сеть - 'адрес/длина'."""
+    if version == 4:
+        address = socket.inet_ntoa(start.to_bytes(4, 'big'))
+    else:
+        address = str(ipaddress.IPv6Address(start))
+    return address if prefix_len == (32 if version == 4 else 128) else f"{address}/{prefix_len}"
+
+def _ranges_to_prefixes(version, ranges):
+    """Минимальный набор CIDR без потерь для диапазонов адресов [(начало, конец), ...]."""
+    bits = 32 if version == 4 else 128
+    prefixes = []
+    merged_start = merged_end = None
+    for start, end in sorted(ranges) + [(None, None)]:
+        if start is not None and merged_end is not None and start <= merged_end + 1:
+            merged_end = max(merged_end, end)
+            continue
+        current = merged_start
+        while current is not None and current <= merged_end:
+            # Наибольший выровненный блок с началом current, не выходящий за merged_end
+            size = (current & -current) if current else 1 << bits
+            while current + size - 1 > merged_end:
+                size >>= 1
+            prefixes.append(_format_prefix(version, current, bits - size.bit_length() + 1))
+            current += size
+        merged_start, merged_end = start, end
+    return prefixes
+
+def aggregate_ip_prefixes(user_ips, user_limits, mode=AGGREGATION_PREFIX, ipv4_prefix=DEFAULT_AGGREGATION_IPV4_PREFIX,
+                          ipv6_prefix=DEFAULT_AGGREGATION_IPV6_PREFIX, min_ips=DEFAULT_AGGREGATION_MIN_IPS):
     """
-    Применяет правила tc (htb для upload, police для download) для IP-адресов пользователей.
-    Сначала очищает старые правила с тем же приоритетом.
+    Сворачивает IP каждого пользователя в минимальный набор CIDR-префиксов (чистая функция).
+    Работает на целых числах (адреса и диапазоны), без объектов ipaddress на каждый IP.
 
     Args:
-        iface (str): Сетевой интерфейс.
+        user_ips (dict): { email: [ip, ...] }.
+        user_limits (dict): { email: limit_mbps } (для запрета объединения сетей с разными лимитами).
+        mode (str): AGGREGATION_EXACT или AGGREGATION_PREFIX (AGGREGATION_OFF - без изменений).
+        ipv4_prefix (int): Длина префикса расширения для IPv4 (режим 'prefix').
+        ipv6_prefix (int): Длина префикса расширения для IPv6 (режим 'prefix').
+        min_ips (int): Минимум адресов пользователя в сети для расширения до нее.
+
+    Returns:
+        dict: { email: [адрес или 'сеть/длина', ...] }. Некорректные адреса остаются как есть.
+    """
+    if mode not in (AGGREGATION_EXACT, AGGREGATION_PREFIX):
+        return {email: list(ips) for email, ips in user_ips.items()}
+    shifts = {4: 32 - ipv4_prefix, 6: 128 - ipv6_prefix} # Широкая сеть адреса - (версия, адрес >> сдвиг)
+    widen = mode == AGGREGATION_PREFIX
+
+    parsed = {}          # email -> {(версия, адрес числом)}
+    invalid = {}         # email -> [некорректная строка]
+    network_limits = {}  # (версия, номер сети) -> {лимиты пользователей с IP в ней}
+    address_limits = {}  # (версия, адрес числом) -> {лимиты пользователей адреса}
+    for email, ips in user_ips.items():
+        addresses = set()
+        for ip in ips:
+            parsed_ip = _parse_ip_int(ip)
+            if parsed_ip is None:
+                invalid.setdefault(email, []).append(ip)
+            else:
+                addresses.add(parsed_ip)
+        parsed[email] = addresses
+        limit = user_limits.get(email)
+        for version, number in addresses:
+            address_limits.setdefault((version, number), set()).add(limit)
+            if widen:
+                network_limits.setdefault((version, number >> shifts[version]), set()).add(limit)
+    # Адрес пользователей с разными лимитами остается отдельным правилом (конфликт решает воркер)
+    shared = {address for address, limits in address_limits.items() if len(limits) > 1}
+
+    result = {}
+    for email, addresses in parsed.items():
+        ranges = {4: [], 6: []}
+        singles = [_format_prefix(version, number, 32 if version == 4 else 128)
+                   for version, number in sorted(addresses & shared)]
+        addresses = addresses - shared
+        if widen:
+            groups = {} # (версия, номер сети) -> адреса пользователя в ней
+            for version, number in addresses:
+                groups.setdefault((version, number >> shifts[version]), []).append(number)
+            allowed = {user_limits.get(email)}
+            for (version, network), members in groups.items():
+                if len(members) >= min_ips and network_limits[(version, network)] == allowed:
+                    shift = shifts[version]
+                    ranges[version].append((network << shift, ((network + 1) << shift) - 1))
+                else:
+                    ranges[version].extend((number, number) for number in members)
+        else:
+            for version, number in addresses:
+                ranges[version].append((number, number))
+        result[email] = (_ranges_to_prefixes(4, ranges[4]) + _ranges_to_prefixes(6, ranges[6])
+                         + singles + invalid.get(email, []))
+    return result
+
+class HandleAllocator:
+    """
+    Постоянное соответствие IP -> handle фильтра: адрес IPv4 - узел в корзине его последнего октета
+    ('<TC_U32_HTID>:<корзина>:<узел>'), префикс IPv4 - узел таблицы префиксов ('<TC_U32_PREFIX_HTID>::<узел>'),
+    IPv6 - handle flower. У каждой корзины и таблицы свой счетчик и список свободных узлов;
+    освобожденные узлы выдаются повторно, поэтому IP сохраняет свой handle, пока его правило установлено.
+    IP, которым handle не хватило при последнем применении, собираются в overflow.
+    Состояние сериализуется через to_dict()/load() (хранится воркером между запусками).
+    """
+
+    def __init__(self, max_node=None, max_flower_handle=None):
+        self.max_node = max_node or common.TC_U32_MAX_NODE
+        self.max_flower_handle = max_flower_handle or common.TC_FLOWER_MAX_HANDLE
+        self.handles = {}  # { ip: handle }
+        self.pools = {}    # { таблица: {'free': [узел, ...], 'next': следующий никогда не выдававшийся узел} }
+        self.overflow = set() # IP без handle при последнем применении
+
+    @staticmethod
+    def layout():
+        """Схема таблиц, к которой относятся handle (состояние другой схемы не восстанавливается)."""
+        return f"{common.TC_U32_HTID}/{common.TC_U32_DIVISOR}+{common.TC_U32_PREFIX_HTID}"
+
+    def to_dict(self):
+        return {'layout': self.layout(), 'handles': self.handles, 'pools': self.pools}
+
+    def load(self, data):
+        """
+        Восстанавливает состояние из to_dict(). Возвращает True, если данные корректны
+        и относятся к текущей схеме таблиц u32 (состояние прежних версий не восстанавливается).
+        """
+        data = data or {}
+        handles, pools = data.get('handles'), data.get('pools')
+        if not isinstance(handles, dict) or not isinstance(pools, dict) or data.get('layout') != self.layout():
+            return False
+        if not all(isinstance(pool, dict) and isinstance(pool.get('free'), list) and isinstance(pool.get('next'), int)
+                   for pool in pools.values()):
+            return False
+        self.handles = dict(handles)
+        self.pools = {table: {'free': list(pool['free']), 'next': pool['next']} for table, pool in pools.items()}
+        self.overflow = set()
+        return True
+
+    def reset(self):
+        self.handles, self.pools, self.overflow = {}, {}, set()
+
+    @staticmethod
+    def table_for(ip):
+        """Таблица (пул узлов) правила IP: 'v6', '<TC_U32_PREFIX_HTID>:' или '<TC_U32_HTID>:<корзина>'."""
+        if _is_ipv6(ip):
+            return 'v6'
+        address, _, length = ip.partition('/')
+        if length and length != '32':
+            return f"{common.TC_U32_PREFIX_HTID}:"
+        last_octet = int(address.rsplit('.', 1)[-1])
+        return f"{common.TC_U32_HTID}:{last_octet % common.TC_U32_DIVISOR:x}"
+
+    def allocate(self, ip):
+        """Возвращает handle для IP (существующий или новый). None - узлы таблицы IP заняты (IP попадает в overflow)."""
+        handle = self.handles.get(ip)
+        if handle is not None:
+            return handle
+        table = self.table_for(ip)
+        pool = self.pools.setdefault(table, {'free': [], 'next': 1})
+        if pool['free']:
+            node = pool['free'].pop()
+        elif pool['next'] <= (self.max_flower_handle if table == 'v6' else self.max_node):
+            node = pool['next']
+            pool['next'] += 1
+        else:
+            self.overflow.add(ip)
+            return None
+        handle = str(node) if table == 'v6' else f"{table}:{node:x}"
+        self.handles[ip] = handle
+        return handle
+
+    def release(self, ip):
+        """Освобождает узел IP для повторного использования."""
+        handle = self.handles.pop(ip, None)
+        if handle is not None:
+            table = self.table_for(ip)
+            node = int(handle) if table == 'v6' else int(handle.rsplit(':', 1)[1], 16)
+            self.pools.setdefault(table, {'free': [], 'next': node + 1})['free'].append(node)
+
+
+def _u32_table(handle):
+    """Аргумент 'ht' для правила с handle u32: '500:2a:1' -> '500:2a:', '501::1' -> '501:'."""
+    table, _, _ = handle.rpartition(':')
+    return f"{table}:" if not table.endswith(':') else table
+
+def _u32_table_commands(iface):
+    """
+    Команды tc (без пути к tc) создания таблиц u32 правил по IP и фильтров-ссылок на них из корневой
+    таблицы приоритета (egress и ingress). Ссылка на хэш-таблицу адресов выбирает корзину по последнему
+    октету адреса клиента (src на egress, dst на ingress); если в корзине правила нет, ядро возвращается
+    в корневую таблицу и переходит по второй ссылке - в таблицу префиксов.
+    Повторное выполнение завершается ошибками _EXISTS_ERRORS.
+    """
+    commands = []
+    for parent, offset in (('1:0', _U32_OFFSET_SRC), ('ffff:', _U32_OFFSET_DST)):
+        prefix = ['filter', 'add', 'dev', iface, 'protocol', 'ip', 'parent', parent, 'prio', common.TC_PRIO]
+        commands.append(prefix + ['handle', f'{common.TC_U32_HTID}:', 'u32', 'divisor', str(common.TC_U32_DIVISOR)])
+        commands.append(prefix + ['handle', f'{common.TC_U32_PREFIX_HTID}:', 'u32', 'divisor', '1'])
+        # Handle '::1', '::2' - узлы корневой таблицы, какой бы ее ни выдало ядро: ссылки не дублируются
+        commands.append(prefix + ['handle', '::1', 'u32', 'match', 'u32', '0', '0', 'link', f'{common.TC_U32_HTID}:',
+                                  'hashkey', 'mask', f'0x{common.TC_U32_DIVISOR - 1:08x}', 'at', str(offset)])
+        commands.append(prefix + ['handle', '::2', 'u32', 'match', 'u32', '0', '0', 'link', f'{common.TC_U32_PREFIX_HTID}:'])
+    return commands
+
+def ensure_u32_tables(iface):
+    """Создает таблицы u32 правил по IP, если их нет. Возвращает True, если таблицы на месте."""
+    failed, expected_only = _run_tc_batch(_u32_table_commands(iface), f"Не удалось создать таблицы u32 на {iface}",
+                                          quiet_errors=_EXISTS_ERRORS)
+    return not failed or expected_only
+
+def normalize_ips(ip_list, ipv6_prefix=128):
+    """
+    Проверяет и нормализует IP клиентов (модуль ipaddress): некорректные отбрасываются,
+    IPv6 записываются в сокращенной форме, дубликаты (в т.ч. разные записи одного адреса) удаляются.
+
+    Args:
+        ip_list (iterable): Строки IP.
+        ipv6_prefix (int): Длина префикса для IPv6 (<128 - адрес заменяется своей сетью,
+                           напр. /64: адреса приватности одного клиента меняются внутри /64).
+
+    Returns:
+        list: Отсортированные уникальные адреса и сети ('адрес/длина').
+    """
+    normalized = set()
+    for ip in ip_list:
+        try:
+            address = ipaddress.ip_address(ip.strip() if isinstance(ip, str) else ip)
+        except ValueError:
+            _logger.debug("Пропуск некорректного IP '%s'.", ip)
+            continue
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        if address.version == 6 and ipv6_prefix < 128:
+            normalized.add(str(ipaddress.IPv6Network((address, ipv6_prefix), strict=False)))
+        else:
+            normalized.add(str(address))
+    return sorted(normalized)
+
+def _is_ipv6(ip_address):
+    return ':' in ip_address
+
+def _is_valid_rule(ip_address, limit_mbps):
+    """Проверка записи плана перед установкой правила."""
+    if not ip_address or not isinstance(limit_mbps, (int, float)) or limit_mbps <= 0:
+        _logger.warning("Пропуск некорректной записи: IP='%s', Лимит='%s'.", ip_address, limit_mbps)
+        return False
+    # Валидация IPv4/IPv6 адреса или префикса (после агрегации)
+    try:
+        ipaddress.ip_network(ip_address)
+    except ValueError:
+        _logger.warning("Пропуск невалидного IP адреса: '%s'.", ip_address)
+        return False
+    return True
+
+def _match_prefix(ip_address):
+    """Аргумент 'match ip src/dst' ('ip6' для IPv6): адрес как /32 (/128), префикс - как есть."""
+    if '/' in ip_address:
+        return ip_address
+    return f'{ip_address}/128' if _is_ipv6(ip_address) else f'{ip_address}/32'
+
+def _rule_commands(iface, ip_address, limit_mbps, handle):
+    """
+    Команды tc (без пути к tc) для установки или замены ('filter replace') пары правил IP с handle из HandleAllocator.
+    """
+    if _is_ipv6(ip_address):
+        return _rule_commands_v6(iface, ip_address, limit_mbps, handle)
+    table = _u32_table(handle)
+    commands = []
+
+    # --- Правило для Upload (Egress - HTB) ---
+    classid_for_upload = map_limit_to_classid(limit_mbps)
+    if classid_for_upload:
+        commands.append([
+            'filter', 'replace', 'dev', iface, 'protocol', 'ip', 'parent', '1:0',
+            'prio', common.TC_PRIO, 'handle', handle, 'u32', 'ht', table,
+            'match', 'ip', 'src', _match_prefix(ip_address), # Фильтр по IP источнику
+            'flowid', classid_for_upload # Направить в HTB класс
+        ])
+    else:
+        _logger.warning("Не найден класс HTB для upload лимита %s Мбит/с для IP %s. Egress правило не добавлено.", limit_mbps, ip_address)
+
+    # --- Правило для Download (Ingress - Police) ---
+    # Расчет Burst: часто используют 10-20% от секунды трафика
+    # rate_bps = limit_mbps * 1000 * 1000
+    # burst_bytes = int(rate_bps * 0.15 / 8) # 150ms буфер в байтах
+    # burst_bytes = max(burst_bytes, 15000) # Минимум ~10 пакетов
+    # Формат для tc: число[k|m]
+    # burst_kb = burst_bytes / 1024
+    # burst_str = f"{int(burst_kb)}k" if burst_kb > 1 else "15k" # Упрощенно, ставим 15k
+    burst_str = "5k" # Упрощенный вариант, часто достаточен
+
+    commands.append([
+        'filter', 'replace', 'dev', iface, 'protocol', 'ip', 'parent', 'ffff:',  # Ingress qdisc
+        'prio', common.TC_PRIO, 'handle', handle, 'u32', 'ht', table,
+        'match', 'ip', 'dst', _match_prefix(ip_address),  # Фильтр по IP назначению
+        'police', 'rate', f'{limit_mbps}mbit', 'burst', burst_str, 'drop',  # Ограничение скорости
+        'flowid', ':1'  # Указываем flowid для police (формально)
+    ])
+    return commands
+
+def _rule_commands_v6(iface, ip_address, limit_mbps, handle):
+    """
+    Пара правил IPv6: flower (хэш-таблица по адресу/маске вместо линейного перебора u32).
+    Пространство handle у каждого приоритета свое, поэтому handle flower не пересекается с u32.
+    """
+    commands = []
+    classid_for_upload = map_limit_to_classid(limit_mbps)
+    if classid_for_upload:
+        commands.append([
+            'filter', 'replace', 'dev', iface, 'protocol', 'ipv6', 'parent', '1:0',
+            'prio', common.TC_PRIO_V6, 'handle', handle, 'flower',
+            'src_ip', _match_prefix(ip_address), 'classid', classid_for_upload
+        ])
+    else:
+        _logger.warning("Не найден класс HTB для upload лимита %s Мбит/с для IP %s. Egress правило не добавлено.", limit_mbps, ip_address)
+    commands.append([
+        'filter', 'replace', 'dev', iface, 'protocol', 'ipv6', 'parent', 'ffff:',
+        'prio', common.TC_PRIO_V6, 'handle', handle, 'flower',
+        'dst_ip', _match_prefix(ip_address),
+        'action', 'police', 'rate', f'{limit_mbps}mbit', 'burst', '5k', 'drop'
+    ])
+    return commands
+
+def _remove_commands(iface, ip_address, handle):
+    """Команды tc (без пути к tc) для удаления пары правил по handle."""
+    if _is_ipv6(ip_address):
+        return [['filter', 'del', 'dev', iface, 'parent', parent, 'protocol', 'ipv6',
+                 'prio', common.TC_PRIO_V6, 'handle', handle, 'flower'] for parent in ('1:0', 'ffff:')]
+    return [['filter', 'del', 'dev', iface, 'parent', parent, 'protocol', 'ip',
+             'prio', common.TC_PRIO, 'handle', handle, 'u32'] for parent in ('1:0', 'ffff:')]
+
+def _run_tc_batch(commands, failure_msg, quiet_errors=()):
+    """
+    Выполняет команды одним процессом 'tc -force -batch -' (одна команда на строку stdin).
+    С -force tc продолжает после ошибки и сообщает о каждой строкой 'Command failed -:N'.
+
+    Args:
+        commands (list): Команды tc без пути к tc (списки аргументов без пробелов).
+        failure_msg (str): Сообщение для лога при ошибках.
+        quiet_errors (tuple): Подстроки ожидаемых ошибок (например, удаление отсутствующего фильтра).
+
+    Returns:
+        tuple: (кол-во неуспешных команд, True если все ошибки - ожидаемые).
+    """
+    if not commands:
+        return 0, True
+    batch_input = ''.join(' '.join(args) + '\n' for args in commands)
+    returncode, _, stderr = system_utils.run_command_output([common.TC_PATH, '-force', '-batch', '-'], input_text=batch_input)
+    if returncode == 0:
+        return 0, True
+    if returncode is None:
+        _logger.warning("%s: не удалось запустить tc: %s", failure_msg, stderr)
+        return len(commands), False
+    lines = (stderr or '').strip().splitlines()
+    failed = sum(1 for line in lines if line.startswith('Command failed')) or len(commands)
+    error_lines = [line for line in lines
+                   if not line.startswith('Command failed') and 'error talking to the kernel' not in line]
+    expected_only = bool(error_lines) and all(any(marker in line for marker in quiet_errors) for line in error_lines)
+    if expected_only:
+        _logger.debug("%s (%d из %d): %s", failure_msg, failed, len(commands), '; '.join(error_lines))
+    else:
+        _logger.warning("%s (%d из %d): %s", failure_msg, failed, len(commands), '; '.join(error_lines[:5]))
+    return failed, expected_only
+
+def interface_names(iface):
+    """Интерфейс (str) или список интерфейсов -> список имен."""
+    return [iface] if isinstance(iface, str) else list(iface)
+
+def run_on_interfaces(ifaces, func, *args):
+    """
+    Вызывает func(iface, *args) для каждого интерфейса, для нескольких - параллельно (поток на интерфейс):
+    tc работает в отдельных процессах, и время применения не складывается по интерфейсам.
+
+    Args:
+        ifaces (str or list): Интерфейс или список интерфейсов.
+        func (callable): Функция tc_manager, первый аргумент - интерфейс.
+
+    Returns:
+        dict: { iface: результат func }.
+    """
+    names = interface_names(ifaces)
+    if len(names) <= 1:
+        return {name: func(name, *args) for name in names}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(names), thread_name_prefix='tc-iface') as executor:
+        futures = {name: executor.submit(func, name, *args) for name in names}
+        return {name: future.result() for name, future in futures.items()}
+
+def _run_tc_batches(commands_by_iface, failure_msg, quiet_errors=()):
+    """
+    _run_tc_batch() для команд каждого интерфейса, параллельно по интерфейсам.
+
+    Args:
+        commands_by_iface (dict): { iface: [команды tc] }.
+
+    Returns:
+        tuple: (суммарное кол-во неуспешных команд, True если все ошибки - ожидаемые).
+    """
+    results = run_on_interfaces(
+        list(commands_by_iface),
+        lambda iface: _run_tc_batch(commands_by_iface[iface], f"{failure_msg} на {iface}", quiet_errors))
+    failed = sum(result[0] for result in results.values())
+    expected_only = all(result[1] or not result[0] for result in results.values())
+    return failed, expected_only
+
+def _log_handle_overflow(allocator):
+    """Ошибка в лог, если части IP не хватило handle (их список - allocator.overflow)."""
+    if allocator.overflow:
+        _logger.error("Исчерпаны handle фильтров (%d узлов на корзину u32, %d handle IPv6): %d IP без правил (%s).",
+                      allocator.max_node, allocator.max_flower_handle, len(allocator.overflow),
+                      ', '.join(sorted(allocator.overflow)[:5]))
+
+def apply_tc_rules(iface, user_ips_with_limits, allocator=None):
+    """
+    Применяет правила tc (htb для upload, police для download) для IP-адресов пользователей
+    с полной пересборкой: сначала очищает все правила с нашим приоритетом.
+    Используется, когда состояние ядра неизвестно; в остальных случаях - sync_tc_rules().
+
+    Args:
+        iface (str or list): Сетевой интерфейс или список интерфейсов (правила одинаковы на всех,
+                             handle выделяются один раз).
         user_ips_with_limits (dict): Словарь { 'ip_address': limit_mbps }.
+        allocator (HandleAllocator, optional): Постоянные handle IP (сбрасывается и заполняется заново).
 
     Returns:
-        int: Количество успешно примененных правил (сумма egress и ingress).
+        int: Количество успешно примененных правил (сумма egress и ingress по всем интерфейсам).
              Может быть 0, если словарь пуст или при применении возникли ошибки.
     """
+    names = interface_names(iface)
+    iface_label = ', '.join(names)
     if not user_ips_with_limits:
-        print(f"{common.Color.YELLOW}[TC] Нет активных IP/лимитов для применения правил на {iface}.{common.Color.RESET}")
+        _logger.info("Нет активных IP/лимитов для применения правил на %s.", iface_label)
         return 0
 
-    print(f"{common.Color.CYAN}[TC] Применение {len(user_ips_with_limits)} правил для IP-адресов на {iface}...{common.Color.RESET}")
+    _logger.debug("Применение %d правил для IP-адресов на %s...", len(user_ips_with_limits), iface_label)
 
     # 1. Очистка старых правил перед применением новых
-    if not clear_dynamic_tc_rules(iface):
-        print(f"{common.Color.YELLOW}[TC WARN] Не удалось полностью очистить старые правила. Новые правила могут работать некорректно.{common.Color.RESET}")
+    if not all(run_on_interfaces(names, clear_dynamic_tc_rules).values()):
+        _logger.warning("Не удалось полностью очистить старые правила. Новые правила могут работать некорректно.")
         # Продолжаем попытку применить новые правила
+    run_on_interfaces(names, ensure_u32_tables) # Очистка приоритета удаляет и таблицы u32
 
-    applied_rules_count = 0
-    handle_counter = 0 # Счетчик для генерации уникальных handle 0x5000, 0x5001, ...
-
+    allocator = allocator if allocator is not None else HandleAllocator()
+    allocator.reset()
+    rules = []
     for ip_address, limit_mbps in user_ips_with_limits.items():
-        # Валидация данных
-        if not ip_address or not isinstance(limit_mbps, (int, float)) or limit_mbps <= 0:
-            print(f"{common.Color.YELLOW}[TC WARN] Пропуск некорректной записи: IP='{ip_address}', Лимит='{limit_mbps}'.{common.Color.RESET}")
+        if not _is_valid_rule(ip_address, limit_mbps):
             continue
+        handle = allocator.allocate(ip_address)
+        if handle is not None:
+            rules.append((ip_address, limit_mbps, handle))
+    _log_handle_overflow(allocator)
 
-        # Простая валидация IP-адреса (только IPv4)
-        if not re.match(r"^\d{1,3}(\.\d{1,3}){3}$", ip_address):
-            print(f"{common.Color.YELLOW}[TC WARN] Пропуск невалидного IPv4 адреса: '{ip_address}'.{common.Color.RESET}")
-            continue
+    commands = {name: [command for ip_address, limit_mbps, handle in rules
+                       for command in _rule_commands(name, ip_address, limit_mbps, handle)] for name in names}
+    failed, _ = _run_tc_batches(commands, "Не удалось добавить часть правил")
+    applied_rules_count = sum(len(iface_commands) for iface_commands in commands.values()) - failed
+    _logger.info("Применено %d правил TC для %s.", applied_rules_count, iface_label)
+    return applied_rules_count
+
+def sync_tc_rules(iface, desired, installed, allocator):
+    """
+    Приводит правила к плану desired по разнице с установленным планом installed:
+    удаление - 'tc filter del' по handle, новый IP или смена лимита - 'tc filter replace',
+    неизмененные правила не трогаются (их счетчики сохраняются).
+
+    Args:
+        iface (str or list): Сетевой интерфейс или список интерфейсов (один план на всех).
+        desired (dict): Новый план { 'ip_address': limit_mbps }.
+        installed (dict): Установленный план { 'ip_address': limit_mbps } (результат прошлой синхронизации).
+        allocator (HandleAllocator): Постоянные handle IP (должен соответствовать installed).
+
+    Returns:
+        tuple: (фактически установленный план {ip: limit}, кол-во измененных IP
+                (добавлено + изменено + удалено), True если все команды tc успешны).
+    """
+    names = interface_names(iface)
+    result = dict(installed)
+    all_ok = True
+    removed = changed = added = 0
 
-        # --- Правило для Upload (Egress - HTB) ---
-        classid_for_upload = map_limit_to_classid(limit_mbps)
-        if classid_for_upload:
-            egress_handle = hex(common.TC_HANDLE_BASE + handle_counter)
-            handle_counter += 1
-            egress_args = [
-                common.TC_PATH,
-                'filter', 'add', 'dev', iface, 'protocol', 'ip', 'parent', '1:0',
-                'prio', common.TC_PRIO, 'handle', egress_handle, 'u32',
-                'match', 'ip', 'src', f'{ip_address}/32', # Фильтр по IP источнику
-                'flowid', classid_for_upload # Направить в HTB класс
-            ]
-            # Теперь вызывается правильная команда: tc filter add ...
-            if system_utils.run_command(egress_args, check=False, capture_output=True, show_error=True, failure_msg=f"Не удалось добавить egress правило для {ip_address}"):
-                 applied_rules_count += 1
-                # print(f"[TC DEBUG] Egress правило: {ip_address} -> {classid_for_upload}")
-            # else: Ошибка уже выведена run_command
+    # Сначала удаления - освободившиеся узлы можно сразу выдать новым IP
+    removals = []
+    for ip_address in [ip for ip in installed if ip not in desired]:
+        handle = allocator.handles.get(ip_address)
+        if handle is not None:
+            removals.append((ip_address, handle))
+        allocator.release(ip_address)
+        result.pop(ip_address, None)
+        removed += 1
+    remove_commands = {name: [command for ip_address, handle in removals
+                              for command in _remove_commands(name, ip_address, handle)]
+                       for name in names}
+    failed, expected_only = _run_tc_batches(remove_commands, "Не удалось удалить часть правил",
+                                            quiet_errors=_NOT_FOUND_ERRORS)
+    if failed and not expected_only:
+        all_ok = False
+
+    installs = []
+    allocator.overflow = set()
+    for ip_address, limit_mbps in desired.items():
+        if installed.get(ip_address) == limit_mbps and ip_address in allocator.handles:
+            continue
+        if not _is_valid_rule(ip_address, limit_mbps):
+            continue
+        is_new = ip_address not in allocator.handles
+        handle = allocator.allocate(ip_address)
+        if handle is None:
+            continue
+        installs.append((ip_address, limit_mbps, handle))
+        result[ip_address] = limit_mbps
+        if is_new:
+            added += 1
         else:
-            print(f"{common.Color.YELLOW}[TC WARN] Не найден класс HTB для upload лимита {limit_mbps} Мбит/с для IP {ip_address}. Egress правило не добавлено.{common.Color.RESET}")
-
-        # --- Правило для Download (Ingress - Police) ---
-        ingress_handle = hex(common.TC_HANDLE_BASE + handle_counter)
-        handle_counter += 1
-        # Расчет Burst: часто используют 10-20% от секунды трафика
-        # rate_bps = limit_mbps * 1000 * 1000
-        # burst_bytes = int(rate_bps * 0.15 / 8) # 150ms буфер в байтах
-        # burst_bytes = max(burst_bytes, 15000) # Минимум ~10 пакетов
-        # Формат для tc: число[k|m]
-        # burst_kb = burst_bytes / 1024
-        # burst_str = f"{int(burst_kb)}k" if burst_kb > 1 else "15k" # Упрощенно, ставим 15k
-        burst_str = "5k" # Упрощенный вариант, часто достаточен
-
-        ingress_args = [
-            common.TC_PATH,  # <--- ДОБАВЛЕНО
-            'filter', 'add', 'dev', iface, 'protocol', 'ip', 'parent', 'ffff:',  # Ingress qdisc
-            'prio', common.TC_PRIO, 'handle', ingress_handle, 'u32',
-            'match', 'ip', 'dst', f'{ip_address}/32',  # Фильтр по IP назначению
-            'police', 'rate', f'{limit_mbps}mbit', 'burst', burst_str, 'drop',  # Ограничение скорости
-            'flowid', ':1'  # Указываем flowid для police (формально)
-        ]
-        # Теперь вызывается правильная команда: tc filter add ...
-        if system_utils.run_command(ingress_args, check=False, capture_output=True, show_error=True,
-                                    failure_msg=f"Не удалось добавить ingress правило для {ip_address}"):
-            applied_rules_count += 1
-            # print(f"[TC DEBUG] Ingress правило: {ip_address} @ {limit_mbps}mbit")
-        # else: Ошибка уже выведена run_command
-
-    print(f"{common.Color.GREEN}[TC] Успешно применено {applied_rules_count} правил TC для {iface}.{common.Color.RESET}")
-    return applied_rules_count
\ No newline at end of file
+            changed += 1
+
+    _log_handle_overflow(allocator) # Остальные правила согласованы: пересборка не нужна, IP без handle - в overflow
+    if installs and not installed:
+        run_on_interfaces(names, ensure_u32_tables) # После очистки правил таблиц u32 нет
+    install_commands = {name: [command for ip_address, limit_mbps, handle in installs
+                               for command in _rule_commands(name, ip_address, limit_mbps, handle)] for name in names}
+    failed, _ = _run_tc_batches(install_commands, "Не удалось установить часть правил")
+    if failed:
+        all_ok = False
+
+    log_utils.log_summary(_logger, "Синхронизация правил TC", level=logging.DEBUG if all_ok else logging.WARNING,
+                          iface=','.join(names), added=added, changed=changed, removed=removed,
+                          unchanged=len(result) - added - changed, ok=all_ok)
+    return result, added + changed + removed, all_ok
+
+# --- Правила по соединению (shared_ip_mode='connection') ---
+# Если один IP (CGNAT, мобильный оператор) у пользователей с разными лимитами, соединения
+# каждого пользователя (IP + порт клиента) получают свои фильтры с приоритетом TC_CONN_PRIO,
+# а правило по IP остается для соединений с неизвестным владельцем. Набор соединений меняется
+# часто и невелик, поэтому он переустанавливается целиком (без постоянных handle).
+
+def _connection_rule_commands(iface, ip_address, port, limit_mbps):
+    """Команды tc (без пути к tc) для пары правил одного соединения клиента."""
+    if _is_ipv6(ip_address):
+        protocol, match, prio = 'ipv6', 'ip6', common.TC_CONN_PRIO_V6
+    else:
+        protocol, match, prio = 'ip', 'ip', common.TC_CONN_PRIO
+    prefix = _match_prefix(ip_address)
+    commands = []
+    classid_for_upload = map_limit_to_classid(limit_mbps)
+    if classid_for_upload:
+        commands.append([
+            'filter', 'add', 'dev', iface, 'protocol', protocol, 'parent', '1:0', 'prio', prio, 'u32',
+            'match', match, 'src', prefix, 'match', match, 'sport', str(port), '0xffff',
+            'flowid', classid_for_upload
+        ])
+    commands.append([
+        'filter', 'add', 'dev', iface, 'protocol', protocol, 'parent', 'ffff:', 'prio', prio, 'u32',
+        'match', match, 'dst', prefix, 'match', match, 'dport', str(port), '0xffff',
+        'police', 'rate', f'{limit_mbps}mbit', 'burst', '5k', 'drop', 'flowid', ':1'
+    ])
+    return commands
+
+def clear_connection_rules(iface):
+    """Удаляет все правила по соединению (приоритеты TC_CONN_PRIO и TC_CONN_PRIO_V6) на egress и ingress."""
+    commands = [['filter', 'del', 'dev', iface, 'parent', parent, 'prio', prio]
+                for prio in (common.TC_CONN_PRIO, common.TC_CONN_PRIO_V6) for parent in ('1:0', 'ffff:')]
+    failed, expected_only = _run_tc_batch(commands, f"Не удалось удалить правила по соединению на {iface}",
+                                          quiet_errors=_NOT_FOUND_ERRORS)
+    return not failed or expected_only
+
+def apply_connection_rules(iface, connection_limits):
+    """
+    Переустанавливает правила по соединению.
+
+    Args:
+        iface (str): Сетевой интерфейс.
+        connection_limits (dict): { (ip, port): limit_mbps }.
+
+    Returns:
+        tuple: (кол-во установленных правил, True если все команды tc успешны).
+    """
+    cleared = clear_connection_rules(iface)
+    commands = []
+    for (ip_address, port), limit_mbps in sorted(connection_limits.items()):
+        if _is_valid_rule(ip_address, limit_mbps):
+            commands.extend(_connection_rule_commands(iface, ip_address, port, limit_mbps))
+    failed, _ = _run_tc_batch(commands, f"Не удалось установить часть правил по соединению на {iface}")
+    _logger.debug("Правила по соединению на %s: %d соединений, %d правил.", iface, len(connection_limits),
+                  len(commands) - failed)
+    return len(commands) - failed, cleared and not failed
+
+def settings_fingerprint():
+    """Параметры tc, от которых зависят устанавливаемые правила (для отпечатка плана в воркере)."""
+    return {
+        'prio': common.TC_PRIO,
+        'conn_prio': common.TC_CONN_PRIO,
+        'prio_v6': common.TC_PRIO_V6,
+        'conn_prio_v6': common.TC_CONN_PRIO_V6,
+        'u32_layout': HandleAllocator.layout(),
+        'classes': sorted(common.PREDEFINED_LIMIT_CLASSES.items()),
+    }
+
+def quick_sanity_check(iface, expected_rules):
+    """
+    Быстрая проверка, что правила в ядре на месте: есть корневой HTB 1: и ingress ffff:,
+    а число ingress-фильтров с нашим приоритетом равно ожидаемому.
+
+    Args:
+        iface (str): Сетевой интерфейс.
+        expected_rules (int): Ожидаемое число IP с правилами.
+
+    Returns:
+        bool: True, если состояние ядра совпадает с ожидаемым.
+    """
+    returncode, stdout, _ = system_utils.run_command_output([common.TC_PATH, 'qdisc', 'show', 'dev', iface])
+    if returncode != 0 or 'qdisc htb 1:' not in stdout or 'qdisc ingress ffff:' not in stdout:
+        _logger.info("Проверка ядра: базовые qdisc на %s не найдены.", iface)
+        return False
+    if expected_rules == 0:
+        return True
+    returncode, stdout, _ = system_utils.run_command_output(
+        [common.TC_PATH, 'filter', 'show', 'dev', iface, 'parent', 'ffff:'])
+    if returncode != 0:
+        return False
+    installed_rules = 0
+    for line in stdout.splitlines():
+        if f" pref {common.TC_PRIO} " in line and _U32_RULE_HANDLE_RE.search(line):
+            installed_rules += 1 # u32 (IPv4)
+        elif f" pref {common.TC_PRIO_V6} " in line and ' handle ' in line:
+            installed_rules += 1 # flower (IPv6)
+    if installed_rules != expected_rules:
+        _logger.info("Проверка ядра: на %s %d ingress-фильтров вместо %d.", iface, installed_rules, expected_rules)
+        return False
+    return True
+
+# --- Классификация по метке сокета (classification='mark') ---
+# Xray ставит sockopt.mark на outbound уровня скорости, пользователи направляются в outbound
+# правилами маршрутизации по email. Egress: fw-фильтр метки -> класс HTB уровня.
+# Ingress: ответы не несут метку сокета, поэтому iptables сохраняет метку в conntrack
+# (CONNMARK --save-mark в mangle OUTPUT), а act_connmark восстанавливает ее до fw-фильтров.
+# Лимит уровня общий для всех его пользователей (класс HTB и police одного фильтра).
+
+def tier_mark(class_id):
+    """Метка сокета для уровня (ID класса HTB из PREDEFINED_LIMIT_CLASSES)."""
+    return common.TC_MARK_BASE + class_id
+
+def mark_for_limit(limit_mbps):
+    """Метка уровня для лимита пользователя (через подбор класса HTB) или None."""
+    classid = map_limit_to_classid(limit_mbps)
+    return tier_mark(int(classid.split(':')[1])) if classid else None
+
+def build_xray_mark_config(user_limits):
+    """
+    Фрагмент конфигурации Xray для classification='mark': outbound 'freedom' с sockopt.mark
+    для каждого используемого уровня и правила маршрутизации пользователей по email.
+    Правила нужно поставить в начало routing.rules (после правила API), outbounds - добавить к существующим.
+
+    Args:
+        user_limits (dict): { email: limit_mbps }.
+
+    Returns:
+        dict: {'outbounds': [...], 'routing_rules': [...]}.
+    """
+    tiers = {} # mark -> [email, ...]
+    for email, limit in user_limits.items():
+        if isinstance(limit, bool) or not isinstance(limit, (int, float)) or limit <= 0:
+            continue
+        mark = mark_for_limit(limit)
+        if mark is not None:
+            tiers.setdefault(mark, []).append(email)
+    outbounds, rules = [], []
+    for mark in sorted(tiers):
+        tag = f"xsl-tier-{mark - common.TC_MARK_BASE}"
+        outbounds.append({'tag': tag, 'protocol': 'freedom', 'settings': {},
+                          'streamSettings': {'sockopt': {'mark': mark}}})
+        rules.append({'type': 'field', 'user': sorted(tiers[mark]), 'outboundTag': tag})
+    return {'outbounds': outbounds, 'routing_rules': rules}
+
+def _mark_filter_commands(iface):
+    """
+    Команды tc (без пути к tc) для установки fw-фильтров всех уровней и восстановления метки на ingress.
+    Фильтры 'protocol all': метка не зависит от семейства, одни и те же фильтры обслуживают IPv4 и IPv6.
+    """
+    commands = [[
+        'filter', 'add', 'dev', iface, 'protocol', 'all', 'parent', 'ffff:', 'prio', common.TC_CONNMARK_PRIO,
+        'u32', 'match', 'u32', '0', '0', 'action', 'connmark', 'continue'
+    ]]
+    for class_id, rate_mbps in sorted(common.PREDEFINED_LIMIT_CLASSES.items()):
+        mark = f"{tier_mark(class_id):#x}"
+        commands.append(['filter', 'add', 'dev', iface, 'protocol', 'all', 'parent', '1:0',
+                         'prio', common.TC_MARK_PRIO, 'handle', mark, 'fw', 'flowid', f'1:{class_id}'])
+        commands.append(['filter', 'add', 'dev', iface, 'protocol', 'all', 'parent', 'ffff:',
+                         'prio', common.TC_MARK_PRIO, 'handle', mark, 'fw',
+                         'police', 'rate', f'{rate_mbps}mbit', 'burst', '5k', 'drop', 'flowid', ':1'])
+    return commands
+
+def _mark_remove_commands(iface):
+    return [['filter', 'del', 'dev', iface, 'parent', '1:0', 'prio', common.TC_MARK_PRIO],
+            ['filter', 'del', 'dev', iface, 'parent', 'ffff:', 'prio', common.TC_MARK_PRIO],
+            ['filter', 'del', 'dev', iface, 'parent', 'ffff:', 'prio', common.TC_CONNMARK_PRIO]]
+
+def _ensure_connmark_save(present):
+    """
+    Добавляет (present=True) или удаляет правило, сохраняющее метку уровня в conntrack:
+    iptables обязательно, ip6tables - по возможности (без него IPv6 ingress не получит метку).
+
+    Returns:
+        bool: Результат для iptables.
+    """
+    ipv4_ok = _ensure_connmark_rule('iptables', present)
+    if not _ensure_connmark_rule('ip6tables', present):
+        _logger.warning("Правило CONNMARK для IPv6 не применено: ingress IPv6 останется без лимита уровня.")
+    return ipv4_ok
+
+def _ensure_connmark_rule(tool, present):
+    rule = ['OUTPUT', '-m', 'mark', '--mark', f"{common.TC_MARK_BASE:#x}/{common.TC_MARK_MASK:#x}",
+            '-j', 'CONNMARK', '--save-mark']
+    returncode, _, stderr = system_utils.run_command_output([tool, '-t', 'mangle', '-C'] + rule)
+    if returncode is None:
+        _logger.warning("Не удалось запустить %s: %s", tool, stderr)
+        return False
+    if (returncode == 0) == present:
+        return True
+    action = '-A' if present else '-D'
+    returncode, _, stderr = system_utils.run_command_output([tool, '-t', 'mangle', action] + rule)
+    if returncode != 0:
+        _logger.warning("Ошибка %s (%s CONNMARK --save-mark): %s", tool, action, (stderr or '').strip())
+        return False
+    return True
+
+def apply_mark_filters(iface):
+    """
+    Устанавливает статические fw-фильтры по меткам уровней (пересоздает их одной пачкой)
+    и правило iptables CONNMARK --save-mark.
+
+    Returns:
+        bool: True, если фильтры и правило iptables установлены.
+    """
+    _run_tc_batch(_mark_remove_commands(iface), "Удаление fw-фильтров меток", quiet_errors=_NOT_FOUND_ERRORS)
+    commands = _mark_filter_commands(iface)
+    failed, _ = _run_tc_batch(commands, "Установка fw-фильтров меток")
+    connmark_ok = _ensure_connmark_save(True)
+    log_utils.log_summary(_logger, "Фильтры меток", iface=iface, tiers=len(common.PREDEFINED_LIMIT_CLASSES),
+                          failed=failed, connmark=connmark_ok)
+    return failed == 0 and connmark_ok
+
+def clear_mark_filters(iface):
+    """Снимает fw-фильтры меток и правило CONNMARK (при возврате к классификации по IP)."""
+    _run_tc_batch(_mark_remove_commands(iface), "Удаление fw-фильтров меток", quiet_errors=_NOT_FOUND_ERRORS)
+    _ensure_connmark_save(False)
+
+def mark_filters_installed(iface):
+    """Быстрая проверка: базовые qdisc на месте и ingress fw-фильтры всех уровней установлены."""
+    if not quick_sanity_check(iface, 0):
+        return False
+    returncode, stdout, _ = system_utils.run_command_output(
+        [common.TC_PATH, 'filter', 'show', 'dev', iface, 'parent', 'ffff:', 'prio', common.TC_MARK_PRIO])
+    return returncode == 0 and stdout.count('handle 0x') == len(common.PREDEFINED_LIMIT_CLASSES)
+
+# --- Базовая структура TC (декларативно) ---
+# Дерево описано данными: корневой HTB 1: (default 30), класс 1:1 на пропускную способность интерфейса,
+# классы уровней PREDEFINED_LIMIT_CLASSES под ним (не выше 1:1) и ingress ffff:. reconcile_base_tree()
+# читает текущее дерево и выполняет только команды для отличий: повторный запуск ничего не меняет,
+# а динамические фильтры на HTB 1: и ingress ffff: сохраняются.
+
+BASE_ROOT_HANDLE = '1:'
+BASE_MAIN_CLASS = '1:1'
+BASE_DEFAULT_CLASS = '30'   # 'default' корневого HTB (минор класса, hex - как в командах tc)
+BASE_INGRESS_HANDLE = 'ffff:'
+_INGRESS_PARENT = 'ffff:fff1'
+_RATE_TOLERANCE = 0.005     # Допуск сравнения скоростей (tc хранит их в байтах/с)
+
+_QDISC_LINE_RE = re.compile(r"^qdisc (\S+) ([0-9a-f]+:)\s+(?:root|parent (\S+))")
+_QDISC_DEFAULT_RE = re.compile(r"\bdefault (?:0x)?([0-9a-f]+)\b")
+_CLASS_LINE_RE = re.compile(r"^class htb (\S+) (?:root|parent (\S+))\b.*?\brate (\S+) ceil (\S+)")
+_RATE_VALUE_RE = re.compile(r"^(\d+(?:\.\d+)?)([KMGT]?)bit$")
+_RATE_UNITS = {'': 1, 'K': 10**3, 'M': 10**6, 'G': 10**9, 'T': 10**12}
+
+def base_tree_spec(capacity_mbit):
+    """
+    Описание классов базы TC для интерфейса.
+
+    Args:
+        capacity_mbit (int): Пропускная способность интерфейса (скорость класса 1:1).
+
+    Returns:
+        dict: { classid: (родитель или None для корневого класса, скорость Мбит/с) }.
+    """
+    classes = {BASE_MAIN_CLASS: (None, capacity_mbit)}
+    for class_id, limit_mbps in sorted(common.PREDEFINED_LIMIT_CLASSES.items()):
+        classes[f'1:{class_id}'] = (BASE_MAIN_CLASS, min(limit_mbps, capacity_mbit))
+    return classes
+
+def _parse_rate(value):
+    """Скорость из вывода tc ('10Mbit', '1Gbit') в бит/с или None."""
+    match = _RATE_VALUE_RE.match(value)
+    return float(match.group(1)) * _RATE_UNITS[match.group(2)] if match else None
+
+def parse_base_tree(qdisc_output, class_output):
+    """
+    Разбирает вывод 'tc qdisc show' и 'tc class show' (текстовый: у HTB-классов нет вывода -j).
+
+    Returns:
+        dict: 'root' - (вид, handle, default или None) или None, 'ingress' - вид qdisc на ffff:fff1 или None,
+              'classes' - { classid: (родитель или None, rate бит/с, ceil бит/с) }.
+    """
+    tree = {'root': None, 'ingress': None, 'classes': {}}
+    for line in qdisc_output.splitlines():
+        match = _QDISC_LINE_RE.match(line.strip())
+        if not match:
+            continue
+        kind, handle, parent = match.groups()
+        if parent is None:
+            default = _QDISC_DEFAULT_RE.search(line)
+            tree['root'] = (kind, handle, default.group(1) if default else None)
+        elif parent == _INGRESS_PARENT:
+            tree['ingress'] = kind
+    for line in class_output.splitlines():
+        match = _CLASS_LINE_RE.match(line.strip())
+        if match:
+            classid, parent, rate, ceil = match.groups()
+            tree['classes'][classid] = (parent, _parse_rate(rate), _parse_rate(ceil))
+    return tree
+
+def _same_rate(current_bps, rate_mbit):
+    return current_bps is not None and abs(current_bps - rate_mbit * 10**6) <= rate_mbit * 10**6 * _RATE_TOLERANCE
+
+def plan_base_tree(iface, spec, current):
+    """
+    Команды tc (без пути к tc), приводящие текущее дерево к описанию.
+
+    Args:
+        iface (str): Сетевой интерфейс.
+        spec (dict): Классы из base_tree_spec().
+        current (dict): Текущее дерево из parse_base_tree().
+
+    Returns:
+        list: Команды; пустой список - дерево уже в нужном виде.
+    """
+    commands = []
+    root = current['root']
+    current_classes = current['classes']
+    if root is None or root[0] != 'htb' or root[1] != BASE_ROOT_HANDLE:
+        # Чужой корневой qdisc заменяется целиком (вместе с его классами и фильтрами)
+        commands.append(['qdisc', 'replace', 'dev', iface, 'root', 'handle', BASE_ROOT_HANDLE,
+                         'htb', 'default', BASE_DEFAULT_CLASS])
+        current_classes = {}
+    elif root[2] is None or int(root[2], 16) != int(BASE_DEFAULT_CLASS, 16):
+        commands.append(['qdisc', 'change', 'dev', iface, 'root', 'handle', BASE_ROOT_HANDLE,
+                         'htb', 'default', BASE_DEFAULT_CLASS])
+
+    # Лишние классы (прежний набор уровней) - сначала дочерние
+    extra_classes = [classid for classid in current_classes if classid not in spec]
+    for classid in sorted(extra_classes, key=lambda classid: current_classes[classid][0] is None):
+        commands.append(['class', 'del', 'dev', iface, 'classid', classid])
+
+    for classid, (parent, rate_mbit) in spec.items(): # 1:1 первым - родитель уровней
+        existing = current_classes.get(classid)
+        action = 'add'
+        if existing is not None:
+            if existing[0] != parent:
+                commands.append(['class', 'del', 'dev', iface, 'classid', classid])
+            elif _same_rate(existing[1], rate_mbit) and _same_rate(existing[2], rate_mbit):
+                continue
+            else:
+                action = 'change'
+        commands.append(['class', action, 'dev', iface, 'parent', parent or BASE_ROOT_HANDLE, 'classid', classid,
+                         'htb', 'rate', f'{rate_mbit}mbit', 'ceil', f'{rate_mbit}mbit'])
+
+    if current['ingress'] != 'ingress':
+        if current['ingress'] is not None: # clsact или другой qdisc на месте ingress
+            commands.append(['qdisc', 'del', 'dev', iface, 'parent', _INGRESS_PARENT])
+        commands.append(['qdisc', 'add', 'dev', iface, 'handle', BASE_INGRESS_HANDLE, 'ingress'])
+    return commands
+
+def read_base_tree(iface):
+    """Текущее дерево интерфейса (parse_base_tree) или None, если tc завершился ошибкой."""
+    trees = []
+    for kind in ('qdisc', 'class'):
+        returncode, stdout, stderr = system_utils.run_command_output([common.TC_PATH, kind, 'show', 'dev', iface])
+        if returncode != 0:
+            _logger.warning("Не удалось прочитать %s на %s (код %s): %s", kind, iface, returncode, (stderr or '').strip())
+            return None
+        trees.append(stdout or '')
+    return parse_base_tree(*trees)
+
+def reconcile_base_tree(iface, capacity_mbit):
+    """
+    Приводит базовую структуру TC интерфейса к описанию base_tree_spec(), меняя только отличия.
+
+    Args:
+        iface (str): Сетевой интерфейс.
+        capacity_mbit (int): Пропускная способность интерфейса.
+
+    Returns:
+        tuple: (кол-во выполненных команд, True если база в нужном виде).
+    """
+    current = read_base_tree(iface)
+    if current is None:
+        return 0, False
+    commands = plan_base_tree(iface, base_tree_spec(capacity_mbit), current)
+    if not commands:
+        _logger.debug("База TC на %s уже в нужном виде.", iface)
+        return 0, True
+    failed, _ = _run_tc_batch(commands, f"Не удалось привести базу TC на {iface}")
+    log_utils.log_summary(_logger, "База TC", level=logging.INFO if not failed else logging.WARNING,
+                          iface=iface, capacity_mbit=capacity_mbit, changes=len(commands), failed=failed)
+    return len(commands), failed == 0
+
+# --- Счетчики трафика и жизненный цикл правил ---
+
+def parse_filter_counters(tc_output, offset=_U32_OFFSET_DST):
+    """
+    Разбирает вывод 'tc -s filter show' и суммирует байты действий (police) по IP фильтра.
+
+    Args:
+        tc_output (str): Вывод команды tc.
+        offset (int): Смещение адреса в матче u32 (16 - dst для ingress, 12 - src для egress).
+                      Для flower (IPv6) читается соответственно 'dst_ip' или 'src_ip'.
+
+    Returns:
+        dict: { 'ip_address' или 'сеть/длина': байт } для фильтров с нашим приоритетом.
+    """
+    counters = {}
+    current_ip = None
+    in_our_prio = False
+    in_v6_prio = False
+    flower_key = 'dst_ip ' if offset == _U32_OFFSET_DST else 'src_ip '
+    for line in tc_output.splitlines():
+        stripped = line.strip()
+        if stripped.startswith('filter '):
+            in_our_prio = f" pref {common.TC_PRIO} " in f" {stripped} "
+            in_v6_prio = f" pref {common.TC_PRIO_V6} " in f" {stripped} "
+            current_ip = None
+            continue
+        if in_v6_prio:
+            if stripped.startswith(flower_key):
+                try:
+                    network = ipaddress.IPv6Network(stripped[len(flower_key):].strip(), strict=False)
+                except ValueError:
+                    continue
+                # Ключ плана: адрес без '/128', префикс (/64) - 'сеть/длина'
+                current_ip = str(network.network_address) if network.prefixlen == 128 else str(network)
+                counters.setdefault(current_ip, 0)
+                continue
+        elif not in_our_prio:
+            continue
+        match = _U32_MATCH_RE.search(stripped)
+        if match:
+            if int(match.group(3)) == offset:
+                current_ip = socket.inet_ntoa(bytes.fromhex(match.group(1)))
+                prefix_len = bin(int(match.group(2), 16)).count('1')
+                if prefix_len < 32: # Агрегированный префикс - ключ плана 'сеть/длина'
+                    current_ip = f"{current_ip}/{prefix_len}"
+                counters.setdefault(current_ip, 0)
+            continue
+        sent = _SENT_BYTES_RE.search(stripped)
+        if sent and current_ip is not None:
+            counters[current_ip] += int(sent.group(1))
+    return counters
+
+def read_filter_counters(iface):
+    """
+    Читает счетчики байт ingress-фильтров (police) нашего приоритета.
+
+    Returns:
+        dict or None: { 'ip_address': байт } или None, если tc завершился ошибкой.
+    """
+    returncode, stdout, stderr = system_utils.run_command_output(
+        [common.TC_PATH, '-s', 'filter', 'show', 'dev', iface, 'parent', 'ffff:'])
+    if returncode != 0:
+        _logger.warning("Не удалось прочитать счетчики фильтров %s (код %s): %s", iface, returncode, (stderr or '').strip())
+        return None
+    return parse_filter_counters(stdout or '')
+
+
+class RuleLifecycle:
+    """
+    Отслеживает установленные правила по IP: время последнего появления в онлайн,
+    счетчик байт и число циклов без трафика.
+
+    - Правило пользователя, пропавшего из онлайн, держится grace_sec (меньше пересоздания при "мигании").
+    - Правило без трафика idle_reclaim_cycles циклов подряд снимается; через idle_recheck_sec
+      оно ставится снова, чтобы заново проверить активность IP.
+
+    Состояние сериализуется через to_dict()/from_dict() (хранится воркером между запусками).
+    """
+
+    def __init__(self, grace_sec=DEFAULT_RULE_GRACE_SEC, idle_reclaim_cycles=DEFAULT_IDLE_RECLAIM_CYCLES,
+                 idle_recheck_sec=DEFAULT_IDLE_RECHECK_SEC):
+        self.grace_sec = grace_sec
+        self.idle_reclaim_cycles = idle_reclaim_cycles
+        self.idle_recheck_sec = idle_recheck_sec
+        # { ip: {'owner', 'limit', 'last_seen', 'bytes', 'idle_cycles', 'reclaimed_at'} }
+        self.entries = {}
+
+    @property
+    def needs_counters(self):
+        """Нужно ли читать счетчики фильтров перед циклом."""
+        return self.idle_reclaim_cycles > 0
+
+    def to_dict(self):
+        return {'entries': self.entries}
+
+    def load(self, data):
+        """Восстанавливает записи из to_dict() (некорректные данные игнорируются)."""
+        entries = (data or {}).get('entries')
+        if isinstance(entries, dict):
+            self.entries = {ip: entry for ip, entry in entries.items() if isinstance(entry, dict)}
+
+    def effective_plan(self, desired, owners, owner_limits, counters=None, now=None, live=None):
+        """
+        Вычисляет фактический план правил с учетом удержания и простоя.
+
+        Args:
+            desired (dict): { 'ip': limit_mbps } по текущим онлайн пользователям.
+            owners (dict): { 'ip': 'email' } для desired.
+            owner_limits (dict): Текущие лимиты { 'email': limit_mbps } (удерживаются только
+                                 IP пользователей, у которых лимит все еще задан).
+            counters (dict, optional): { 'ip': байт } из read_filter_counters().
+            now (float, optional): Текущее время (time.time()).
+            live (set, optional): IP с живыми соединениями; удерживаемые IP вне этого множества
+                                  снимаются сразу, без ожидания grace_sec.
+
+        Returns:
+            tuple: (plan {ip: limit_mbps}, stats {'held', 'reclaimed', 'expired'}).
+        """
+        now = time.time() if now is None else now
+        stats = {'held': 0, 'reclaimed': 0, 'expired': 0}
+        for ip, limit in desired.items():
+            entry = self.entries.setdefault(ip, {'bytes': 0, 'idle_cycles': 0, 'reclaimed_at': None})
+            entry.update(owner=owners.get(ip), limit=limit, last_seen=now)
+
+        plan = {}
+        for ip, entry in list(self.entries.items()):
+            if ip not in desired:
+                owner_limit = owner_limits.get(entry.get('owner'))
+                if (now - entry.get('last_seen', 0) >= self.grace_sec
+                        or (live is not None and ip not in live)
+                        or not isinstance(owner_limit, (int, float)) or owner_limit <= 0):
+                    del self.entries[ip]
+                    stats['expired'] += 1
+                    continue
+                entry['limit'] = owner_limit
+                stats['held'] += 1
+            if self._is_reclaimed(ip, entry, counters, now):
+                stats['reclaimed'] += 1
+                continue
+            plan[ip] = entry['limit']
+        return plan, stats
+
+    def _is_reclaimed(self, ip, entry, counters, now):
+        """Обновляет счетчик простоя IP и решает, снято ли его правило."""
+        if not self.needs_counters:
+            entry['reclaimed_at'] = None
+            return False
+        if entry.get('reclaimed_at') is not None:
+            if now - entry['reclaimed_at'] < self.idle_recheck_sec:
+                return True
+            entry.update(reclaimed_at=None, idle_cycles=0, bytes=0) # Ставим правило заново для проверки
+            return False
+        if counters is None or ip not in counters:
+            return False # Правило еще не установлено или счетчики недоступны
+        current_bytes = counters[ip]
+        # Счетчик меньше прошлого - фильтр пересоздан, считаем от нуля
+        delta = current_bytes - entry.get('bytes', 0) if current_bytes >= entry.get('bytes', 0) else current_bytes
+        entry['bytes'] = current_bytes
+        entry['idle_cycles'] = 0 if delta > 0 else entry.get('idle_cycles', 0) + 1
+        if entry['idle_cycles'] >= self.idle_reclaim_cycles:
+            _logger.debug("Правило для %s снято: нет трафика %d циклов.", ip, entry['idle_cycles'])
+            entry['reclaimed_at'] = now
+            return True
+        return False
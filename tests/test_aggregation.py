@@ -0,0 +1,97 @@
+"""Тесты tc_manager.aggregate_ip_prefixes(): покрытие входных адресов и запрет объединения разных лимитов."""
+
+import ipaddress
+import os
+import sys
+
+import pytest
+
+import tc_manager
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from aggregate_ip_prefixes import generate_clusters # noqa: E402
+
+EXACT = tc_manager.AGGREGATION_EXACT
+PREFIX = tc_manager.AGGREGATION_PREFIX
+
+
+def _networks(prefixes):
+    return [ipaddress.ip_network(prefix) for prefix in prefixes]
+
+def _addresses(prefixes):
+    """Все адреса, покрытые списком префиксов (для небольших сетей)."""
+    return {address for network in _networks(prefixes) for address in network}
+
+def _covers(prefixes, ip):
+    address = ipaddress.ip_address(ip)
+    return any(address in network for network in _networks(prefixes))
+
+
+def test_exact_covers_exactly_input():
+    ips = ['10.0.0.0', '10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.7', '2001:db8::4', '2001:db8::5']
+    result = tc_manager.aggregate_ip_prefixes({'a': ips}, {'a': 10}, mode=EXACT)
+    assert sorted(result['a']) == sorted(['10.0.0.0/30', '10.0.0.7', '2001:db8::4/127'])
+    assert _addresses(result['a']) == {ipaddress.ip_address(ip) for ip in ips}
+
+def test_prefix_widens_only_own_network():
+    result = tc_manager.aggregate_ip_prefixes({'a': ['10.0.0.5', '10.0.0.9', '10.0.1.5']}, {'a': 10})
+    assert sorted(result['a']) == ['10.0.0.0/24', '10.0.1.5']
+
+def test_prefix_widens_ipv6_to_64():
+    result = tc_manager.aggregate_ip_prefixes({'a': ['2001:db8:0:1::5', '2001:db8:0:1:ffff::1']}, {'a': 10})
+    assert result['a'] == ['2001:db8:0:1::/64']
+
+def test_min_ips_threshold():
+    result = tc_manager.aggregate_ip_prefixes({'a': ['10.0.0.5', '10.0.0.9']}, {'a': 10}, min_ips=3)
+    assert sorted(result['a']) == ['10.0.0.5', '10.0.0.9']
+
+def test_different_limits_never_share_network():
+    user_ips = {'a': ['10.0.0.5', '10.0.0.9'], 'b': ['10.0.0.200', '10.0.0.201']}
+    result = tc_manager.aggregate_ip_prefixes(user_ips, {'a': 10, 'b': 20})
+    assert sorted(result['a']) == ['10.0.0.5', '10.0.0.9']
+    assert sorted(result['b']) == ['10.0.0.200/31']
+
+def test_same_limit_users_both_widen():
+    user_ips = {'a': ['10.0.0.5', '10.0.0.9'], 'b': ['10.0.0.200', '10.0.0.202']}
+    result = tc_manager.aggregate_ip_prefixes(user_ips, {'a': 10, 'b': 10})
+    assert result == {'a': ['10.0.0.0/24'], 'b': ['10.0.0.0/24']}
+
+def test_shared_address_stays_single():
+    # Без общего адреса .2-.3 свернулись бы в /31, а в режиме 'prefix' - в /24
+    user_ips = {'a': ['10.0.0.1', '10.0.0.2', '10.0.0.3'], 'b': ['10.0.0.3']}
+    for mode in (EXACT, PREFIX):
+        result = tc_manager.aggregate_ip_prefixes(user_ips, {'a': 10, 'b': 20}, mode=mode)
+        assert sorted(result['a']) == ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+        assert result['b'] == ['10.0.0.3']
+
+def test_invalid_addresses_kept_and_off_mode_unchanged():
+    result = tc_manager.aggregate_ip_prefixes({'a': ['10.0.0.1', 'bogus']}, {'a': 10}, mode=EXACT)
+    assert sorted(result['a']) == ['10.0.0.1', 'bogus']
+    user_ips = {'a': ['10.0.0.2', '10.0.0.1']}
+    assert tc_manager.aggregate_ip_prefixes(user_ips, {}, mode=tc_manager.AGGREGATION_OFF) == user_ips
+
+
+@pytest.fixture(scope='module')
+def clusters():
+    return generate_clusters(300, 6, seed=7)
+
+def test_generated_exact_covers_exactly_input(clusters):
+    user_ips, user_limits = clusters
+    result = tc_manager.aggregate_ip_prefixes(user_ips, user_limits, mode=EXACT)
+    for email, ips in user_ips.items():
+        assert _addresses(result[email]) == {ipaddress.ip_address(ip) for ip in ips}
+
+def test_generated_prefix_covers_input_without_mixing_limits(clusters):
+    user_ips, user_limits = clusters
+    result = tc_manager.aggregate_ip_prefixes(user_ips, user_limits, mode=PREFIX)
+    for email, ips in user_ips.items():
+        assert all(_covers(result[email], ip) for ip in ips)
+    # Адрес другого пользователя с другим лимитом может попасть в сеть только как точное правило
+    for email, prefixes in result.items():
+        wide = [network for network in _networks(prefixes) if network.num_addresses > 1]
+        for other, ips in user_ips.items():
+            if user_limits[other] == user_limits[email]:
+                continue
+            for ip in ips:
+                address = ipaddress.ip_address(ip)
+                assert not any(address in network for network in wide), (email, other, ip)
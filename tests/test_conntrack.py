@@ -0,0 +1,91 @@
+"""
+Тесты разбора таблицы conntrack (ip_liveness='conntrack') на записанных дампах
+/proc/net/nf_conntrack и 'conntrack -L' (каталог fixtures).
+"""
+
+import os
+
+import pytest
+
+import system_utils
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+INBOUND_PORTS = (443, 8443)
+
+
+def _fixture(name):
+    with open(os.path.join(FIXTURES, name), 'r', encoding='utf-8') as f:
+        return f.read()
+
+@pytest.fixture(scope='module')
+def proc_dump():
+    return _fixture('nf_conntrack')
+
+
+def test_proc_dump_live_clients(proc_dump):
+    assert system_utils.parse_conntrack_client_ips(proc_dump, INBOUND_PORTS) == {
+        '203.0.113.10', '203.0.113.11',   # TCP ESTABLISHED на 443 и 8443
+        '203.0.113.30', '203.0.113.31',   # UDP с ответом (ASSURED и без)
+        '2001:db8::42', '2001:db8::44',   # IPv6 TCP ESTABLISHED и UDP с ответом
+    }
+
+def test_tcp_only_established(proc_dump):
+    ips = system_utils.parse_conntrack_client_ips(proc_dump, INBOUND_PORTS)
+    # TIME_WAIT, CLOSE_WAIT, FIN_WAIT, SYN_RECV, SYN_SENT, CLOSE - соединение не живое
+    assert ips.isdisjoint({f'203.0.113.{host}' for host in range(20, 26)} | {'2001:db8::43'})
+
+def test_udp_without_reply_skipped(proc_dump):
+    ips = system_utils.parse_conntrack_client_ips(proc_dump, INBOUND_PORTS)
+    assert '203.0.113.32' not in ips
+    assert '2001:db8::45' not in ips
+
+def test_non_matching_ports_skipped(proc_dump):
+    ips = system_utils.parse_conntrack_client_ips(proc_dump, INBOUND_PORTS)
+    assert ips.isdisjoint({'203.0.113.40', '2001:db8::46'}) # SSH
+    assert '198.51.100.1' not in ips # Исходящие соединения сервера (DNS, ответная сторона)
+    assert '203.0.113.41' not in ips # dport=443 только в ответном направлении
+    assert '203.0.113.50' not in ips # ICMP
+
+def test_ports_filter(proc_dump):
+    assert system_utils.parse_conntrack_client_ips(proc_dump, ['8443']) == {'203.0.113.11', '2001:db8::44'}
+    assert system_utils.parse_conntrack_client_ips(proc_dump, []) == set()
+
+def test_ipv6_normalized_to_compressed_form(proc_dump):
+    ips = system_utils.parse_conntrack_client_ips(proc_dump, INBOUND_PORTS)
+    assert not any(ip.startswith('2001:0db8') for ip in ips)
+
+def test_conntrack_tool_format():
+    dump = _fixture('conntrack_ipv4.txt') + _fixture('conntrack_ipv6.txt')
+    assert system_utils.parse_conntrack_client_ips(dump, INBOUND_PORTS) == {
+        '203.0.113.10', '203.0.113.30', '2001:db8::42', '2001:db8::44'}
+
+def test_garbage_lines_ignored():
+    dump = '\n'.join(['', 'conntrack v1.4.7 (conntrack-tools): 3 flow entries have been shown.',
+                      'tcp 6 10 ESTABLISHED src=not-an-ip dst=198.51.100.1 sport=1 dport=443',
+                      'tcp 6 10 ESTABLISHED src=203.0.113.60 dst=198.51.100.1 sport=1 dport=https'])
+    assert system_utils.parse_conntrack_client_ips(dump, INBOUND_PORTS) == set()
+
+
+def test_read_from_proc(monkeypatch):
+    monkeypatch.setattr(system_utils, 'CONNTRACK_PROC_FILE', os.path.join(FIXTURES, 'nf_conntrack'))
+    monkeypatch.setattr(system_utils, 'run_command_output', lambda *args, **kwargs: pytest.fail('conntrack -L'))
+    assert system_utils.read_conntrack_client_ips(INBOUND_PORTS) == {
+        '203.0.113.10', '203.0.113.11', '203.0.113.30', '203.0.113.31', '2001:db8::42', '2001:db8::44'}
+
+def test_read_falls_back_to_conntrack_tool(monkeypatch, tmp_path):
+    dumps = {'ipv4': _fixture('conntrack_ipv4.txt'), 'ipv6': _fixture('conntrack_ipv6.txt')}
+    monkeypatch.setattr(system_utils, 'CONNTRACK_PROC_FILE', str(tmp_path / 'missing'))
+    monkeypatch.setattr(system_utils, 'run_command_output', lambda command, **kwargs: (0, dumps[command[-1]], ''))
+    assert system_utils.read_conntrack_client_ips(INBOUND_PORTS) == {
+        '203.0.113.10', '203.0.113.30', '2001:db8::42', '2001:db8::44'}
+
+def test_read_unavailable(monkeypatch, tmp_path):
+    monkeypatch.setattr(system_utils, 'CONNTRACK_PROC_FILE', str(tmp_path / 'missing'))
+    monkeypatch.setattr(system_utils, 'run_command_output', lambda command, **kwargs: (None, '', 'not found'))
+    assert system_utils.read_conntrack_client_ips(INBOUND_PORTS) is None
+
+def test_protocol_filter(proc_dump):
+    assert system_utils.parse_conntrack_client_ips(proc_dump, INBOUND_PORTS, protocols=('udp',)) == {
+        '203.0.113.30', '203.0.113.31', '2001:db8::44'}
+    assert system_utils.parse_conntrack_client_ips(proc_dump, INBOUND_PORTS, protocols=('tcp',)) == {
+        '203.0.113.10', '203.0.113.11', '2001:db8::42'}
@@ -0,0 +1,73 @@
+"""Тесты управляющего сокета: таймауты клиента и применение лимитов демоном."""
+
+import socket
+import threading
+import time
+
+import pytest
+
+import control
+
+pytest.importorskip('requests') # worker -> xui_api без requests завершает процесс
+
+import worker
+
+
+@pytest.fixture
+def silent_daemon(tmp_path):
+    """Сокет, который принимает соединение и команду, но не отвечает (демон занят циклом)."""
+    path = str(tmp_path / 'control.sock')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    accepted = []
+    thread = threading.Thread(target=lambda: accepted.append(listener.accept()[0]), daemon=True)
+    thread.start()
+    yield path
+    thread.join(1)
+    for conn in accepted:
+        conn.close()
+    listener.close()
+
+
+def test_send_command_without_daemon(tmp_path):
+    assert control.send_command('ping', socket_path=str(tmp_path / 'missing.sock')) is None
+
+def test_send_command_timeout_is_not_unavailable(silent_daemon):
+    response = control.send_command('set_limit', socket_path=silent_daemon, timeout=0.2, email='a', limit=5)
+    assert response['ok'] is False
+    assert response['timeout'] is True
+
+def test_control_timeout_covers_cycle_budget():
+    assert worker.control_timeout({}) > worker.DEFAULT_CYCLE_BUDGET_SEC
+    assert worker.control_timeout({'cycle_budget_sec': 120}) >= 2 * 120
+    assert worker.control_timeout({'cycle_budget_sec': 0}) == control.CONTROL_UNBOUNDED_TIMEOUT
+
+
+@pytest.fixture
+def runtime(monkeypatch):
+    saved = []
+    monkeypatch.setattr(worker.config_manager, 'save_user_limits', lambda limits: saved.append(dict(limits)) or True)
+    runtime = worker.WorkerRuntime({}, {'a': 10})
+    runtime.next_cycle_at = time.monotonic() + 600
+    runtime.saved_limits = saved
+    return runtime
+
+def test_limit_update_without_cache_schedules_cycle(runtime, monkeypatch):
+    monkeypatch.setattr(worker, 'replan_from_cache', lambda runtime: False)
+    response = worker._apply_limits_update(runtime, {'b': 20}, ())
+    assert response['changed'] and not response['applied'] and response['cycle_scheduled']
+    assert runtime.next_cycle_at <= time.monotonic()
+    assert runtime.saved_limits == [{'a': 10, 'b': 20}]
+
+def test_limit_update_with_cache_keeps_schedule(runtime, monkeypatch):
+    monkeypatch.setattr(worker, 'replan_from_cache', lambda runtime: True)
+    response = worker._apply_limits_update(runtime, {}, ['a'])
+    assert response['applied'] and not response['cycle_scheduled']
+    assert runtime.next_cycle_at > time.monotonic()
+    assert runtime.user_limits == {}
+
+def test_unchanged_limits_do_nothing(runtime, monkeypatch):
+    monkeypatch.setattr(worker, 'replan_from_cache', lambda runtime: pytest.fail('replan'))
+    assert worker._apply_limits_update(runtime, {'a': 10}, ()) == {'changed': False, 'applied': False}
+    assert runtime.saved_limits == []
@@ -0,0 +1,91 @@
+"""Тесты раскладки правил по IP в таблицах u32 (HandleAllocator) и команд tc для нее."""
+
+import common
+import tc_manager
+
+TC_SHOW = """\
+filter protocol ip pref 5000 u32 chain 0 
+filter protocol ip pref 5000 u32 chain 0 fh 501: ht divisor 1 
+filter protocol ip pref 5000 u32 chain 0 fh 501::1 order 1 key ht 501 bkt 0 *flowid :1 not_in_hw 
+  match 0a090000/ffffff00 at 16
+filter protocol ip pref 5000 u32 chain 0 fh 500: ht divisor 256 
+filter protocol ip pref 5000 u32 chain 0 fh 500:1:1 order 1 key ht 500 bkt 1 *flowid :1 not_in_hw 
+  match 7f000001/ffffffff at 16
+filter protocol ip pref 5000 u32 chain 0 fh 500:2a:2 order 2 key ht 500 bkt 2a *flowid :1 not_in_hw 
+  match 0a00012a/ffffffff at 16
+filter protocol ip pref 5000 u32 chain 0 fh 800: ht divisor 1 
+filter protocol ip pref 5000 u32 chain 0 fh 800::1 order 1 key ht 800 bkt 0 link 500: not_in_hw 
+  match 00000000/00000000 at 0
+    hash mask 000000ff at 16 
+filter protocol ip pref 5000 u32 chain 0 fh 800::2 order 2 key ht 800 bkt 0 link 501: not_in_hw 
+  match 00000000/00000000 at 0
+"""
+
+
+def test_addresses_hashed_by_last_octet():
+    allocator = tc_manager.HandleAllocator()
+    assert allocator.allocate('10.0.0.42') == f'{common.TC_U32_HTID}:2a:1'
+    assert allocator.allocate('10.0.1.42') == f'{common.TC_U32_HTID}:2a:2'
+    assert allocator.allocate('10.0.0.1') == f'{common.TC_U32_HTID}:1:1'
+    assert allocator.allocate('10.0.0.42') == f'{common.TC_U32_HTID}:2a:1' # Постоянный handle
+    assert allocator.allocate('10.0.0.7/32') == f'{common.TC_U32_HTID}:7:1'
+
+def test_prefixes_and_ipv6_use_own_tables():
+    allocator = tc_manager.HandleAllocator()
+    assert allocator.allocate('10.9.0.0/24') == f'{common.TC_U32_PREFIX_HTID}::1'
+    assert allocator.allocate('10.8.0.0/16') == f'{common.TC_U32_PREFIX_HTID}::2'
+    assert allocator.allocate('2001:db8::/64') == '1'
+    assert allocator.allocate('2001:db8::1') == '2'
+    assert allocator.allocate('10.0.0.1') == f'{common.TC_U32_HTID}:1:1'
+
+def test_capacity_is_per_bucket():
+    allocator = tc_manager.HandleAllocator(max_node=2)
+    ips = [f'10.{a}.{b}.{c}' for a in range(2) for b in range(1) for c in range(256)] # 2 адреса на корзину
+    assert all(allocator.allocate(ip) is not None for ip in ips)
+    assert not allocator.overflow
+    assert allocator.allocate('10.5.0.0') is None # Третий адрес корзины 0
+    assert allocator.overflow == {'10.5.0.0'}
+    assert allocator.allocate('2001:db8::5') is not None # Другие таблицы не затронуты
+
+def test_release_reuses_node_in_same_bucket():
+    allocator = tc_manager.HandleAllocator(max_node=1)
+    handle = allocator.allocate('10.0.0.42')
+    allocator.release('10.0.0.42')
+    assert allocator.allocate('10.0.5.42') == handle
+    allocator.release('2001:db8::1') # Неизвестный IP - ничего не делает
+    allocator.allocate('2001:db8::1')
+    allocator.release('2001:db8::1')
+    assert allocator.allocate('2001:db8::2') == '1'
+
+def test_state_roundtrip_and_legacy_state_rejected():
+    allocator = tc_manager.HandleAllocator()
+    for ip in ('10.0.0.42', '10.9.0.0/24', '2001:db8::1'):
+        allocator.allocate(ip)
+    allocator.release('10.0.0.42')
+    restored = tc_manager.HandleAllocator()
+    assert restored.load(allocator.to_dict())
+    assert restored.handles == allocator.handles
+    assert restored.allocate('10.0.1.42') == f'{common.TC_U32_HTID}:2a:1'
+    legacy = {'htid': '500', 'handles': {'10.0.0.1': 1}, 'free': [], 'next_node': 2}
+    assert not tc_manager.HandleAllocator().load(legacy)
+
+def test_rule_commands_target_handle_table():
+    upload, download = tc_manager._rule_commands('eth0', '10.0.0.42', 10, f'{common.TC_U32_HTID}:2a:1')
+    assert upload[upload.index('ht') + 1] == f'{common.TC_U32_HTID}:2a:'
+    assert download[download.index('ht') + 1] == f'{common.TC_U32_HTID}:2a:'
+    upload, _ = tc_manager._rule_commands('eth0', '10.9.0.0/24', 10, f'{common.TC_U32_PREFIX_HTID}::3')
+    assert upload[upload.index('ht') + 1] == f'{common.TC_U32_PREFIX_HTID}:'
+
+def test_table_links_hash_client_address():
+    commands = tc_manager._u32_table_commands('eth0')
+    links = [command for command in commands if 'hashkey' in command]
+    assert [(command[command.index('parent') + 1], command[-1]) for command in links] == [('1:0', '12'), ('ffff:', '16')]
+    assert all(command[command.index('mask') + 1] == '0x000000ff' for command in links)
+    divisors = [command[-1] for command in commands if 'divisor' in command]
+    assert divisors == [str(common.TC_U32_DIVISOR), '1'] * 2
+
+def test_sanity_check_counts_only_rules():
+    assert sum(1 for line in TC_SHOW.splitlines() if tc_manager._U32_RULE_HANDLE_RE.search(line)) == 3
+
+def test_counters_parsed_from_hashed_layout():
+    assert set(tc_manager.parse_filter_counters(TC_SHOW)) == {'10.9.0.0/24', '127.0.0.1', '10.0.1.42'}
@@ -0,0 +1,64 @@
+"""Тесты параллельного получения IP: окно запросов по адаптивному лимиту панели и остановка по бюджету цикла."""
+
+import threading
+import time
+import types
+
+import pytest
+
+pytest.importorskip('requests') # worker -> xui_api без requests завершает процесс
+
+import worker
+import xui_api
+
+
+class _SlowPanel:
+    """Клиент API, который отвечает через delay секунд и считает одновременные запросы."""
+
+    def __init__(self, limit, delay):
+        self.limiter = xui_api.AdaptiveConcurrencyLimiter(max_limit=8)
+        self.limiter.limit = float(limit)
+        self.delay = delay
+        self.started = []
+        self.in_flight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def get_client_ip_addresses(self, user_email, method=None):
+        with self._lock:
+            self.started.append(user_email)
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        time.sleep(self.delay)
+        with self._lock:
+            self.in_flight -= 1
+        return ['198.51.100.%d' % (len(user_email) % 250 + 1)]
+
+def _runtime(api_client, workers=8):
+    return types.SimpleNamespace(config={'ip_fetch_workers': workers}, user_ips={}, ips_refreshed_at={},
+                                 get_api_client=lambda deadline=None: api_client)
+
+USERS = ['user%02d@example' % index for index in range(20)]
+
+
+def test_in_flight_requests_bounded_by_limiter():
+    panel = _SlowPanel(limit=2, delay=0.02)
+    resolved, failed, deferred = worker._resolve_user_ips(_runtime(panel), USERS)
+    assert (resolved, failed, deferred) == (len(USERS), 0, 0)
+    assert panel.peak <= 2
+    assert sorted(panel.started) == USERS
+
+def test_window_capped_by_workers_and_unlimited_clients():
+    assert worker._ip_fetch_window(_SlowPanel(limit=6, delay=0), 4) == 4
+    assert worker._ip_fetch_window(_SlowPanel(limit=0.5, delay=0), 4) == 1
+    assert worker._ip_fetch_window(types.SimpleNamespace(limiter=None), 4) == 4
+
+def test_exhausted_budget_stops_sending_requests():
+    panel = _SlowPanel(limit=2, delay=0.3)
+    deadline = time.monotonic() + xui_api.MIN_REQUEST_TIMEOUT + 0.1
+    resolved, failed, deferred = worker._resolve_user_ips(_runtime(panel), USERS, deadline=deadline)
+    assert resolved + deferred == len(USERS)
+    assert len(panel.started) <= resolved + 2 # Кроме завершенных - не больше окна
+    sent = len(panel.started)
+    time.sleep(0.5)
+    assert len(panel.started) == sent # После исчерпания бюджета очередь в панель не уходит
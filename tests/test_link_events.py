@@ -0,0 +1,72 @@
+"""
+Тесты подписки на события интерфейсов: BPF-фильтр сокета LinkWatcher (исполняется здесь
+небольшим интерпретатором classic BPF) и разбор сообщений rtnetlink.
+"""
+
+import pytest
+
+import system_utils
+
+RTM_NEWQDISC = 36
+RTM_NEWTFILTER = 44
+RTM_DELTFILTER = 45
+
+
+def _run_filter(packet):
+    """Исполняет link_events_filter() над сообщением так же, как ядро (загрузки BPF_ABS - сетевой порядок)."""
+    raw = system_utils.link_events_filter()
+    program = [system_utils._SOCK_FILTER.unpack_from(raw, offset)
+               for offset in range(0, len(raw), system_utils._SOCK_FILTER.size)]
+    pc, accumulator = 0, 0
+    while True:
+        code, jt, jf, k = program[pc]
+        if code == system_utils._BPF_RET_K:
+            return k
+        if code in (system_utils._BPF_LD_H_ABS, system_utils._BPF_LD_W_ABS):
+            size = 2 if code == system_utils._BPF_LD_H_ABS else 4
+            if k + size > len(packet):
+                return 0 # Выход за границы пакета - ядро отбрасывает сообщение
+            accumulator = int.from_bytes(packet[k:k + size], 'big')
+            pc += 1
+        elif code == system_utils._BPF_JEQ_K:
+            pc += 1 + (jt if accumulator == k else jf)
+        else:
+            raise AssertionError('неизвестная инструкция %#x' % code)
+
+
+def _tc_message(msg_type, ifindex=1, handle=0, parent=system_utils.TC_H_ROOT):
+    payload = system_utils._TCMSG.pack(0, ifindex, handle, parent, 0)
+    return system_utils._NLMSG_HEADER.pack(system_utils._NLMSG_HEADER.size + len(payload), msg_type, 0, 0, 0) + payload
+
+
+def _link_message(name):
+    ifname = name.encode() + b'\0'
+    attr = system_utils._RTATTR.pack(system_utils._RTATTR.size + len(ifname), system_utils.IFLA_IFNAME) + ifname
+    attr += b'\0' * (-len(attr) % 4)
+    payload = system_utils._IFINFOMSG.pack(0, 0, 1, 0, 0) + attr
+    return system_utils._NLMSG_HEADER.pack(system_utils._NLMSG_HEADER.size + len(payload),
+                                           system_utils.RTM_NEWLINK, 0, 0, 0) + payload
+
+
+@pytest.mark.parametrize('packet', [
+    _link_message('eth0'),
+    _tc_message(system_utils.RTM_DELQDISC, parent=system_utils.TC_H_ROOT, handle=0x10000),
+    _tc_message(system_utils.RTM_DELQDISC, parent=system_utils.TC_H_INGRESS, handle=0xFFFF0000),
+])
+def test_filter_accepts_link_and_base_qdisc_events(packet):
+    assert _run_filter(packet) != 0
+
+
+@pytest.mark.parametrize('packet', [
+    _tc_message(RTM_NEWTFILTER, parent=0x10000),  # tc filter replace демона
+    _tc_message(RTM_DELTFILTER, parent=0x10000),
+    _tc_message(RTM_NEWQDISC),                    # qdisc создан - база не пропала
+    _tc_message(system_utils.RTM_DELQDISC, parent=0x10001),  # дочерний qdisc класса
+])
+def test_filter_drops_own_tc_changes(packet):
+    assert _run_filter(packet) == 0
+
+
+def test_parse_ignores_filter_messages():
+    data = _tc_message(RTM_NEWTFILTER, parent=0x10000) + _link_message('eth1')
+    assert system_utils.parse_link_events(data) == {'eth1'}
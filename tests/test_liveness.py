@@ -0,0 +1,129 @@
+"""Тесты проверки живости IP (ip_liveness): sock_diag для TCP, conntrack для клиентов UDP inbound."""
+
+import json
+import types
+
+import pytest
+
+pytest.importorskip('requests') # xui_api без requests завершает процесс
+
+import system_utils
+import worker
+import xui_api
+
+TCP_PORT, UDP_PORT = 443, 8443
+
+
+def _inbound(port, protocol='vless', stream=None, settings=None, emails=()):
+    settings = dict(settings or {}, clients=[{'email': email} for email in emails])
+    return {'id': port, 'port': port, 'protocol': protocol, 'enable': True, 'settings': json.dumps(settings),
+            'streamSettings': json.dumps(stream or {'network': 'tcp'}),
+            'clientStats': [{'email': email, 'enable': True} for email in emails]}
+
+@pytest.fixture
+def snapshot():
+    return xui_api.InboundSnapshot.from_inbounds([
+        _inbound(TCP_PORT, emails=['tcp-user']),
+        _inbound(UDP_PORT, protocol='hysteria2', emails=['udp-user']),
+    ])
+
+def _runtime(snapshot, **config):
+    config.setdefault('ip_liveness', worker.IP_LIVENESS_SOCK_DIAG)
+    return types.SimpleNamespace(config=config, inbound_snapshot=snapshot, timings={},
+                                 live_ips=None, liveness_exempt_ports=set())
+
+@pytest.fixture
+def sources(monkeypatch):
+    """Подменяет sock_diag и conntrack; значения источников задает тест."""
+    state = {'sock_diag': {'198.51.100.1'}, 'conntrack': {'203.0.113.7'}, 'calls': []}
+    def sockets(ports, protocols):
+        state['calls'].append(('sock_diag', set(ports), protocols))
+        return None if state['sock_diag'] is None else set(state['sock_diag'])
+    def conntrack(ports, protocols):
+        state['calls'].append(('conntrack', set(ports), protocols))
+        return None if state['conntrack'] is None else set(state['conntrack'])
+    monkeypatch.setattr(system_utils, 'read_socket_peer_ips', sockets)
+    monkeypatch.setattr(system_utils, 'read_conntrack_client_ips', conntrack)
+    return state
+
+
+@pytest.mark.parametrize('inbound, udp', [
+    (_inbound(1, protocol='hysteria'), True),
+    (_inbound(1, protocol='wireguard'), True),
+    (_inbound(1, stream={'network': 'kcp'}), True),
+    (_inbound(1, stream={'network': 'quic'}), True),
+    (_inbound(1, protocol='shadowsocks', settings={'network': 'tcp,udp'}), True),
+    (_inbound(1, protocol='shadowsocks', settings={'network': 'tcp'}), False),
+    (_inbound(1, stream={'network': 'ws'}), False),
+])
+def test_snapshot_detects_udp_inbounds(inbound, udp):
+    inbound['clientStats'] = [{'email': 'a'}]
+    snapshot = xui_api.InboundSnapshot.from_inbounds([inbound])
+    assert snapshot.udp_ports() == ({1} if udp else set())
+
+def test_configured_ports_with_protocol():
+    config = {'xray_inbound_ports': [443, '8443/udp', '8443/tcp', ' 53/UDP', '80/tcp', 'bad', True, 70000]}
+    assert worker._configured_inbound_ports(config) == {443: False, 8443: True, 53: True, 80: False}
+    assert worker._configured_inbound_ports({}) is None
+
+
+def test_sock_diag_and_conntrack_combined(snapshot, sources):
+    runtime = _runtime(snapshot)
+    worker._refresh_live_ips(runtime)
+    assert runtime.live_ips == {'198.51.100.1', '203.0.113.7'}
+    assert runtime.liveness_exempt_ports == set()
+    assert sources['calls'] == [('sock_diag', {TCP_PORT, UDP_PORT}, (worker.socket.IPPROTO_TCP,)),
+                                ('conntrack', {UDP_PORT}, ('udp',))]
+
+def test_sock_diag_without_conntrack_exempts_only_udp_users(snapshot, sources):
+    sources['conntrack'] = None
+    runtime = _runtime(snapshot)
+    worker._refresh_live_ips(runtime)
+    assert runtime.live_ips == {'198.51.100.1'} # TCP-проверка продолжает работать
+    assert runtime.liveness_exempt_ports == {UDP_PORT}
+    assert worker._liveness_exempt(runtime, 'udp-user')
+    assert not worker._liveness_exempt(runtime, 'tcp-user')
+    assert worker._liveness_exempt(runtime, 'unknown-user') # Порт неизвестен - не отбрасываем
+
+def test_sock_diag_without_udp_inbounds_skips_conntrack(sources):
+    snapshot = xui_api.InboundSnapshot.from_inbounds([_inbound(TCP_PORT, emails=['tcp-user'])])
+    runtime = _runtime(snapshot)
+    worker._refresh_live_ips(runtime)
+    assert runtime.live_ips == {'198.51.100.1'}
+    assert [call[0] for call in sources['calls']] == ['sock_diag']
+    assert not worker._liveness_exempt(runtime, 'tcp-user')
+
+def test_configured_udp_ports_without_snapshot(sources):
+    sources['conntrack'] = None
+    runtime = _runtime(None, xray_inbound_ports=[TCP_PORT, f'{UDP_PORT}/udp'])
+    worker._refresh_live_ips(runtime)
+    assert runtime.live_ips == {'198.51.100.1'}
+    assert runtime.liveness_exempt_ports == {UDP_PORT}
+    assert worker._liveness_exempt(runtime, 'any-user') # Без снимка порт пользователя неизвестен
+
+def test_sock_diag_unavailable_skips_check(snapshot, sources):
+    sources['sock_diag'] = None
+    runtime = _runtime(snapshot)
+    worker._refresh_live_ips(runtime)
+    assert runtime.live_ips is None
+    assert [call[0] for call in sources['calls']] == ['sock_diag']
+
+
+def test_apply_plan_prunes_only_tcp_users(snapshot, sources, monkeypatch):
+    sources['conntrack'] = None
+    applied = {}
+    def apply_tc_rules(interfaces, plan, allocator):
+        applied.update(plan)
+        allocator.handles.update({ip: node for node, ip in enumerate(plan, 1)})
+        return len(plan)
+    monkeypatch.setattr(worker.tc_manager, 'apply_tc_rules', apply_tc_rules)
+    monkeypatch.setattr(worker.config_manager, 'save_applied_plan', lambda data: True)
+
+    runtime = worker.WorkerRuntime({'iface': 'eth0', 'ip_liveness': worker.IP_LIVENESS_SOCK_DIAG,
+                                    'ipv6_match_prefix': 128}, {'tcp-user': 10, 'udp-user': 20})
+    runtime.inbound_snapshot = snapshot
+    runtime.user_ips = {'tcp-user': ['198.51.100.1', '198.51.100.2'], 'udp-user': ['203.0.113.9']}
+    worker._refresh_live_ips(runtime)
+    worker._apply_plan(runtime, {'tcp-user', 'udp-user'})
+    # Отключившийся TCP-клиент отброшен, UDP-клиент без conntrack сохранил лимит
+    assert applied == {'198.51.100.1': 10, '203.0.113.9': 20}
@@ -0,0 +1,233 @@
+"""
+Тесты XrayStatsClient против локального gRPC-сервера-заглушки StatsService:
+ручное кодирование protobuf, разбор списков IP, трафик и пути ошибок.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip('requests') # xui_api без requests завершает процесс
+grpc = pytest.importorskip('grpc')
+
+import xui_api
+from xui_api import _pb_bool, _pb_fields, _pb_string, _pb_varint
+
+STATS_METHODS = ('QueryStats', 'GetStatsOnline', 'GetStatsOnlineIpList', 'GetAllOnlineUsers')
+
+
+def _pb_int(number, value):
+    """Поле int64 (wire type 0), отрицательные значения - в дополнительном коде."""
+    return _pb_varint(number << 3) + _pb_varint(value & 0xFFFFFFFFFFFFFFFF)
+
+def _pb_message(number, data):
+    """Вложенное сообщение (wire type 2)."""
+    return _pb_varint(number << 3 | 2) + _pb_varint(len(data)) + data
+
+def stats_response(stats):
+    """QueryStatsResponse/GetStatsResponse: repeated Stat{name=1, value=2}."""
+    return b''.join(_pb_message(1, _pb_string(1, name) + _pb_int(2, value)) for name, value in stats)
+
+def ip_list_response(name, ips):
+    """GetStatsOnlineIpListResponse{name=1, ips=2 map<string, int64>}."""
+    return _pb_string(1, name) + b''.join(_pb_message(2, _pb_string(1, ip) + _pb_int(2, seen))
+                                          for ip, seen in ips.items())
+
+
+class StubStatsService:
+    """
+    StatsService без сериализаторов: обработчики получают и возвращают bytes.
+    handlers: { метод: функция(request) -> bytes или grpc.StatusCode (ответ ошибкой) }.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.requests = []
+        self.server = grpc.server(ThreadPoolExecutor(max_workers=8))
+        method_handlers = {method: grpc.unary_unary_rpc_method_handler(self._handler(method))
+                           for method in STATS_METHODS}
+        self.server.add_generic_rpc_handlers(
+            (grpc.method_handlers_generic_handler(xui_api.XRAY_STATS_SERVICE, method_handlers),))
+        self.port = self.server.add_insecure_port('127.0.0.1:0')
+        self.address = f'127.0.0.1:{self.port}'
+
+    def _handler(self, method):
+        def handle(request, context):
+            self.requests.append((method, request))
+            handler = self.handlers.get(method)
+            result = handler(request) if handler else grpc.StatusCode.UNIMPLEMENTED
+            if isinstance(result, grpc.StatusCode):
+                context.abort(result, f'stub: {method}')
+            return result
+        return handle
+
+    def calls(self, method):
+        return [request for called, request in self.requests if called == method]
+
+
+class FakeRpcError(grpc.RpcError):
+    def __init__(self, code):
+        self._code = code
+
+    def code(self):
+        return self._code
+
+
+@pytest.fixture
+def stub():
+    service = StubStatsService()
+    service.server.start()
+    yield service
+    service.server.stop(0)
+
+@pytest.fixture
+def client(stub):
+    api_client = xui_api.XrayStatsClient(api_address=stub.address)
+    yield api_client
+    api_client.close()
+
+
+# --- Кодирование protobuf ---
+
+def test_varint_matches_protobuf_encoding():
+    assert _pb_varint(0) == b'\x00'
+    assert _pb_varint(1) == b'\x01'
+    assert _pb_varint(300) == b'\xac\x02'
+    assert _pb_varint(2 ** 63) == b'\x80\x80\x80\x80\x80\x80\x80\x80\x80\x01'
+
+def test_string_and_bool_fields():
+    assert _pb_string(1, 'user>>>') == b'\x0a\x07user>>>'
+    assert _pb_string(1, 'é') == b'\x0a\x02\xc3\xa9'
+    assert _pb_bool(2, True) == b'\x10\x01'
+    assert _pb_bool(2, False) == b''
+
+def test_fields_decode_nested_and_negative_values():
+    data = _pb_string(1, 'name') + _pb_int(2, -5) + _pb_int(3, 2 ** 40)
+    assert _pb_fields(data) == [(1, b'name'), (2, -5), (3, 2 ** 40)]
+
+def test_fields_skip_fixed_width_fields():
+    data = _pb_varint(4 << 3 | 1) + b'\x00' * 8 + _pb_varint(5 << 3 | 5) + b'\x00' * 4 + _pb_int(6, 7)
+    assert _pb_fields(data) == [(6, 7)]
+
+@pytest.mark.parametrize('data', [
+    b'\x80',                            # Обрезанный varint
+    b'\x0a\x05abc',                     # Длина поля больше сообщения
+    _pb_varint(1 << 3 | 3) + b'\x00',   # Устаревшая группа (wire type 3)
+])
+def test_fields_reject_corrupted_messages(data):
+    with pytest.raises(ValueError):
+        _pb_fields(data)
+
+def test_stats_decoding():
+    data = stats_response([('user>>>a>>>traffic>>>uplink', 10), ('inbound>>>in>>>traffic>>>downlink', 7)])
+    assert xui_api._pb_stats(data) == [('user>>>a>>>traffic>>>uplink', 10), ('inbound>>>in>>>traffic>>>downlink', 7)]
+
+
+# --- _parse_ip_list ---
+
+def test_parse_ip_list_orders_by_last_seen():
+    response = ip_list_response('user>>>a>>>online', {'10.0.0.1': 100, '10.0.0.2': 300, '2001:db8::1': 200})
+    assert xui_api.XrayStatsClient._parse_ip_list('a', response) == ['10.0.0.2', '2001:db8::1', '10.0.0.1']
+
+def test_parse_ip_list_ties_sorted_by_address():
+    response = ip_list_response('user>>>a>>>online', {'10.0.0.9': 5, '10.0.0.3': 5})
+    assert xui_api.XrayStatsClient._parse_ip_list('a', response) == ['10.0.0.3', '10.0.0.9']
+
+def test_parse_ip_list_empty_response():
+    assert xui_api.XrayStatsClient._parse_ip_list('a', b'') == []
+
+def test_parse_ip_list_not_found_means_offline():
+    assert xui_api.XrayStatsClient._parse_ip_list('a', FakeRpcError(grpc.StatusCode.NOT_FOUND)) == []
+
+@pytest.mark.parametrize('response', [
+    FakeRpcError(grpc.StatusCode.UNAVAILABLE),
+    FakeRpcError(grpc.StatusCode.DEADLINE_EXCEEDED),
+    b'\x12\x05abc',                     # Обрезанная запись map
+])
+def test_parse_ip_list_errors_return_none(response):
+    assert xui_api.XrayStatsClient._parse_ip_list('a', response) is None
+
+
+# --- Вызовы через gRPC ---
+
+def test_online_users_and_ip_batch(stub, client):
+    stub.handlers['GetAllOnlineUsers'] = lambda request: (_pb_string(1, 'user>>>a>>>online')
+                                                           + _pb_string(1, 'user>>>b>>>online'))
+    ips = {'user>>>a>>>online': {'1.1.1.1': 10, '2.2.2.2': 20}}
+    def ip_list(request):
+        name = _pb_fields(request)[0][1].decode()
+        return ip_list_response(name, ips[name]) if name in ips else grpc.StatusCode.NOT_FOUND
+    stub.handlers['GetStatsOnlineIpList'] = ip_list
+
+    assert client.get_online_users_emails() == {'a', 'b'}
+    assert sorted(stub.calls('GetStatsOnlineIpList')) == [_pb_string(1, 'user>>>a>>>online'),
+                                                          _pb_string(1, 'user>>>b>>>online')]
+    assert client.get_client_ip_addresses('a') == ['2.2.2.2', '1.1.1.1']
+    assert client.get_client_ip_addresses('b') == []
+    assert len(stub.calls('GetStatsOnlineIpList')) == 2 # IP взяты из пачки, без повторных вызовов
+
+def test_ip_lookup_outside_batch(stub, client):
+    stub.handlers['GetStatsOnlineIpList'] = lambda request: ip_list_response('user>>>c>>>online', {'3.3.3.3': 1})
+    assert client.get_client_ip_addresses('c') == ['3.3.3.3']
+    assert stub.calls('GetStatsOnlineIpList') == [_pb_string(1, 'user>>>c>>>online')]
+
+def test_online_fallback_without_get_all_online_users(stub, client):
+    stub.handlers['QueryStats'] = lambda request: stats_response([
+        ('user>>>a>>>traffic>>>uplink', 1), ('user>>>b>>>traffic>>>downlink', 2), ('inbound>>>in>>>traffic>>>uplink', 3)])
+    stub.handlers['GetStatsOnline'] = lambda request: stats_response(
+        [('user>>>a>>>online', 2 if b'>>>a>>>' in request else 0)])
+    stub.handlers['GetStatsOnlineIpList'] = lambda request: grpc.StatusCode.NOT_FOUND
+
+    assert client.get_online_users_emails() == {'a'}
+    assert stub.calls('QueryStats') == [_pb_string(1, 'user>>>')]
+    assert len(stub.calls('GetStatsOnline')) == 2
+
+def test_online_error_returns_none(stub, client):
+    stub.handlers['GetAllOnlineUsers'] = lambda request: grpc.StatusCode.INTERNAL
+    assert client.get_online_users_emails() is None
+
+def test_online_corrupted_response_returns_none(stub, client):
+    stub.handlers['GetAllOnlineUsers'] = lambda request: b'\x0a\x09short'
+    assert client.get_online_users_emails() is None
+
+def test_user_traffic(stub, client):
+    stub.handlers['QueryStats'] = lambda request: stats_response([
+        ('user>>>a>>>traffic>>>uplink', 10), ('user>>>a>>>traffic>>>downlink', 20),
+        ('user>>>b>>>traffic>>>downlink', 5), ('inbound>>>in>>>traffic>>>uplink', 99),
+        ('user>>>c>>>online', 1)])
+    assert client.get_user_traffic(reset=True) == {'a': {'up': 10, 'down': 20}, 'b': {'up': 0, 'down': 5}}
+    assert stub.calls('QueryStats') == [_pb_string(1, 'user>>>') + _pb_bool(2, True)]
+
+def test_user_traffic_error_returns_none(stub, client):
+    stub.handlers['QueryStats'] = lambda request: grpc.StatusCode.UNAVAILABLE
+    assert client.get_user_traffic() is None
+
+def test_traffic_reaches_worker_through_snapshot(stub, client):
+    stub.handlers['QueryStats'] = lambda request: stats_response([
+        ('user>>>a>>>traffic>>>uplink', 10), ('user>>>a>>>traffic>>>downlink', 20)])
+    snapshot = client.get_inbounds_snapshot()
+    assert snapshot.traffic('a') == {'up': 10, 'down': 20, 'total': 0}
+    assert snapshot.is_active('a')
+    assert snapshot.ports() == set() and snapshot.limits() == {}
+    assert client.get_inbounds_snapshot() is snapshot # Из кэша до истечения snapshot_interval
+    assert len(stub.calls('QueryStats')) == 1
+
+    stub.handlers['QueryStats'] = lambda request: grpc.StatusCode.UNAVAILABLE
+    assert client.get_inbounds_snapshot(force=True) is snapshot # При ошибке - прежний снимок
+
+def test_snapshot_disabled(stub, client):
+    client.snapshot_interval = 0
+    assert client.get_inbounds_snapshot() is None
+    assert stub.calls('QueryStats') == []
+
+def test_exhausted_deadline_skips_calls(stub, client):
+    client.deadline = 0 # Момент в прошлом time.monotonic()
+    assert client.get_user_traffic() is None
+    assert client.get_online_users_emails() is None
+    assert client.get_client_ip_addresses('a') is None
+    assert stub.requests == []
+
+def test_unreachable_api_raises_connection_error(monkeypatch):
+    monkeypatch.setattr(xui_api.common, 'API_TIMEOUT', 0.5)
+    with pytest.raises(ConnectionError):
+        xui_api.XrayStatsClient(api_address='127.0.0.1:1')
@@ -0,0 +1,1711 @@
+"""
+Логика воркера xraySpeedLimit (запускается сгенерированным скриптом xray_limit_worker.py).
+- Цикл обновления правил TC: онлайн пользователи -> их IP -> правила tc.
+- Адаптивный интервал опроса: сокращается при изменениях онлайн/IP, растет при стабильности.
+- Режимы запуска: по таймеру systemd (однократный запуск) и демон (постоянный процесс).
+- Демон принимает команды через управляющий Unix-сокет (см. control.py).
+- Несколько интерфейсов ('interfaces'): свой backend и пропускная способность у каждого,
+  правила применяются на всех интерфейсах параллельно.
+- Демон следит за событиями интерфейсов (netlink): пропавшая база TC пересоздается, правила восстанавливаются по кэшу.
+"""
+
+import collections
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback # Для детального логирования ошибок
+
+# Импортируем наши модули
+try:
+    import common
+    import config_manager
+    import xui_api
+    import tc_manager
+    import log_utils
+    import system_utils
+    import control
+    # Импортируем константы для метода получения IP
+    from xui_api import IP_FETCH_API
+except ImportError as e:
+    print(f"[CRITICAL] Ошибка импорта модуля: {e}")
+    sys.exit(1)
+
+# --- Константы Воркера ---
+DEFAULT_LOG_PATH = "/usr/local/x-ui/access.log" # Стандартный путь, если не задан в конфиге
+DEFAULT_LOG_LINES = 500                     # Стандартное кол-во строк, если не задано
+
+# Режимы запуска воркера (config.json: 'worker_mode')
+WORKER_MODE_TIMER = 'timer'
+WORKER_MODE_DAEMON = 'daemon'
+
+# Источник лимитов скорости (config.json: 'limit_source')
+LIMIT_SOURCE_FILE = 'file'   # Только user_limits.json
+LIMIT_SOURCE_PANEL = 'panel' # Поля/метки клиентов панели ('panel_limit_field', 'panel_limit_tag'),
+                             # user_limits.json переопределяет их (0 - снять лимит панели)
+
+# Способ классификации трафика (config.json: 'classification')
+CLASSIFICATION_IP = 'ip'     # u32-фильтры по IP клиентов (онлайн и IP из API)
+CLASSIFICATION_MARK = 'mark' # Статические fw-фильтры по метке сокета outbound Xray (без запросов к API)
+
+# Проверка, что IP клиента все еще подключен ('ip_liveness')
+IP_LIVENESS_OFF = 'off'             # IP из API/лога используются как есть
+IP_LIVENESS_CONNTRACK = 'conntrack' # Только IP с живыми соединениями к портам inbound по таблице conntrack
+IP_LIVENESS_SOCK_DIAG = 'sock_diag' # То же по установленным сокетам inbound (NETLINK_SOCK_DIAG) - только TCP:
+                                    # клиентов UDP inbound (из панели или 'порт/udp' в 'xray_inbound_ports')
+                                    # проверяет conntrack, без него они не отбрасываются
+IP_LIVENESS_MODES = (IP_LIVENESS_OFF, IP_LIVENESS_CONNTRACK, IP_LIVENESS_SOCK_DIAG)
+
+# IP, общий для пользователей с разными лимитами ('shared_ip_mode')
+SHARED_IP_OVERWRITE = 'overwrite'   # Правило IP получает лимит последнего пользователя
+SHARED_IP_CONNECTION = 'connection' # Соединения каждого пользователя (IP + порт из access.log и sock_diag)
+                                    # получают свои правила; остальные соединения IP - наименьший лимит
+
+# IPv6 клиента меняется внутри его сети (адреса приватности), поэтому правило ставится на сеть ('ipv6_match_prefix')
+DEFAULT_IPV6_MATCH_PREFIX = 64
+
+# Интерфейсы шейпинга (config.json: 'interfaces' - [{'name', 'capacity_mbit', 'backend'}], иначе 'iface').
+# backend - способ классификации на интерфейсе (CLASSIFICATION_*), по умолчанию - 'classification'.
+DEFAULT_INTERFACE_CAPACITY_MBIT = 1000 # Скорость корневого класса HTB 1:1
+
+# Шаг таймера systemd (config.json: 'timer_interval_sec'): каждый запуск по таймеру - полный цикл
+DEFAULT_TIMER_INTERVAL_SEC = 60
+
+# Адаптивный интервал опроса - только в режиме демона (config.json: 'poll_interval_min', 'poll_interval_max', 'poll_interval_backoff')
+DEFAULT_POLL_INTERVAL_MIN = 10   # Секунды, при изменениях онлайн/IP
+DEFAULT_POLL_INTERVAL_MAX = 120  # Секунды, предел роста при стабильном состоянии
+DEFAULT_POLL_BACKOFF = 1.5       # Множитель роста интервала за стабильный цикл
+
+# Бюджет времени одного цикла (config.json: 'cycle_budget_sec', 0 - без ограничения)
+DEFAULT_CYCLE_BUDGET_SEC = 45    # Секунды на вход, онлайн и получение IP; применение правил не ограничивается
+
+# Параллельное получение IP и поэтапное применение правил
+DEFAULT_IP_FETCH_WORKERS = 4             # 'ip_fetch_workers': параллельных запросов IP (1 - последовательно)
+DEFAULT_APPLY_BATCH_USERS = 8            # 'apply_batch_users': изменений IP до промежуточного применения
+DEFAULT_APPLY_FLUSH_INTERVAL_SEC = 1.0   # 'apply_flush_interval_sec': не реже этого интервала при наличии изменений
+
+# Удержание последних правил при недоступности панели (config.json: 'panel_failure_grace_sec', 0 - не удерживать)
+DEFAULT_PANEL_FAILURE_GRACE_SEC = 600
+
+# Задержка для сбора серии inotify-событий от одной записи файла (секунды)
+CONFIG_CHANGE_DEBOUNCE_SEC = 0.05
+# Задержка для сбора серии событий интерфейса (пересоздание, переименование udev)
+LINK_EVENT_DEBOUNCE_SEC = 0.5
+
+# Статусы результата цикла
+CYCLE_OK = 'ok'       # Правила применены по актуальным данным
+CYCLE_IDLE = 'idle'   # Ограничивать некого (нет лимитов/онлайн), правила очищены
+CYCLE_ERROR = 'error' # Цикл прерван ошибкой (конфиг, API)
+
+# Способ применения плана в последнем цикле (поле 'tc' в сводке)
+APPLY_SKIP = 'skip'       # Отпечаток не изменился, ядро в порядке - tc не трогали
+APPLY_SYNC = 'sync'       # Применена разница с установленным планом
+APPLY_REBUILD = 'rebuild' # Полная пересборка правил
+APPLY_CLEAR = 'clear'     # Все динамические правила сняты
+
+# --- Логирование Воркера ---
+_logger = log_utils.get_logger('worker')
+_stop_event = threading.Event() # Флаг остановки демона (SIGTERM/SIGINT)
+
+def log_worker(level, message, *args):
+    """Логирование сообщений воркера (аргументы подставляются лениво, только для включенного уровня)."""
+    _logger.log(log_utils.LOG_LEVELS.get(level.lower(), logging.INFO), message, *args)
+
+def _digest(data):
+    """Короткий стабильный отпечаток JSON-совместимых данных (для сравнения между циклами)."""
+    encoded = json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+def _cycle_result(status, online_users=None, user_ips=None):
+    """Формирует результат цикла с отпечатками онлайн-множества и карты IP."""
+    return {
+        'status': status,
+        'online_digest': _digest(sorted(online_users)) if online_users is not None else None,
+        'ip_map_digest': _digest(user_ips) if user_ips is not None else None,
+    }
+
+# --- Данные воркера в памяти процесса ---
+
+# Ключи config.json, от которых зависят данные из API (их изменение требует полного цикла)
+API_CONFIG_KEYS = ("api_url", "api_user", "api_pass", "iface", "ip_fetch_method", "log_file_path", "log_read_lines",
+                   "interfaces", "stats_backend", "xray_api_address", "classification", "ip_liveness", "xray_inbound_ports",
+                   "shared_ip_mode")
+# Ключи config.json, задающие, откуда берутся лимиты (их изменение требует только пересчета)
+LIMIT_CONFIG_KEYS = ("limit_source", "panel_limit_field", "panel_limit_tag")
+
+class WorkerRuntime:
+    """
+    Данные между циклами внутри одного процесса воркера: конфиг, лимиты, API клиент,
+    последнее онлайн-множество и карта IP. В режиме таймера живет один запуск,
+    в режиме демона позволяет пересчитать правила без повторных запросов к API.
+    """
+    def __init__(self, config=None, user_limits=None):
+        self.config = config or {}
+        self.user_limits = user_limits
+        self.api_client = None
+        self._api_client_key = None
+        self.online_users = None   # set email онлайн пользователей (последний успешный запрос)
+        self.user_ips = {}         # {email: [ip, ...]} для онлайн пользователей с лимитами
+        self.ips_refreshed_at = {} # {email: time.time()} последнего успешного получения IP
+        self.plan = {}             # {ip: limit_mbps} - последний примененный план
+        self.panel_ok_at = None    # time.time() последнего успешного ответа панели (список онлайн)
+        self.inbound_snapshot = None # xui_api.InboundSnapshot: статус, срок и трафик клиентов панели
+        self.panel_limits = {}     # {email: limit_mbps} из настроек клиентов панели (limit_source='panel')
+        self.live_ips = None       # set IP с живыми соединениями к inbound (None - проверка выключена/недоступна)
+        self.liveness_exempt_ports = set() # Порты UDP inbound, клиенты которых не проверяются (нет conntrack)
+        self.connection_owners = {} # {(ip, port): email} живых соединений клиентов (shared_ip_mode='connection')
+        self.connection_plan = {}  # {(ip, port): limit_mbps} - установленные правила по соединению
+        self.rule_lifecycle = tc_manager.RuleLifecycle() # Удержание и снятие простаивающих правил
+        self.handle_allocator = tc_manager.HandleAllocator() # Постоянные handle фильтров по IP
+        self.rules_in_sync = False # plan и handle соответствуют ядру (можно применять разницу)
+        self.plan_fingerprint = None # Отпечаток входных данных примененного плана
+        self.mark_fingerprint = None # Отпечаток установленных fw-фильтров меток (None - не установлены)
+        self.ip_cache = xui_api.IpResolutionCache() # Кэш результатов получения IP (переживает пересоздание клиента)
+        self.api_limiter = xui_api.AdaptiveConcurrencyLimiter() # Подобранный лимит запросов к панели
+        self.last_apply_mode = None  # APPLY_* последнего применения
+        self.timings = {}          # Длительности этапов последнего цикла/пересчета (секунды)
+        self.next_cycle_at = 0.0   # time.monotonic() следующего планового цикла (демон)
+
+    def get_api_client(self, deadline=None):
+        """
+        Возвращает API клиент, переиспользуя сессию, пока не изменились параметры подключения.
+
+        Args:
+            deadline (float, optional): Дедлайн запросов текущего цикла (time.monotonic()).
+
+        Raises:
+            ConnectionError: Если не удалось войти в API.
+        """
+        config = self.config
+        self._configure_ip_cache()
+        self._configure_api_limiter()
+        client_key = tuple(config.get(k) for k in API_CONFIG_KEYS)
+        hedge_delay = _hedge_delay(config)
+        snapshot_interval = _snapshot_interval(config)
+        if self.api_client is not None:
+            self.api_client.deadline = deadline
+            self.api_client.hedge_delay = hedge_delay
+            self.api_client.snapshot_interval = snapshot_interval
+        if self.api_client is None or self._api_client_key != client_key:
+            self.reset_api_client()
+            if config.get('stats_backend') == xui_api.STATS_BACKEND_XRAY:
+                address = config.get('xray_api_address', xui_api.DEFAULT_XRAY_API_ADDRESS)
+                log_worker('debug', "Попытка подключения к gRPC API Xray %s", address)
+                self.api_client = xui_api.XrayStatsClient(api_address=address, deadline=deadline,
+                                                          snapshot_interval=snapshot_interval)
+                self._api_client_key = client_key
+                return self.api_client
+            log_worker('debug', "Попытка инициализации API клиента для %s", config['api_url'])
+            self.api_client = xui_api.XUIApiClient(
+                panel_url=config['api_url'],
+                username=config['api_user'],
+                password=config['api_pass'],
+                log_file_path=config.get('log_file_path', DEFAULT_LOG_PATH),  # Передаем параметры лога
+                log_read_lines=config.get('log_read_lines', DEFAULT_LOG_LINES), # в клиент
+                deadline=deadline,
+                ip_cache=self.ip_cache,
+                hedge_delay=hedge_delay,
+                limiter=self.api_limiter,
+                snapshot_interval=snapshot_interval
+            )
+            self._api_client_key = client_key
+            log_worker('debug', "API клиент успешно инициализирован.")
+        return self.api_client
+
+    def reset_api_client(self):
+        """Сбрасывает сессию API (например, после ошибки запроса - вероятно, истекла сессия)."""
+        if self.api_client is not None:
+            self.api_client.close()
+        self.api_client = None
+        self._api_client_key = None
+
+    def _configure_ip_cache(self):
+        """Переносит параметры кэша IP из config.json."""
+        settings = (
+            ('ttl', 'ip_cache_ttl_sec', xui_api.DEFAULT_IP_CACHE_TTL),
+            ('negative_ttl', 'ip_cache_negative_ttl_sec', xui_api.DEFAULT_IP_CACHE_NEGATIVE_TTL),
+            ('max_entries', 'ip_cache_max_entries', xui_api.DEFAULT_IP_CACHE_MAX_ENTRIES),
+        )
+        for attr, key, default in settings:
+            value = self.config.get(key, default)
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                value = default
+            setattr(self.ip_cache, attr, int(value) if attr == 'max_entries' else value)
+
+    def effective_limits(self):
+        """Действующие лимиты: user_limits.json или лимиты панели, переопределенные user_limits.json."""
+        if _limit_source(self.config) != LIMIT_SOURCE_PANEL:
+            return self.user_limits or {}
+        limits = dict(self.panel_limits)
+        limits.update(self.user_limits or {})
+        return limits
+
+    def refresh_panel_limits(self):
+        """Перечитывает лимиты из снимка клиентов панели (при limit_source='panel')."""
+        if _limit_source(self.config) != LIMIT_SOURCE_PANEL or self.inbound_snapshot is None:
+            self.panel_limits = {}
+            return
+        field = self.config.get('panel_limit_field', xui_api.DEFAULT_PANEL_LIMIT_FIELD)
+        tag = self.config.get('panel_limit_tag', xui_api.DEFAULT_PANEL_LIMIT_TAG)
+        limits = self.inbound_snapshot.limits(field if isinstance(field, str) else xui_api.DEFAULT_PANEL_LIMIT_FIELD,
+                                              tag if isinstance(tag, str) else xui_api.DEFAULT_PANEL_LIMIT_TAG)
+        if limits != self.panel_limits:
+            log_worker('info', "Лимиты из панели обновлены: %d клиентов с лимитом.", len(limits))
+            self.panel_limits = limits
+
+    def _configure_api_limiter(self):
+        """Потолок параллельных запросов - 'ip_fetch_workers', порог задержки - 'api_latency_target_sec'."""
+        self.api_limiter.set_max_limit(_int_setting(self.config, 'ip_fetch_workers', DEFAULT_IP_FETCH_WORKERS))
+        target = self.config.get('api_latency_target_sec', xui_api.DEFAULT_API_LATENCY_TARGET)
+        if isinstance(target, bool) or not isinstance(target, (int, float)) or target <= 0:
+            target = xui_api.DEFAULT_API_LATENCY_TARGET
+        self.api_limiter.latency_target = target
+
+    def restore_ip_cache(self):
+        """Теплый старт: загружает непросроченные записи кэша IP из ip_cache.json."""
+        self._configure_ip_cache()
+        self.ip_cache.load(config_manager.load_ip_cache())
+
+    def save_ip_cache(self):
+        config_manager.save_ip_cache(self.ip_cache.to_dict())
+
+    def restore_applied_plan(self):
+        """
+        Восстанавливает последний примененный план и карту IP из applied_plan.json
+        (после перезапуска воркера или в каждом запуске по таймеру). План других интерфейсов игнорируется.
+        """
+        saved = config_manager.load_applied_plan()
+        if not saved:
+            return
+        # Файлы прежних версий хранят один 'iface'
+        saved_interfaces = saved.get('interfaces') or ([saved['iface']] if saved.get('iface') else [])
+        current_interfaces = _ip_interfaces(self.config)
+        if saved_interfaces != current_interfaces:
+            # Интерфейсы, больше не обслуживаемые по IP (убраны или переведены на метки): их правила снимаются
+            stale_interfaces = [name for name in saved_interfaces if name not in current_interfaces]
+            if saved.get('plan') and stale_interfaces:
+                tc_manager.run_on_interfaces(stale_interfaces, tc_manager.clear_dynamic_tc_rules)
+            return
+        if isinstance(saved.get('plan'), dict):
+            self.plan = saved['plan']
+        if isinstance(saved.get('user_ips'), dict):
+            self.user_ips = saved['user_ips']
+        if isinstance(saved.get('ips_refreshed_at'), dict):
+            self.ips_refreshed_at = saved['ips_refreshed_at']
+        if isinstance(saved.get('panel_ok_at'), (int, float)):
+            self.panel_ok_at = saved['panel_ok_at']
+        self.rule_lifecycle.load(saved.get('lifecycle'))
+        # Без сохраненных handle состояние ядра неизвестно - первое применение будет полной пересборкой
+        self.rules_in_sync = self.handle_allocator.load(saved.get('handles'))
+        self.plan_fingerprint = saved.get('fingerprint') if self.rules_in_sync else None
+        if isinstance(saved.get('mark_fingerprint'), str):
+            self.mark_fingerprint = saved['mark_fingerprint']
+        self.connection_owners = _load_connection_items(saved.get('connection_owners'), str)
+        self.connection_plan = _load_connection_items(saved.get('connections'), (int, float))
+        log_worker('debug', "Восстановлен примененный план: %d IP, %d пользователей.", len(self.plan), len(self.user_ips))
+
+    def save_applied_plan(self):
+        """Сохраняет примененный план и карту IP для удержания правил при сбоях панели."""
+        config_manager.save_applied_plan({
+            'interfaces': _ip_interfaces(self.config),
+            'plan': self.plan,
+            'user_ips': self.user_ips,
+            'ips_refreshed_at': self.ips_refreshed_at,
+            'panel_ok_at': self.panel_ok_at,
+            'lifecycle': self.rule_lifecycle.to_dict(),
+            'handles': self.handle_allocator.to_dict(),
+            'fingerprint': self.plan_fingerprint,
+            'mark_fingerprint': self.mark_fingerprint,
+            'connection_owners': [[ip, port, email] for (ip, port), email in self.connection_owners.items()],
+            'connections': [[ip, port, limit] for (ip, port), limit in self.connection_plan.items()],
+            'saved_at': time.time(),
+        })
+
+def _load_connection_items(items, value_types):
+    """{(ip, port): значение} из сохраненного списка [[ip, port, значение], ...] (некорректные записи пропускаются)."""
+    result = {}
+    for item in items if isinstance(items, list) else []:
+        if (isinstance(item, list) and len(item) == 3 and isinstance(item[0], str)
+                and isinstance(item[1], int) and isinstance(item[2], value_types)):
+            result[(item[0], item[1])] = item[2]
+    return result
+
+def _validate_inputs(config, user_limits):
+    """Проверяет конфиг и лимиты перед циклом. Возвращает True, если можно продолжать."""
+    if not config:
+        log_worker('critical', "Ошибка: Конфигурационный файл %s отсутствует или пуст.", common.CONFIG_FILE)
+        return False
+    if not configured_interfaces(config):
+        log_worker('critical', "Ошибка: В %s не задан интерфейс ('iface' или 'interfaces').", common.CONFIG_FILE)
+        return False
+    required_keys = ["api_url", "api_user", "api_pass"]
+    if config.get('stats_backend') == xui_api.STATS_BACKEND_XRAY or not _ip_interfaces(config):
+        required_keys = [] # Панель не нужна: данные из API Xray или классификация по меткам на всех интерфейсах
+    if not all(k in config for k in required_keys):
+        missing = [k for k in required_keys if k not in config]
+        log_worker('critical', "Ошибка: Конфигурационный файл %s неполный. Отсутствуют ключи: %s", common.CONFIG_FILE, ', '.join(missing))
+        return False
+    if config.get('stats_backend') == xui_api.STATS_BACKEND_XRAY and _limit_source(config) == LIMIT_SOURCE_PANEL:
+        # Снимок из API Xray содержит только трафик, настроек клиентов панели в нем нет
+        log_worker('warning', "limit_source='panel' недоступен при stats_backend='%s': действуют только лимиты %s.",
+                   xui_api.STATS_BACKEND_XRAY, common.USER_LIMITS_FILE)
+    if user_limits is None: # Проверяем на None (ошибка загрузки)
+        log_worker('critical', "Ошибка: Не удалось загрузить файл лимитов %s.", common.USER_LIMITS_FILE)
+        return False
+    return True
+
+def _cycle_budget(config):
+    """Бюджет цикла в секундах из 'cycle_budget_sec' или None, если бюджет не ограничен."""
+    budget = config.get('cycle_budget_sec', DEFAULT_CYCLE_BUDGET_SEC)
+    if isinstance(budget, bool) or not isinstance(budget, (int, float)) or budget <= 0:
+        return None
+    return float(budget)
+
+def control_timeout(config):
+    """
+    Таймаут ожидания ответа демона клиентом управляющего сокета: команда может ждать конца текущего
+    цикла и сама запустить цикл ('cycle', пересчет с запросом IP), т.е. до двух бюджетов
+    плюс применение правил, которое в бюджет не входит.
+    """
+    budget = _cycle_budget(config)
+    if budget is None:
+        return control.CONTROL_UNBOUNDED_TIMEOUT
+    return 2 * budget + control.CONTROL_APPLY_MARGIN
+
+def _cycle_deadline(config, started):
+    """Дедлайн цикла (time.monotonic()) или None, если бюджет не ограничен."""
+    budget = _cycle_budget(config)
+    return started + budget if budget is not None else None
+
+def _panel_failure_grace(config):
+    """Срок удержания последних правил при сбоях панели (секунды, 0 - не удерживать)."""
+    grace = config.get('panel_failure_grace_sec', DEFAULT_PANEL_FAILURE_GRACE_SEC)
+    if isinstance(grace, bool) or not isinstance(grace, (int, float)) or grace < 0:
+        return DEFAULT_PANEL_FAILURE_GRACE_SEC
+    return grace
+
+def _hedge_delay(config):
+    """Задержка запуска запроса к логу для метода 'hybrid' (секунды, 0 - сразу оба источника)."""
+    delay = config.get('ip_hedge_delay_sec', xui_api.DEFAULT_HEDGE_DELAY)
+    if isinstance(delay, bool) or not isinstance(delay, (int, float)) or delay < 0:
+        return xui_api.DEFAULT_HEDGE_DELAY
+    return float(delay)
+
+def _snapshot_interval(config):
+    """Срок годности снимка inbounds/list (секунды, 0 - не запрашивать, кроме limit_source='panel')."""
+    interval = config.get('inbound_snapshot_interval_sec', xui_api.DEFAULT_INBOUND_SNAPSHOT_INTERVAL)
+    if isinstance(interval, bool) or not isinstance(interval, (int, float)) or interval < 0:
+        return xui_api.DEFAULT_INBOUND_SNAPSHOT_INTERVAL
+    if interval == 0 and _limit_source(config) == LIMIT_SOURCE_PANEL:
+        return xui_api.DEFAULT_INBOUND_SNAPSHOT_INTERVAL # Без снимка лимиты панели не получить
+    return interval
+
+def _classification(config):
+    """Способ классификации из 'classification' (неизвестное значение - по IP)."""
+    mode = config.get('classification', CLASSIFICATION_IP)
+    return mode if mode in (CLASSIFICATION_IP, CLASSIFICATION_MARK) else CLASSIFICATION_IP
+
+def configured_interfaces(config):
+    """
+    Интерфейсы шейпинга из 'interfaces' или, если список не задан, единственный 'iface'.
+    Некорректные записи и повторы имен пропускаются.
+
+    Returns:
+        list: [{'name': str, 'capacity_mbit': int, 'backend': CLASSIFICATION_IP | CLASSIFICATION_MARK}].
+    """
+    default_backend = _classification(config)
+    entries = config.get('interfaces')
+    if not isinstance(entries, list) or not entries:
+        entries = [{'name': config['iface']}] if isinstance(config.get('iface'), str) and config['iface'] else []
+    interfaces = []
+    for entry in entries:
+        if isinstance(entry, str): # Краткая запись - только имя
+            entry = {'name': entry}
+        name = entry.get('name') if isinstance(entry, dict) else None
+        if not isinstance(name, str) or not name or name in (item['name'] for item in interfaces):
+            log_worker('warning', "Пропуск некорректной записи интерфейса: %s", entry)
+            continue
+        backend = entry.get('backend', default_backend)
+        interfaces.append({
+            'name': name,
+            'capacity_mbit': _int_setting(entry, 'capacity_mbit', DEFAULT_INTERFACE_CAPACITY_MBIT),
+            'backend': backend if backend in (CLASSIFICATION_IP, CLASSIFICATION_MARK) else default_backend,
+        })
+    return interfaces
+
+def _interface_names(config, backend=None):
+    """Имена интерфейсов (только с указанным backend, если он задан)."""
+    return [item['name'] for item in configured_interfaces(config) if backend is None or item['backend'] == backend]
+
+def _ip_interfaces(config):
+    """Интерфейсы с правилами по IP клиентов."""
+    return _interface_names(config, CLASSIFICATION_IP)
+
+def _ip_liveness(config):
+    """Проверка подключенности IP из 'ip_liveness' (неизвестное значение - выключена)."""
+    mode = config.get('ip_liveness', IP_LIVENESS_OFF)
+    return mode if mode in IP_LIVENESS_MODES else IP_LIVENESS_OFF
+
+def _configured_inbound_ports(config):
+    """
+    Порты из 'xray_inbound_ports' config.json: число или строка 'порт/udp' ('порт/tcp') для UDP inbound.
+
+    Returns:
+        dict or None: { порт: True, если inbound принимает клиентов по UDP } или None, если список не задан.
+    """
+    entries = config.get('xray_inbound_ports')
+    if not isinstance(entries, list):
+        return None
+    ports = {}
+    for entry in entries:
+        port, _, protocol = str(entry).partition('/') if isinstance(entry, str) else (entry, '', '')
+        if isinstance(port, str):
+            port = int(port) if port.strip().isdigit() else None
+        if isinstance(port, int) and not isinstance(port, bool) and 0 < port < 65536:
+            ports[port] = ports.get(port, False) or protocol.strip().lower() == 'udp'
+    return ports
+
+def _inbound_ports(runtime):
+    """Порты inbound Xray: 'xray_inbound_ports' из config.json или порты из снимка клиентов панели."""
+    ports = _configured_inbound_ports(runtime.config)
+    if ports is not None:
+        return set(ports)
+    return runtime.inbound_snapshot.ports() if runtime.inbound_snapshot is not None else set()
+
+def _udp_inbound_ports(runtime):
+    """Порты UDP inbound: помеченные '/udp' в 'xray_inbound_ports' или по протоколу/транспорту inbound из снимка."""
+    ports = _configured_inbound_ports(runtime.config)
+    if ports is not None:
+        return {port for port, udp in ports.items() if udp}
+    return runtime.inbound_snapshot.udp_ports() if runtime.inbound_snapshot is not None else set()
+
+def _liveness_exempt(runtime, email):
+    """
+    Не проверять живость IP пользователя: его inbound - UDP без conntrack (liveness_exempt_ports)
+    или порт inbound неизвестен, а UDP inbound есть.
+    """
+    if not runtime.liveness_exempt_ports:
+        return False
+    port = runtime.inbound_snapshot.port(email) if runtime.inbound_snapshot is not None else None
+    return port is None or port in runtime.liveness_exempt_ports
+
+def _refresh_live_ips(runtime):
+    """
+    Обновляет runtime.live_ips по таблице conntrack или сокетам inbound (ip_liveness).
+    При недоступности источника или неизвестных портах проверка пропускается (IP не отбрасываются).
+    """
+    runtime.live_ips = None
+    runtime.liveness_exempt_ports = set()
+    mode = _ip_liveness(runtime.config)
+    if mode == IP_LIVENESS_OFF:
+        return
+    ports = _inbound_ports(runtime)
+    if not ports:
+        log_worker('warning', "ip_liveness: порты inbound неизвестны (задайте 'xray_inbound_ports'). Проверка пропущена.")
+        return
+    started = time.monotonic()
+    if mode == IP_LIVENESS_SOCK_DIAG:
+        runtime.live_ips = system_utils.read_socket_peer_ips(ports, protocols=(socket.IPPROTO_TCP,))
+        # Клиенты UDP inbound не видны в sock_diag (один неподключенный сокет на inbound): их проверяет
+        # conntrack, а без него пользователи UDP inbound не проверяются, чтобы не снять с них лимит
+        udp_ports = _udp_inbound_ports(runtime) if runtime.live_ips is not None else set()
+        if udp_ports:
+            udp_ips = system_utils.read_conntrack_client_ips(udp_ports, protocols=('udp',))
+            if udp_ips is not None:
+                runtime.live_ips |= udp_ips
+            else:
+                runtime.liveness_exempt_ports = udp_ports
+                log_worker('warning', "ip_liveness: таблица conntrack недоступна, клиенты UDP inbound (порты %s) не проверяются.",
+                           ', '.join(map(str, sorted(udp_ports))))
+    else:
+        runtime.live_ips = system_utils.read_conntrack_client_ips(ports)
+    runtime.timings['liveness_s'] = round(time.monotonic() - started, 3)
+    if runtime.live_ips is None:
+        log_worker('warning', "ip_liveness: источник '%s' недоступен. Проверка пропущена.", mode)
+    else:
+        log_worker('debug', "ip_liveness (%s): %d IP с живыми соединениями к портам %s.",
+                   mode, len(runtime.live_ips), ', '.join(map(str, sorted(ports))))
+
+def _shared_ip_mode(config):
+    """Обработка общих IP из 'shared_ip_mode' (неизвестное значение - перезапись лимита)."""
+    mode = config.get('shared_ip_mode', SHARED_IP_OVERWRITE)
+    return mode if mode in (SHARED_IP_OVERWRITE, SHARED_IP_CONNECTION) else SHARED_IP_OVERWRITE
+
+def _refresh_connection_owners(runtime):
+    """
+    Обновляет runtime.connection_owners (shared_ip_mode='connection'): новые соединения берутся
+    из access.log, живость - из сокетов inbound. Соединение остается известным, пока оно живо,
+    даже если его строка уже ушла из хвоста лога. Без sock_diag используются только соединения из лога.
+    """
+    if _shared_ip_mode(runtime.config) != SHARED_IP_CONNECTION:
+        runtime.connection_owners = {}
+        return
+    config = runtime.config
+    logged = xui_api.read_access_log_connections(config.get('log_file_path', DEFAULT_LOG_PATH),
+                                                 config.get('log_read_lines', DEFAULT_LOG_LINES))
+    ports = _inbound_ports(runtime)
+    live = system_utils.read_socket_peer_endpoints(ports) if ports else None
+    owners = dict(runtime.connection_owners)
+    owners.update(logged or {})
+    if live is not None:
+        owners = {endpoint: email for endpoint, email in owners.items() if endpoint in live}
+    else:
+        owners = logged or {}
+    runtime.connection_owners = owners
+    log_worker('debug', "Соединения клиентов: %d известных (в логе %s, живых сокетов %s).", len(owners),
+               len(logged) if logged is not None else '-', len(live) if live is not None else '-')
+
+def _ip_aggregation(config):
+    """
+    Параметры tc_manager.aggregate_ip_prefixes() из config.json ('ip_aggregation', 'ip_aggregation_ipv4_prefix',
+    'ip_aggregation_ipv6_prefix', 'ip_aggregation_min_ips') или None, если агрегация выключена.
+    """
+    mode = config.get('ip_aggregation', tc_manager.AGGREGATION_OFF)
+    if mode not in (tc_manager.AGGREGATION_EXACT, tc_manager.AGGREGATION_PREFIX):
+        return None
+    ipv4_prefix = _int_setting(config, 'ip_aggregation_ipv4_prefix', tc_manager.DEFAULT_AGGREGATION_IPV4_PREFIX, minimum=8)
+    ipv6_prefix = _int_setting(config, 'ip_aggregation_ipv6_prefix', tc_manager.DEFAULT_AGGREGATION_IPV6_PREFIX, minimum=32)
+    return {
+        'mode': mode,
+        'ipv4_prefix': min(ipv4_prefix, 32),
+        'ipv6_prefix': min(ipv6_prefix, 128),
+        'min_ips': _int_setting(config, 'ip_aggregation_min_ips', tc_manager.DEFAULT_AGGREGATION_MIN_IPS),
+    }
+
+def _ipv6_match_prefix(config):
+    """Длина префикса правил IPv6 из 'ipv6_match_prefix' (128 - по точному адресу)."""
+    return min(_int_setting(config, 'ipv6_match_prefix', DEFAULT_IPV6_MATCH_PREFIX, minimum=16), 128)
+
+def _limit_source(config):
+    """Источник лимитов из 'limit_source' (неизвестное значение - user_limits.json)."""
+    source = config.get('limit_source', LIMIT_SOURCE_FILE)
+    return source if source in (LIMIT_SOURCE_FILE, LIMIT_SOURCE_PANEL) else LIMIT_SOURCE_FILE
+
+def _int_setting(config, key, default, minimum=1):
+    """Целочисленный параметр config.json с проверкой нижней границы."""
+    value = config.get(key, default)
+    if isinstance(value, bool) or not isinstance(value, int) or value < minimum:
+        return default
+    return value
+
+def _store_ip_result(runtime, user_email, user_ip_list, grace, ip_fetch_method):
+    """
+    Записывает результат получения IP пользователя в runtime.user_ips.
+
+    Returns:
+        tuple: (статус 'resolved' | 'empty' | 'failed', True если IP пользователя изменились).
+    """
+    previous_ips = runtime.user_ips.get(user_email)
+    if user_ip_list is None:
+        if time.time() - runtime.ips_refreshed_at.get(user_email, 0.0) > grace:
+            if runtime.user_ips.pop(user_email, None):
+                log_worker('warning', "IP пользователя '%s' не обновлялись дольше %d сек. Его правила сняты.", user_email, grace)
+                return 'failed', True
+            return 'failed', False
+        log_worker('debug', "Не удалось получить IP для пользователя '%s' (метод: %s). Остаются прежние IP: %s",
+                   user_email, ip_fetch_method, previous_ips or [])
+        return 'failed', False
+    runtime.user_ips[user_email] = tc_manager.normalize_ips(user_ip_list)
+    runtime.ips_refreshed_at[user_email] = time.time()
+    changed = runtime.user_ips[user_email] != previous_ips
+    if user_ip_list:
+        log_worker('debug', "Пользователь '%s' -> IP: %s (метод: %s)", user_email, user_ip_list, ip_fetch_method)
+        return 'resolved', changed
+    log_worker('debug', "IP для пользователя '%s' не найдены методом '%s'.", user_email, ip_fetch_method)
+    return 'empty', changed
+
+def _ip_fetch_window(api_client, workers):
+    """Сколько запросов IP держать отправленными одновременно: текущий адаптивный лимит панели, не больше workers."""
+    limiter = getattr(api_client, 'limiter', None)
+    if limiter is None:
+        return workers
+    return max(1, min(workers, int(limiter.limit)))
+
+def _resolve_user_ips(runtime, users, deadline=None, flusher=None):
+    """
+    Запрашивает IP для указанных пользователей и обновляет runtime.user_ips.
+    Сначала опрашиваются пользователи без IP в кэше (у них еще нет правил), затем - давно не обновлявшиеся.
+    При ошибке или исчерпании бюджета у пользователя остаются IP прошлого цикла (и его правила),
+    но не дольше panel_failure_grace_sec с последнего успешного получения.
+    При 'ip_fetch_workers' > 1 запросы идут параллельно (окном не шире адаптивного лимита панели),
+    результаты обрабатываются по мере готовности.
+
+    Args:
+        runtime (WorkerRuntime): Данные воркера.
+        users (iterable): Email пользователей.
+        deadline (float, optional): Дедлайн цикла (time.monotonic()), после него запросы не отправляются.
+        flusher (_PipelineFlusher, optional): Поэтапное применение правил по мере изменения IP.
+
+    Returns:
+        tuple: (кол-во пользователей с найденными IP, кол-во ошибок получения, кол-во отложенных по бюджету).
+    """
+    ip_fetch_method = runtime.config.get('ip_fetch_method', IP_FETCH_API)
+    api_client = runtime.get_api_client(deadline)
+    grace = _panel_failure_grace(runtime.config)
+    workers = _int_setting(runtime.config, 'ip_fetch_workers', DEFAULT_IP_FETCH_WORKERS)
+    counts = {'resolved': 0, 'empty': 0, 'failed': 0}
+    ordered_users = sorted(users, key=lambda email: (email in runtime.user_ips,
+                                                     runtime.ips_refreshed_at.get(email, 0.0), email))
+
+    def handle_result(user_email, user_ip_list):
+        status, changed = _store_ip_result(runtime, user_email, user_ip_list, grace, ip_fetch_method)
+        counts[status] += 1
+        if changed and flusher is not None:
+            flusher.notify()
+
+    def budget_left():
+        return deadline is None or deadline - time.monotonic() >= xui_api.MIN_REQUEST_TIMEOUT
+
+    deferred_count = 0
+    if workers <= 1 or len(ordered_users) <= 1:
+        for index, user_email in enumerate(ordered_users):
+            if not budget_left():
+                deferred_count = len(ordered_users) - index
+                break
+            # Получаем IP выбранным методом!
+            handle_result(user_email, api_client.get_client_ip_addresses(user_email, method=ip_fetch_method))
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ip-fetch')
+        queue = collections.deque(ordered_users)
+        futures = {}
+        not_done = set()
+        try:
+            while queue or not_done:
+                # Запросы отправляются окном не шире текущего лимита панели: после исчерпания бюджета
+                # в очереди исполнителя не остается запросов, которые еще успели бы уйти в панель
+                window = _ip_fetch_window(api_client, workers)
+                while queue and len(not_done) < window and budget_left():
+                    email = queue.popleft()
+                    future = executor.submit(api_client.get_client_ip_addresses, email, method=ip_fetch_method)
+                    futures[future] = email
+                    not_done.add(future)
+                if not not_done:
+                    break # Бюджет исчерпан до отправки оставшихся
+                # Ждем готовых результатов, но не дольше дедлайна и срока очередного применения пачки
+                timeouts = [] if deadline is None else [max(0.0, deadline - time.monotonic())]
+                due = flusher.seconds_until_due() if flusher is not None else None
+                if due is not None:
+                    timeouts.append(due)
+                done, not_done = concurrent.futures.wait(not_done, timeout=min(timeouts) if timeouts else None,
+                                                         return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        user_ip_list = future.result()
+                    except Exception as e:
+                        log_worker('debug', "Ошибка получения IP для '%s': %s", futures[future], e)
+                        user_ip_list = None
+                    handle_result(futures[future], user_ip_list)
+                if flusher is not None:
+                    flusher.poll()
+                if not budget_left():
+                    break
+        finally:
+            for future in not_done:
+                future.cancel() # Еще не начатые запросы не нужны (бюджет исчерпан)
+            executor.shutdown(wait=False)
+        deferred_count = len(queue) + len(not_done)
+
+    if deferred_count:
+        log_worker('warning', "Бюджет цикла исчерпан: IP %d пользователей не обновлены, остаются прежние правила.", deferred_count)
+    if counts['failed']:
+        log_worker('warning', "Не удалось получить IP для %d пользователей (метод: %s).", counts['failed'], ip_fetch_method)
+    return counts['resolved'], counts['failed'], deferred_count
+
+class _PipelineFlusher:
+    """
+    Поэтапное применение правил во время получения IP: изменения копятся и применяются
+    пачками (по 'apply_batch_users' пользователей или раз в 'apply_flush_interval_sec'),
+    так что новый онлайн пользователь ограничивается сразу после своего запроса, а не после самого медленного.
+    """
+    def __init__(self, runtime, relevant_users):
+        config = runtime.config
+        self.runtime = runtime
+        self.relevant_users = relevant_users
+        self.batch_users = _int_setting(config, 'apply_batch_users', DEFAULT_APPLY_BATCH_USERS)
+        interval = config.get('apply_flush_interval_sec', DEFAULT_APPLY_FLUSH_INTERVAL_SEC)
+        if isinstance(interval, bool) or not isinstance(interval, (int, float)) or interval < 0:
+            interval = DEFAULT_APPLY_FLUSH_INTERVAL_SEC
+        self.flush_interval = interval
+        self.pending = 0
+        self.flushes = 0
+        self.last_flush = time.monotonic()
+
+    def notify(self):
+        """Отмечает изменение IP одного пользователя."""
+        self.pending += 1
+        if self.pending >= self.batch_users:
+            self._flush()
+        else:
+            self.poll()
+
+    def seconds_until_due(self):
+        """Сколько ждать до применения накопленных изменений по интервалу (None - изменений нет)."""
+        if not self.pending:
+            return None
+        return max(0.0, self.flush_interval - (time.monotonic() - self.last_flush))
+
+    def poll(self):
+        """Применяет накопленные изменения, если истек интервал."""
+        if self.pending and time.monotonic() - self.last_flush >= self.flush_interval:
+            self._flush()
+
+    def finish(self):
+        """
+        Итоговое применение после получения всех IP. Если пачки уже применялись в этом цикле,
+        быструю проверку ядра не повторяем - правила только что записаны.
+        """
+        return _apply_plan(self.runtime, self.relevant_users, verify_kernel=not self.flushes)
+
+    def _flush(self):
+        _apply_plan(self.runtime, self.relevant_users, final=False)
+        self.pending = 0
+        self.flushes += 1
+        self.last_flush = time.monotonic()
+
+def _report_ip_cache(runtime):
+    """Сводка попаданий в кэш IP за цикл; кэш сохраняется на диск, если были новые запросы."""
+    stats = runtime.ip_cache.take_stats()
+    lookups = stats['hits'] + stats['negative_hits'] + stats['misses']
+    if not lookups:
+        return
+    log_utils.log_summary(_logger, "Кэш IP", level=logging.DEBUG, lookups=lookups,
+                          hit_ratio=(stats['hits'] + stats['negative_hits']) / lookups, **stats)
+    if stats['misses']:
+        runtime.save_ip_cache()
+
+def _report_api_limiter(runtime):
+    """Сводка адаптивного лимита запросов к панели за цикл."""
+    stats = runtime.api_limiter.take_stats()
+    if not stats['requests']:
+        return
+    level = logging.INFO if stats['overloads'] else logging.DEBUG
+    log_utils.log_summary(_logger, "Лимит запросов к панели", level=level, **stats)
+
+def _report_hedge_stats(runtime):
+    """Сводка гибридного метода за цикл: какой источник дал ответ."""
+    if runtime.api_client is None:
+        return
+    stats = runtime.api_client.take_hedge_stats()
+    lookups = stats['api'] + stats['log'] + stats['none']
+    if lookups:
+        log_utils.log_summary(_logger, "Гибридный метод IP", level=logging.DEBUG, lookups=lookups,
+                              log_win_ratio=stats['log'] / lookups, **stats)
+
+def _relevant_users(runtime):
+    """
+    Онлайн пользователи с действующим (положительным) лимитом.
+    По снимку панели пропускаются отключенные, истекшие и исчерпавшие квоту клиенты.
+    """
+    relevant = set()
+    snapshot = runtime.inbound_snapshot
+    limits = runtime.effective_limits()
+    now = time.time()
+    for user_email in runtime.online_users.intersection(limits):
+        limit = limits.get(user_email)
+        if not isinstance(limit, (int, float)) or limit <= 0:
+            log_worker('debug', "Пропуск пользователя '%s' с недействительным лимитом: %s", user_email, limit)
+        elif snapshot is not None and not snapshot.is_active(user_email, now):
+            log_worker('debug', "Пропуск пользователя '%s': клиент отключен или истек в панели.", user_email)
+        else:
+            relevant.add(user_email)
+    return relevant
+
+def _configure_rule_lifecycle(runtime):
+    """Переносит параметры жизненного цикла правил из config.json в runtime.rule_lifecycle."""
+    config, lifecycle = runtime.config, runtime.rule_lifecycle
+    settings = (
+        ('grace_sec', 'tc_rule_grace_sec', tc_manager.DEFAULT_RULE_GRACE_SEC),
+        ('idle_reclaim_cycles', 'tc_idle_reclaim_cycles', tc_manager.DEFAULT_IDLE_RECLAIM_CYCLES),
+        ('idle_recheck_sec', 'tc_idle_recheck_sec', tc_manager.DEFAULT_IDLE_RECHECK_SEC),
+    )
+    for attr, key, default in settings:
+        value = config.get(key, default)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            value = default
+        setattr(lifecycle, attr, value)
+
+def _plan_fingerprint(runtime, relevant_users, desired_ips, limits, connection_limits):
+    """Отпечаток всего, от чего зависят правила: лимиты, релевантные пользователи, карта IP, настройки tc."""
+    lifecycle = runtime.rule_lifecycle
+    return _digest({
+        'limits': {email: limits.get(email) for email in relevant_users},
+        'users': sorted(relevant_users),
+        'ips': {email: runtime.user_ips.get(email, []) for email in relevant_users},
+        'desired': desired_ips,
+        'connections': sorted([ip, port, limit] for (ip, port), limit in connection_limits.items()),
+        'interfaces': _ip_interfaces(runtime.config),
+        'tc': tc_manager.settings_fingerprint(),
+        'aggregation': _ip_aggregation(runtime.config),
+        'ipv6_prefix': _ipv6_match_prefix(runtime.config),
+        'lifecycle': [lifecycle.grace_sec, lifecycle.idle_reclaim_cycles, lifecycle.idle_recheck_sec],
+    })
+
+def _can_skip_apply(runtime, fingerprint, desired_ips, verify_kernel=True):
+    """
+    Быстрый путь: план не изменился, у жизненного цикла нет отложенных переходов
+    (удержаний и учета простоя) и быстрая проверка ядра прошла.
+    """
+    lifecycle = runtime.rule_lifecycle
+    if (fingerprint != runtime.plan_fingerprint or not runtime.rules_in_sync
+            or lifecycle.needs_counters or set(lifecycle.entries) != set(desired_ips)):
+        return False
+    if verify_kernel and not all(tc_manager.run_on_interfaces(_ip_interfaces(runtime.config), tc_manager.quick_sanity_check,
+                                                              len(runtime.plan)).values()):
+        log_worker('warning', "Правила в ядре не совпадают с сохраненным планом. Полная пересборка.")
+        runtime.rules_in_sync = False
+        return False
+    return True
+
+def _apply_plan(runtime, relevant_users, final=True, verify_kernel=True):
+    """
+    Собирает {ip: limit} из кэша IP для релевантных пользователей и применяет правила TC.
+    IP недавно ушедших пользователей удерживаются, простаивающие IP снимаются (tc_manager.RuleLifecycle).
+    Если отпечаток входных данных не изменился и ядро в порядке, tc не трогается (runtime.last_apply_mode).
+
+    Args:
+        runtime (WorkerRuntime): Данные воркера.
+        relevant_users (set): Онлайн пользователи с лимитами.
+        final (bool): False - промежуточное применение во время получения IP: счетчики трафика
+                      не читаются, чтобы не учитывать простой несколько раз за цикл.
+        verify_kernel (bool): Выполнять ли быструю проверку ядра перед пропуском применения.
+
+    Returns:
+        tuple: (кол-во IP в плане, кол-во примененных правил).
+    """
+    interfaces = _ip_interfaces(runtime.config)
+    desired_ips = {} # Словарь {ip: limit_mbps} по текущим онлайн пользователям
+    ip_owners = {}   # Словарь {ip: email}
+    ip_claims = {}   # Словарь {ip: {email: limit_mbps}} - все пользователи IP
+    shared_ip_conflicts = 0
+    dead_ips = 0     # IP из API/лога без живых соединений (ip_liveness)
+    limits = runtime.effective_limits()
+    live_ips = runtime.live_ips
+    if live_ips is not None and runtime.liveness_exempt_ports:
+        # IP пользователей UDP inbound без conntrack считаются живыми (и для удержания правил)
+        live_ips = live_ips | {ip for user_email in relevant_users if _liveness_exempt(runtime, user_email)
+                               for ip in runtime.user_ips.get(user_email, [])}
+    split_connections = _shared_ip_mode(runtime.config) == SHARED_IP_CONNECTION
+    rule_ips = {} # {email: [ip или префикс]} - живые IP пользователя, при агрегации свернутые в префиксы
+    for user_email in relevant_users:
+        user_ip_list = runtime.user_ips.get(user_email, [])
+        if live_ips is not None:
+            rule_ips[user_email] = [ip for ip in user_ip_list if ip in live_ips]
+            dead_ips += len(user_ip_list) - len(rule_ips[user_email])
+        else:
+            rule_ips[user_email] = user_ip_list
+    ipv6_prefix = _ipv6_match_prefix(runtime.config)
+    if ipv6_prefix < 128:
+        for user_email, ips in rule_ips.items():
+            if any(':' in ip for ip in ips):
+                rule_ips[user_email] = tc_manager.normalize_ips(ips, ipv6_prefix)
+    aggregation = _ip_aggregation(runtime.config)
+    if aggregation is not None:
+        addresses_count = sum(len(ips) for ips in rule_ips.values())
+        rule_ips = tc_manager.aggregate_ip_prefixes(rule_ips, limits, **aggregation)
+        log_worker('debug', "Агрегация IP (%s): %d адресов -> %d префиксов.", aggregation['mode'],
+                   addresses_count, sum(len(ips) for ips in rule_ips.values()))
+    for user_email in sorted(relevant_users):
+        limit = limits[user_email]
+        for ip in rule_ips[user_email]:
+            if ip in desired_ips and desired_ips[ip] != limit and not split_connections:
+                log_worker('debug', "IP %s используется несколькими пользователями. Лимит будет перезаписан: %s -> %s (для '%s')",
+                           ip, desired_ips[ip], limit, user_email)
+                shared_ip_conflicts += 1
+            desired_ips[ip] = limit
+            ip_owners[ip] = user_email
+            ip_claims.setdefault(ip, {})[user_email] = limit
+    if shared_ip_conflicts:
+        log_worker('warning', "%d IP используются несколькими пользователями с разными лимитами (лимит перезаписан).", shared_ip_conflicts)
+
+    # shared_ip_mode='connection': соединения каждого пользователя общего IP - по его лимиту,
+    # соединения с неизвестным владельцем - по наименьшему лимиту пользователей IP
+    connection_limits = {}
+    if split_connections:
+        shared_ips = {ip: claims for ip, claims in ip_claims.items() if len(set(claims.values())) > 1}
+        for ip, claims in shared_ips.items():
+            ip_owners[ip] = min(claims, key=lambda email: (claims[email], email))
+            desired_ips[ip] = claims[ip_owners[ip]]
+        for (ip, port), user_email in runtime.connection_owners.items():
+            if user_email in shared_ips.get(ip, ()):
+                connection_limits[(ip, port)] = shared_ips[ip][user_email]
+        if shared_ips:
+            log_worker('debug', "%d IP используются несколькими пользователями с разными лимитами: "
+                       "%d соединений с известным владельцем разделены.", len(shared_ips), len(connection_limits))
+
+    _configure_rule_lifecycle(runtime)
+    apply_started = time.monotonic()
+    fingerprint = _plan_fingerprint(runtime, relevant_users, desired_ips, limits, connection_limits)
+    if _can_skip_apply(runtime, fingerprint, desired_ips, verify_kernel):
+        log_worker('debug', "План не изменился (%d IP). Применение правил пропущено.", len(runtime.plan))
+        runtime.last_apply_mode = APPLY_SKIP
+        runtime.timings['apply_s'] = round(time.monotonic() - apply_started, 3)
+        return len(runtime.plan), 0
+
+    counters = None
+    if final and runtime.rule_lifecycle.needs_counters and runtime.plan:
+        counters = _read_filter_counters(interfaces)
+    active_ips_to_limit, lifecycle_stats = runtime.rule_lifecycle.effective_plan(
+        desired_ips, ip_owners, limits, counters, live=live_ips)
+    if final and (any(lifecycle_stats.values()) or dead_ips):
+        log_utils.log_summary(_logger, "Жизненный цикл правил", desired=len(desired_ips), dead=dead_ips,
+                              **lifecycle_stats)
+
+    applied_count = 0
+    if active_ips_to_limit and runtime.rules_in_sync:
+        # Разница с установленным планом: replace/del по постоянным handle
+        runtime.plan, applied_count, runtime.rules_in_sync = tc_manager.sync_tc_rules(
+            interfaces, active_ips_to_limit, runtime.plan, runtime.handle_allocator)
+        runtime.last_apply_mode = APPLY_SYNC
+        if not runtime.rules_in_sync:
+            log_worker('warning', "Ошибки при синхронизации правил. В следующий раз правила будут пересобраны полностью.")
+    elif active_ips_to_limit:
+        applied_count = tc_manager.apply_tc_rules(interfaces, active_ips_to_limit, runtime.handle_allocator)
+        runtime.plan = {ip: limit for ip, limit in active_ips_to_limit.items() if ip in runtime.handle_allocator.handles}
+        runtime.rules_in_sync = True
+        runtime.last_apply_mode = APPLY_REBUILD
+    else:
+        log_worker('debug', "Нет активных IP для применения правил. Очистка динамических правил...")
+        tc_manager.run_on_interfaces(interfaces, tc_manager.clear_dynamic_tc_rules)
+        runtime.plan = {}
+        runtime.handle_allocator.reset()
+        runtime.rules_in_sync = True
+        runtime.last_apply_mode = APPLY_CLEAR
+    connections_ok = _apply_connection_rules(runtime, connection_limits)
+    runtime.plan_fingerprint = fingerprint if runtime.rules_in_sync and connections_ok else None
+    runtime.save_applied_plan() # Записи жизненного цикла (в т.ч. снятых по простою IP) сохраняются
+    runtime.timings['apply_s'] = round(time.monotonic() - apply_started, 3)
+    return len(active_ips_to_limit), applied_count
+
+def _read_filter_counters(interfaces):
+    """Счетчики байт правил, суммированные по интерфейсам (None, если хотя бы один не прочитан)."""
+    counters = {}
+    for iface_counters in tc_manager.run_on_interfaces(interfaces, tc_manager.read_filter_counters).values():
+        if iface_counters is None:
+            return None
+        for ip, sent_bytes in iface_counters.items():
+            counters[ip] = counters.get(ip, 0) + sent_bytes
+    return counters
+
+def _apply_connection_rules(runtime, connection_limits):
+    """
+    Приводит правила по соединению к connection_limits (после применения правил по IP:
+    полная пересборка и очистка правил по IP снимают и их). Возвращает True при успехе.
+    """
+    interfaces = _ip_interfaces(runtime.config)
+    if runtime.last_apply_mode in (APPLY_REBUILD, APPLY_CLEAR):
+        runtime.connection_plan = {}
+    if connection_limits == runtime.connection_plan:
+        return True
+    if not connection_limits:
+        ok = all(tc_manager.run_on_interfaces(interfaces, tc_manager.clear_connection_rules).values())
+    else:
+        results = tc_manager.run_on_interfaces(interfaces, tc_manager.apply_connection_rules, connection_limits)
+        ok = all(iface_ok for _, iface_ok in results.values())
+    runtime.connection_plan = dict(connection_limits) if ok else {}
+    if not ok:
+        log_worker('warning', "Ошибки при установке правил по соединению. Они будут переустановлены в следующий раз.")
+    return ok
+
+def _clear_rules(runtime):
+    """Снимает все динамические правила (без удержания) и сохраняет пустой план."""
+    tc_manager.run_on_interfaces(_ip_interfaces(runtime.config), tc_manager.clear_dynamic_tc_rules)
+    runtime.plan = {}
+    runtime.connection_plan = {}
+    runtime.rule_lifecycle.entries = {}
+    runtime.handle_allocator.reset()
+    runtime.rules_in_sync = True
+    runtime.plan_fingerprint = None
+    runtime.last_apply_mode = APPLY_CLEAR
+    runtime.save_applied_plan()
+
+def _sync_mark_filters(runtime):
+    """
+    Поддерживает статические fw-фильтры уровней на интерфейсах с backend 'mark' (трафик классифицирует
+    сам Xray по метке сокета outbound уровня) и обновляет фрагмент маршрутизации Xray при изменении лимитов.
+    С интерфейсов, перешедших на классификацию по IP, фильтры меток снимаются.
+    """
+    mark_interfaces = _interface_names(runtime.config, CLASSIFICATION_MARK)
+    other_interfaces = _ip_interfaces(runtime.config)
+    if not mark_interfaces:
+        if runtime.mark_fingerprint is not None:
+            log_worker('info', "Классификация по IP: снятие fw-фильтров меток.")
+            for network_interface in other_interfaces:
+                tc_manager.clear_mark_filters(network_interface)
+            runtime.mark_fingerprint = None
+            runtime.save_applied_plan()
+        return
+    fingerprint = _digest({'interfaces': mark_interfaces, 'tc': tc_manager.settings_fingerprint(),
+                           'marks': [common.TC_MARK_BASE, common.TC_MARK_PRIO, common.TC_CONNMARK_PRIO]})
+    if fingerprint != runtime.mark_fingerprint and runtime.mark_fingerprint is not None:
+        for network_interface in other_interfaces: # До установки: снятие убирает и общее правило CONNMARK
+            tc_manager.clear_mark_filters(network_interface)
+    if fingerprint != runtime.mark_fingerprint or not all(
+            tc_manager.run_on_interfaces(mark_interfaces, tc_manager.mark_filters_installed).values()):
+        # Последовательно: apply_mark_filters правит общее для всех интерфейсов правило iptables
+        results = [tc_manager.apply_mark_filters(network_interface) for network_interface in mark_interfaces]
+        runtime.mark_fingerprint = fingerprint if all(results) else None
+        runtime.save_applied_plan()
+
+    snippet = tc_manager.build_xray_mark_config(runtime.effective_limits())
+    if snippet != config_manager.load_xray_mark_snippet() and config_manager.save_xray_mark_snippet(snippet):
+        log_worker('warning', "Обновлен фрагмент маршрутизации Xray %s (%d уровней). Примените его в конфигурации Xray.",
+                   common.XRAY_MARK_SNIPPET_FILE, len(snippet['outbounds']))
+
+def _run_mark_cycle(runtime):
+    """
+    Цикл, когда на всех интерфейсах классификация по меткам: онлайн и IP не запрашиваются,
+    фильтры меток уже поддерживает _sync_mark_filters().
+    """
+    if runtime.plan or runtime.handle_allocator.handles:
+        log_worker('info', "Классификация по меткам: снятие правил по IP.")
+        _clear_rules(runtime)
+    return _cycle_result(CYCLE_IDLE, set(), {})
+
+def _hold_last_known_good(runtime, reason):
+    """
+    Реакция на недоступность панели: последние примененные правила остаются в ядре
+    в течение panel_failure_grace_sec с последнего успешного ответа панели, затем снимаются.
+    """
+    grace = _panel_failure_grace(runtime.config)
+    held_for = time.time() - runtime.panel_ok_at if runtime.panel_ok_at is not None else None
+    if runtime.plan and held_for is not None and held_for < grace:
+        log_utils.log_summary(_logger, "Деградированный режим: панель недоступна, удерживаются последние правила",
+                              level=logging.WARNING, reason=reason, ips=len(runtime.plan),
+                              held_s=round(held_for, 1), grace_left_s=round(grace - held_for, 1))
+        return
+    if runtime.plan:
+        log_worker('error', "Панель недоступна дольше %d сек (%s). Последние правила сняты.", grace, reason)
+    else:
+        log_worker('info', "Очистка динамических правил TC из-за недоступности панели (%s)...", reason)
+    runtime.user_ips = {}
+    runtime.ips_refreshed_at = {}
+    _clear_rules(runtime)
+
+# --- Основная логика Воркера ---
+def run_worker_cycle(runtime):
+    """
+    Выполняет один полный цикл обновления правил TC (онлайн -> IP -> правила).
+
+    Args:
+        runtime (WorkerRuntime): Конфиг, лимиты и кэш данных процесса (обновляется на месте).
+
+    Returns:
+        dict: Результат цикла: 'status' (CYCLE_OK/CYCLE_IDLE/CYCLE_ERROR) и отпечатки
+              'online_digest'/'ip_map_digest' (None, если данные не были получены).
+    """
+    cycle_started = time.monotonic()
+    log_worker('debug', "Запуск цикла обновления правил TC...")
+    config, user_limits = runtime.config, runtime.user_limits
+    if not _validate_inputs(config, user_limits):
+        return _cycle_result(CYCLE_ERROR)
+
+    _sync_mark_filters(runtime)
+    ip_interfaces = _ip_interfaces(config)
+    if not ip_interfaces:
+        return _run_mark_cycle(runtime)
+    log_worker('debug', "Используются интерфейсы: %s, метод получения IP: %s",
+               ', '.join(ip_interfaces), config.get('ip_fetch_method', IP_FETCH_API))
+
+    # Проверка, есть ли вообще лимиты пользователей (лимиты панели станут известны после запроса к API)
+    if not user_limits and _limit_source(config) == LIMIT_SOURCE_FILE:
+        log_worker('info', "Список лимитов пользователей пуст. Очистка динамических правил TC...")
+        _apply_plan(runtime, set())
+        return _cycle_result(CYCLE_IDLE, set(), {})
+
+    # 2. Инициализация API клиента (в демоне сессия переиспользуется между циклами)
+    deadline = _cycle_deadline(config, cycle_started)
+    try:
+        api_client = runtime.get_api_client(deadline)
+    except ConnectionError as e:
+        log_worker('critical', "Критическая ошибка: Не удалось подключиться/войти в API X-UI: %s", e)
+        _hold_last_known_good(runtime, "ошибка входа")
+        return _cycle_result(CYCLE_ERROR) # Прерываем цикл, т.к. без API не получить онлайн (если метод API)
+    except Exception as e:
+        log_worker('critical', "!!! Непредвиденная ошибка при инициализации API (Generic Exception): %s", e)
+        return _cycle_result(CYCLE_ERROR) # Прерываем цикл
+
+    # 3. Получение онлайн пользователей (нужно для сверки)
+    online_users_set = api_client.get_online_users_emails()
+    runtime.timings['panel_s'] = round(time.monotonic() - cycle_started, 3)
+    if online_users_set is None:
+        log_worker('error', "Не удалось получить список онлайн пользователей из API. Обновление правил отложено.")
+        runtime.reset_api_client() # Сессия могла истечь - в следующий раз войдем заново
+        _hold_last_known_good(runtime, "ошибка получения онлайн")
+        return _cycle_result(CYCLE_ERROR)
+    runtime.online_users = online_users_set
+    runtime.panel_ok_at = time.time()
+    snapshot = api_client.get_inbounds_snapshot() # Обычно из кэша (раз в interval)
+    if snapshot is not None or api_client.snapshot_interval <= 0:
+        runtime.inbound_snapshot = snapshot # Иначе - прежний снимок (новый клиент, панель не ответила)
+    if _limit_source(config) == LIMIT_SOURCE_PANEL:
+        if runtime.inbound_snapshot is None:
+            log_worker('error', "Не удалось получить лимиты из панели (inbounds/list). Обновление правил отложено.")
+            _hold_last_known_good(runtime, "нет лимитов панели")
+            return _cycle_result(CYCLE_ERROR)
+        runtime.refresh_panel_limits()
+    _refresh_live_ips(runtime)
+    _refresh_connection_owners(runtime)
+    if not online_users_set:
+        log_worker('info', "Нет активных онлайн пользователей по данным API.")
+        runtime.user_ips = {}
+        _apply_plan(runtime, set()) # Правила недавно ушедших пользователей удерживаются
+        return _cycle_result(CYCLE_IDLE, set(), {})
+
+    # 4. Определение релевантных пользователей и сбор их IP
+    relevant_online_users = _relevant_users(runtime)
+    # IP ушедших из онлайна пользователей больше не нужны
+    runtime.user_ips = {email: ips for email, ips in runtime.user_ips.items() if email in relevant_online_users}
+    runtime.ips_refreshed_at = {email: ts for email, ts in runtime.ips_refreshed_at.items() if email in runtime.user_ips}
+    if not relevant_online_users:
+        log_worker('info', "Нет онлайн пользователей с настроенными лимитами.")
+        _apply_plan(runtime, set())
+        return _cycle_result(CYCLE_IDLE, relevant_online_users, {})
+
+    log_worker('debug', "Обнаружено %d онлайн пользователей с лимитами: %s",
+               len(relevant_online_users), ', '.join(sorted(relevant_online_users)))
+    resolve_started = time.monotonic()
+    flusher = _PipelineFlusher(runtime, relevant_online_users)
+    resolved_count, failed_count, deferred_count = _resolve_user_ips(runtime, relevant_online_users, deadline,
+                                                                     flusher=flusher)
+    runtime.timings['resolve_s'] = round(time.monotonic() - resolve_started, 3)
+    _report_ip_cache(runtime)
+    _report_hedge_stats(runtime)
+    _report_api_limiter(runtime)
+
+    # 5. Применение правил TC (оставшиеся изменения; у неопрошенных по бюджету остаются прежние IP)
+    ips_count, applied_count = flusher.finish()
+
+    runtime.timings['cycle_s'] = round(time.monotonic() - cycle_started, 3)
+    runtime.timings['cycle_finished_at'] = time.time()
+    log_utils.log_summary(_logger, "Цикл завершен",
+                          online=len(online_users_set), relevant=len(relevant_online_users),
+                          resolved=resolved_count, failed=failed_count, deferred=deferred_count,
+                          ips=ips_count, rules=applied_count, tc=runtime.last_apply_mode,
+                          no_handle=len(runtime.handle_allocator.overflow),
+                          flushes=flusher.flushes, duration_s=runtime.timings['cycle_s'])
+    _log_budget_usage(config, runtime.timings)
+    return _cycle_result(CYCLE_OK, relevant_online_users, runtime.user_ips)
+
+def replan_from_cache(runtime):
+    """
+    Пересчитывает и применяет правила после изменения лимитов, используя онлайн-множество
+    и карту IP из прошлого цикла. К API обращается только за IP пользователей, которые
+    стали релевантными (онлайн, но раньше не имели лимита).
+
+    Returns:
+        bool: True, если пересчет выполнен; False, если кэша нет и нужен полный цикл.
+    """
+    if not _validate_inputs(runtime.config, runtime.user_limits):
+        return False
+    _sync_mark_filters(runtime) # Фрагмент маршрутизации Xray для интерфейсов с метками
+    if not _ip_interfaces(runtime.config):
+        _run_mark_cycle(runtime) # Онлайн и IP не нужны
+        return True
+    if runtime.online_users is None:
+        return False
+    started = time.monotonic()
+    relevant_online_users = _relevant_users(runtime)
+    missing_users = [email for email in relevant_online_users if email not in runtime.user_ips]
+    if missing_users:
+        try:
+            _resolve_user_ips(runtime, missing_users, _cycle_deadline(runtime.config, started))
+            _report_ip_cache(runtime)
+        except ConnectionError as e:
+            log_worker('warning', "Не удалось получить IP новых пользователей с лимитом: %s", e)
+    ips_count, applied_count = _apply_plan(runtime, relevant_online_users)
+    runtime.timings['replan_s'] = round(time.monotonic() - started, 3)
+    log_utils.log_summary(_logger, "Правила пересчитаны по изменению лимитов",
+                          relevant=len(relevant_online_users), new_users=len(missing_users),
+                          ips=ips_count, rules=applied_count, tc=runtime.last_apply_mode,
+                          no_handle=len(runtime.handle_allocator.overflow),
+                          duration_s=runtime.timings['replan_s'])
+    return True
+
+def _log_budget_usage(config, timings):
+    """Сводка: сколько бюджета цикла заняли этапы (вход+онлайн, получение IP, применение правил)."""
+    budget = _cycle_budget(config)
+    if budget is None:
+        return
+    stages = {'panel': timings.get('panel_s', 0.0), 'resolve': timings.get('resolve_s', 0.0),
+              'apply': timings.get('apply_s', 0.0)}
+    level = logging.WARNING if timings.get('cycle_s', 0.0) > budget else logging.INFO
+    log_utils.log_summary(_logger, "Бюджет цикла", level=level, budget_s=budget,
+                          **{f"{stage}_pct": round(100.0 * value / budget, 1) for stage, value in stages.items()},
+                          total_pct=round(100.0 * timings.get('cycle_s', 0.0) / budget, 1))
+
+# --- Адаптивный интервал опроса ---
+
+def _poll_settings(config):
+    """Читает границы адаптивного интервала из конфига (с защитой от некорректных значений)."""
+    try:
+        interval_min = max(1.0, float(config.get('poll_interval_min', DEFAULT_POLL_INTERVAL_MIN)))
+        interval_max = max(interval_min, float(config.get('poll_interval_max', DEFAULT_POLL_INTERVAL_MAX)))
+        backoff = max(1.0, float(config.get('poll_interval_backoff', DEFAULT_POLL_BACKOFF)))
+    except (TypeError, ValueError):
+        log_worker('warning', "Некорректные параметры poll_interval_* в конфиге. Используются значения по умолчанию.")
+        interval_min, interval_max, backoff = DEFAULT_POLL_INTERVAL_MIN, DEFAULT_POLL_INTERVAL_MAX, DEFAULT_POLL_BACKOFF
+    return interval_min, interval_max, backoff
+
+def compute_next_interval(config, state, result):
+    """
+    Выбирает интервал до следующего цикла.
+    - Изменилось онлайн-множество или карта IP -> минимальный интервал.
+    - Данные стабильны -> интервал растет в poll_interval_backoff раз до poll_interval_max.
+    - Ошибка цикла -> интервал не меняется (данных для сравнения нет).
+
+    Args:
+        config (dict): Конфигурация (границы интервала).
+        state (dict): Состояние прошлых циклов ('poll_interval', 'online_digest', 'ip_map_digest').
+                      Обновляется на месте отпечатками текущего цикла.
+        result (dict): Результат run_worker_cycle.
+
+    Returns:
+        tuple: (интервал в секундах, причина выбора).
+    """
+    interval_min, interval_max, backoff = _poll_settings(config)
+    previous_interval = state.get('poll_interval', interval_min)
+    try:
+        previous_interval = min(max(float(previous_interval), interval_min), interval_max)
+    except (TypeError, ValueError):
+        previous_interval = interval_min
+
+    if result['status'] == CYCLE_ERROR or result['online_digest'] is None:
+        interval, reason = previous_interval, "ошибка цикла, интервал не изменен"
+    else:
+        online_changed = result['online_digest'] != state.get('online_digest')
+        ip_map_changed = result['ip_map_digest'] != state.get('ip_map_digest')
+        if online_changed or ip_map_changed:
+            changed = [name for name, flag in (("онлайн-множество", online_changed), ("карта IP", ip_map_changed)) if flag]
+            interval, reason = interval_min, f"изменилось: {', '.join(changed)}"
+        else:
+            interval = min(previous_interval * backoff, interval_max)
+            reason = "без изменений" if interval < interval_max else "без изменений, достигнут максимум"
+        state['online_digest'] = result['online_digest']
+        state['ip_map_digest'] = result['ip_map_digest']
+
+    state['poll_interval'] = interval
+    return interval, reason
+
+# --- Режимы запуска ---
+
+def _load_inputs():
+    """Загружает конфиг и лимиты, перенастраивает логирование по конфигу."""
+    config = config_manager.load_config()
+    user_limits = config_manager.load_user_limits()
+    # Уровни и формат логов берутся из config.json
+    log_utils.setup_logging(config, with_timestamps=True)
+    return config, user_limits
+
+def run_base_tc_mode():
+    """
+    Настройка базы TC ('--base-tc', запускается скриптом setup_base_tc.sh службы базы TC).
+    Повторный запуск с неизменной конфигурацией ничего не меняет.
+
+    Returns:
+        int: Код выхода (0 - база на всех интерфейсах в нужном виде).
+    """
+    config = config_manager.load_config()
+    log_utils.setup_logging(config, with_timestamps=True)
+    if not configured_interfaces(config):
+        log_worker('error', "Интерфейсы не заданы ('interfaces' или 'iface' в %s).", common.CONFIG_FILE)
+        return 1
+    results = reconcile_base_tc(config)
+    for name, (changes, ok) in results.items():
+        if not ok:
+            log_worker('error', "База TC на %s не приведена к нужному виду.", name)
+        else:
+            log_worker('info', "База TC на %s: изменений %d.", name, changes)
+    return 0 if all(ok for _, ok in results.values()) else 1
+
+def timer_interval(config):
+    """Шаг таймера systemd в секундах из 'timer_interval_sec'."""
+    return _int_setting(config, 'timer_interval_sec', DEFAULT_TIMER_INTERVAL_SEC)
+
+def run_timer_mode():
+    """
+    Однократный запуск по таймеру systemd: один полный цикл с шагом timer_interval_sec.
+    Адаптивный интервал требует частых пробуждений, поэтому он работает только в режиме демона,
+    где пропущенный цикл ничего не стоит (без запуска процесса).
+    """
+    config, user_limits = _load_inputs()
+    runtime = WorkerRuntime(config, user_limits)
+    runtime.restore_applied_plan()
+    runtime.restore_ip_cache()
+    run_worker_cycle(runtime)
+
+# Канал пробуждения select() из обработчика сигнала (select сам по себе перезапускается после EINTR)
+_wakeup_read_fd, _wakeup_write_fd = None, None
+
+def _handle_stop_signal(signum, frame):
+    """Обработчик SIGTERM/SIGINT для демона: завершаем после текущего цикла."""
+    _stop_event.set()
+    if _wakeup_write_fd is not None:
+        try:
+            os.write(_wakeup_write_fd, b'\0')
+        except OSError:
+            pass
+
+def _open_config_watcher():
+    """Открывает inotify-наблюдение за директорией конфигурации (None, если недоступно)."""
+    try:
+        watcher = system_utils.InotifyWatcher(common.CONFIG_DIR)
+        log_worker('debug', "Отслеживание изменений в %s (inotify) включено.", common.CONFIG_DIR)
+        return watcher
+    except OSError as e:
+        log_worker('warning', "inotify недоступен (%s). Изменения конфигурации применятся в следующем цикле.", e)
+        return None
+
+def _open_link_watcher():
+    """Открывает подписку на события интерфейсов и qdisc (None, если netlink недоступен)."""
+    try:
+        watcher = system_utils.LinkWatcher()
+        log_worker('debug', "Отслеживание событий интерфейсов (netlink) включено.")
+        return watcher
+    except OSError as e:
+        log_worker('warning', "netlink недоступен (%s). Пропажа базы TC будет обнаружена только проверкой в цикле.", e)
+        return None
+
+def _open_control_server(runtime, state):
+    """Создает управляющий сокет демона (None, если создать не удалось)."""
+    try:
+        server = control.ControlServer(_control_handlers(runtime, state))
+        log_worker('debug', "Управляющий сокет: %s", server.socket_path)
+        return server
+    except OSError as e:
+        log_worker('warning', "Не удалось создать управляющий сокет %s: %s", common.CONTROL_SOCKET_PATH, e)
+        return None
+
+def _wait_for_events(watcher, control_server, timeout, link_watcher=None):
+    """
+    Ждет изменений файлов конфигурации, событий интерфейсов или команд управляющего сокета
+    не дольше timeout секунд. Команды сокета выполняются здесь же (ответ уходит после применения правил).
+
+    Returns:
+        tuple: (имена измененных файлов конфигурации,
+                интерфейсы с событиями netlink - множество или None, если события потеряны).
+                Пустые множества - таймаут, сигнал или команда.
+    """
+    wait_fds = [_wakeup_read_fd] + [fd for fd in (watcher, link_watcher) if fd]
+    if control_server:
+        wait_fds += control_server.fds()
+    try:
+        ready, _, _ = select.select(wait_fds, [], [], max(0.0, timeout))
+    except InterruptedError:
+        return set(), set()
+    if _wakeup_read_fd in ready:
+        os.read(_wakeup_read_fd, 64)
+    if control_server:
+        control_server.process(ready)
+    changed_links = set()
+    if link_watcher and link_watcher in ready:
+        # Собственные изменения фильтров отсекает BPF-фильтр сокета - задержка только для событий интерфейса
+        changed_links = link_watcher.read_changed_links()
+        if changed_links != set():
+            time.sleep(LINK_EVENT_DEBOUNCE_SEC)
+            more_links = link_watcher.read_changed_links()
+            changed_links = None if changed_links is None or more_links is None else changed_links | more_links
+    if not watcher or watcher not in ready:
+        return set(), changed_links
+    # Небольшая задержка, чтобы собрать серию событий от одной записи (tmp-файл + rename)
+    time.sleep(CONFIG_CHANGE_DEBOUNCE_SEC)
+    watched = {os.path.basename(common.CONFIG_FILE), os.path.basename(common.USER_LIMITS_FILE)}
+    return watcher.read_changed_names() & watched, changed_links
+
+def reconcile_base_tc(config, names=None):
+    """
+    Приводит базу TC интерфейсов из конфигурации к описанию tc_manager.base_tree_spec()
+    (параллельно по интерфейсам, меняются только отличия).
+
+    Args:
+        config (dict): Конфигурация.
+        names (list, optional): Только эти интерфейсы (по умолчанию - все из конфигурации).
+
+    Returns:
+        dict: { iface: (кол-во изменений, True если база в нужном виде) }.
+    """
+    capacities = {item['name']: item['capacity_mbit'] for item in configured_interfaces(config)}
+    targets = [name for name in capacities if names is None or name in names]
+    return tc_manager.run_on_interfaces(targets, lambda name: tc_manager.reconcile_base_tree(name, capacities[name]))
+
+def _handle_link_events(runtime, changed_links):
+    """
+    Реакция на события интерфейсов: если у обслуживаемого интерфейса нет базы TC (интерфейс пересоздан,
+    qdisc удален), база пересоздается и текущий план сразу применяется заново по кэшу онлайн/IP.
+
+    Args:
+        changed_links (set or None): Интерфейсы с событиями (None - события потеряны, проверяются все).
+    """
+    candidates = [name for name in _interface_names(runtime.config) if changed_links is None or name in changed_links]
+    broken = [name for name in candidates
+              if system_utils.link_exists(name) and not tc_manager.quick_sanity_check(name, 0)]
+    if not broken:
+        return
+    started = time.monotonic()
+    log_worker('warning', "База TC отсутствует на %s (событие интерфейса). Пересоздание и восстановление правил.",
+               ', '.join(broken))
+    rebuilt = all(ok for _, ok in reconcile_base_tc(runtime.config, broken).values())
+    # На пересозданном qdisc нет ни правил, ни фильтров меток - они ставятся заново
+    runtime.rules_in_sync = False
+    runtime.plan_fingerprint = None
+    runtime.mark_fingerprint = None
+    if not rebuilt or not replan_from_cache(runtime):
+        runtime.next_cycle_at = time.monotonic() # Кэша нет или база не пересоздана - полный цикл
+    runtime.timings['link_rebuild_s'] = round(time.monotonic() - started, 3)
+    log_utils.log_summary(_logger, "Восстановление после события интерфейса", interfaces=','.join(broken),
+                          base_tc=rebuilt, rules=len(runtime.plan), duration_s=runtime.timings['link_rebuild_s'])
+
+def _reload_changed_config(runtime, changed_names):
+    """
+    Перечитывает только измененные файлы конфигурации.
+
+    Returns:
+        str: 'full' - нужен полный цикл (изменились параметры API/интерфейса),
+             'replan' - изменились только лимиты, 'none' - изменений, влияющих на правила, нет.
+    """
+    action = 'none'
+    if os.path.basename(common.CONFIG_FILE) in changed_names:
+        new_config = config_manager.load_config()
+        log_utils.setup_logging(new_config, with_timestamps=True)
+        old_config = runtime.config
+        changed_keys = [k for k in API_CONFIG_KEYS if old_config.get(k) != new_config.get(k)]
+        if changed_keys:
+            log_worker('info', "Изменены параметры в %s: %s. Запуск полного цикла.", common.CONFIG_FILE, ', '.join(changed_keys))
+            old_interfaces = _ip_interfaces(old_config or {})
+            new_interfaces = _ip_interfaces(new_config or {})
+            for network_interface in _interface_names(old_config or {}, CLASSIFICATION_MARK):
+                if network_interface not in _interface_names(new_config or {}):
+                    tc_manager.clear_mark_filters(network_interface) # Интерфейс убран из конфигурации
+            if old_interfaces != new_interfaces:
+                # Правила на интерфейсах, которые больше не обслуживаются по IP, снимаются
+                removed_interfaces = [name for name in old_interfaces if name not in new_interfaces]
+                tc_manager.run_on_interfaces(removed_interfaces, tc_manager.clear_dynamic_tc_rules)
+                runtime.plan = {}
+                runtime.connection_plan = {}
+                runtime.handle_allocator.reset()
+                runtime.rules_in_sync = False # Состояние новых интерфейсов неизвестно
+            runtime.online_users = None
+            runtime.user_ips = {}
+            runtime.ips_refreshed_at = {}
+            runtime.ip_cache.clear() # Кэш относится к прежней панели/методу
+            action = 'full'
+        limit_keys_changed = any(old_config.get(k) != new_config.get(k) for k in LIMIT_CONFIG_KEYS)
+        runtime.config = new_config
+        if limit_keys_changed:
+            log_worker('info', "Изменен источник лимитов в %s.", common.CONFIG_FILE)
+            runtime.refresh_panel_limits()
+            if _limit_source(new_config) == LIMIT_SOURCE_PANEL and runtime.inbound_snapshot is None:
+                action = 'full' # Снимка клиентов еще нет - лимиты панели нужно запросить
+            elif action == 'none':
+                action = 'replan'
+
+    if os.path.basename(common.USER_LIMITS_FILE) in changed_names:
+        new_limits = config_manager.load_user_limits()
+        if new_limits != runtime.user_limits:
+            log_worker('info', "Изменены лимиты в %s.", common.USER_LIMITS_FILE)
+            runtime.user_limits = new_limits
+            if action == 'none':
+                action = 'replan'
+    return action
+
+def run_daemon_mode():
+    """
+    Постоянный процесс: циклы с адаптивным интервалом до получения SIGTERM/SIGINT.
+    Между циклами следит за директорией конфигурации через inotify: изменение лимитов
+    применяется сразу по кэшу онлайн/IP, изменение параметров API - внеочередным циклом.
+    События интерфейсов (netlink) восстанавливают пропавшую базу TC без перезапуска служб.
+    """
+    global _wakeup_read_fd, _wakeup_write_fd
+    _wakeup_read_fd, _wakeup_write_fd = os.pipe()
+    os.set_blocking(_wakeup_read_fd, False)
+    signal.signal(signal.SIGTERM, _handle_stop_signal)
+    signal.signal(signal.SIGINT, _handle_stop_signal)
+
+    state = config_manager.load_worker_state()
+    config, user_limits = _load_inputs()
+    runtime = WorkerRuntime(config, user_limits)
+    runtime.restore_applied_plan()
+    runtime.restore_ip_cache()
+    watcher = _open_config_watcher()
+    link_watcher = _open_link_watcher()
+    control_server = _open_control_server(runtime, state)
+    log_worker('info', "Воркер запущен в режиме демона.")
+    runtime.next_cycle_at = time.monotonic() # Первый цикл - сразу
+
+    while not _stop_event.is_set():
+        changed_names, changed_links = _wait_for_events(watcher, control_server, runtime.next_cycle_at - time.monotonic(),
+                                                        link_watcher)
+        if _stop_event.is_set():
+            break
+        if changed_links != set():
+            _handle_link_events(runtime, changed_links)
+        if changed_names:
+            action = _reload_changed_config(runtime, changed_names)
+            if action == 'full':
+                runtime.next_cycle_at = time.monotonic()
+            elif action == 'replan' and not replan_from_cache(runtime):
+                runtime.next_cycle_at = time.monotonic() # Кэша еще нет - нужен полный цикл
+        if time.monotonic() >= runtime.next_cycle_at:
+            _run_daemon_cycle(runtime, state)
+
+    if watcher:
+        watcher.close()
+    if link_watcher:
+        link_watcher.close()
+    if control_server:
+        control_server.close()
+    log_worker('info', "Демон воркера остановлен.")
+
+def _run_daemon_cycle(runtime, state):
+    """Полный цикл в режиме демона с выбором следующего интервала. Возвращает результат цикла."""
+    try:
+        result = run_worker_cycle(runtime)
+    except Exception as e:
+        # В режиме демона одна ошибка цикла не должна останавливать процесс
+        log_worker('critical', "Неперехваченное исключение в цикле воркера: %s", e)
+        log_worker('debug', "Traceback:\n%s", traceback.format_exc())
+        runtime.reset_api_client()
+        result = _cycle_result(CYCLE_ERROR)
+    interval, reason = compute_next_interval(runtime.config, state, result)
+    config_manager.save_worker_state(state)
+    log_worker('info', "Следующий цикл через %.0f сек (%s).", interval, reason)
+    runtime.next_cycle_at = time.monotonic() + interval
+    return result
+
+# --- Команды управляющего сокета ---
+
+def _parse_limit(value):
+    """Проверяет лимит из команды: положительное число Мбит/с."""
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        raise control.ControlError(f"Некорректный лимит '{value}': ожидается положительное число Мбит/с")
+    return value
+
+def _apply_limits_update(runtime, updates, removals):
+    """
+    Меняет лимиты в памяти, сохраняет user_limits.json и сразу пересчитывает правила.
+    Сохраненный файл совпадет с лимитами в памяти, поэтому событие inotify от записи не вызовет повторный пересчет.
+    """
+    if runtime.user_limits is None:
+        raise control.ControlError("Лимиты не загружены (ошибка чтения user_limits.json)")
+    new_limits = dict(runtime.user_limits)
+    new_limits.update(updates)
+    for email in removals:
+        new_limits.pop(email, None)
+    if new_limits == runtime.user_limits:
+        return {'changed': False, 'applied': False}
+    if not config_manager.save_user_limits(new_limits):
+        raise control.ControlError(f"Не удалось сохранить {common.USER_LIMITS_FILE}")
+    runtime.user_limits = new_limits
+    applied = replan_from_cache(runtime)
+    if not applied:
+        # Кэша онлайн/IP еще нет (первый цикл, сбой цикла): лимит применит внеочередной полный цикл,
+        # событие inotify от записи файла его не запустит - лимиты в памяти уже совпадают с файлом
+        runtime.next_cycle_at = time.monotonic()
+    return {'changed': True, 'applied': applied, 'cycle_scheduled': not applied, 'rules': len(runtime.plan)}
+
+def _control_handlers(runtime, state):
+    """Обработчики команд управляющего сокета (замыкания над данными демона)."""
+
+    def cmd_ping(request):
+        return {'pid': os.getpid()}
+
+    def cmd_set_limit(request):
+        email = request.get('email')
+        if not isinstance(email, str) or not email.strip():
+            raise control.ControlError("Не указан 'email'")
+        return _apply_limits_update(runtime, {email.strip(): _parse_limit(request.get('limit'))}, ())
+
+    def cmd_set_limits(request):
+        limits = request.get('limits')
+        if not isinstance(limits, dict):
+            raise control.ControlError("Ожидается 'limits': { 'email': limit_mbps }")
+        updates = {}
+        removals = []
+        for email, limit in limits.items():
+            if not isinstance(limit, bool) and limit in (0, None): # 0/null - удалить лимит, как в меню; false - ошибка
+                removals.append(email)
+            else:
+                updates[email] = _parse_limit(limit)
+        return _apply_limits_update(runtime, updates, removals)
+
+    def cmd_remove_limit(request):
+        email = request.get('email')
+        if not isinstance(email, str) or email not in (runtime.user_limits or {}):
+            raise control.ControlError(f"Лимит для '{email}' не найден")
+        return _apply_limits_update(runtime, {}, (email,))
+
+    def cmd_cycle(request):
+        result = _run_daemon_cycle(runtime, state)
+        return {'status': result['status'], 'rules': len(runtime.plan), 'timings': runtime.timings}
+
+    def cmd_dump(request):
+        return {
+            'config': {k: v for k, v in runtime.config.items() if k != 'api_pass'},
+            'limits': runtime.user_limits,
+            'limit_source': _limit_source(runtime.config),
+            'panel_limits': runtime.panel_limits,
+            'online_users': sorted(runtime.online_users) if runtime.online_users is not None else None,
+            'user_ips': runtime.user_ips,
+            'plan': runtime.plan,
+            'no_handle_ips': sorted(runtime.handle_allocator.overflow), # IP без правила: исчерпаны handle фильтров
+            'live_ips': sorted(runtime.live_ips) if runtime.live_ips is not None else None,
+            'liveness_exempt_ports': sorted(runtime.liveness_exempt_ports),
+            'connections': [[ip, port, runtime.connection_owners.get((ip, port)), limit]
+                            for (ip, port), limit in sorted(runtime.connection_plan.items())],
+            'panel_ok_at': runtime.panel_ok_at,
+            'api_concurrency_limit': round(runtime.api_limiter.limit, 2),
+            'client_traffic': ({email: runtime.inbound_snapshot.traffic(email) for email in runtime.user_ips}
+                               if runtime.inbound_snapshot is not None else None),
+            'state': state,
+        }
+
+    def cmd_timings(request):
+        return {'timings': runtime.timings,
+                'next_cycle_in_s': round(max(0.0, runtime.next_cycle_at - time.monotonic()), 3)}
+
+    return {
+        'ping': cmd_ping,
+        'set_limit': cmd_set_limit,
+        'set_limits': cmd_set_limits,
+        'remove_limit': cmd_remove_limit,
+        'cycle': cmd_cycle,
+        'dump': cmd_dump,
+        'timings': cmd_timings,
+    }
+
+def main(argv):
+    """
+    Точка входа воркера.
+
+    Args:
+        argv (list): Аргументы командной строки ('--daemon' - режим демона,
+                     '--ctl <команда> [ключ=значение ...]' - команда работающему демону,
+                     '--base-tc' - настройка базы TC (setup_base_tc.sh),
+                     иначе - по таймеру).
+
+    Returns:
+        int: Код выхода процесса.
+    """
+    if '--ctl' in argv:
+        return control.main_cli(argv[argv.index('--ctl') + 1:], timeout=control_timeout(config_manager.load_config()))
+    try:
+        if '--base-tc' in argv:
+            return run_base_tc_mode()
+        if '--daemon' in argv:
+            run_daemon_mode()
+        else:
+            run_timer_mode()
+    except Exception as e:
+        log_worker('critical', "Неперехваченное исключение в главном цикле воркера: %s", e)
+        try:
+            log_worker('critical', "Traceback:\n%s", traceback.format_exc())
+        except Exception:
+            log_worker('error', "Не удалось отформатировать трейсбек.")
+        return 1
+    return 0
@@ -2,15 +2,27 @@
 Модуль для взаимодействия с API панели X-UI.
 - Аутентификация.
 - Получение списка онлайн пользователей.
-- Получение IP-адресов клиента (через API или парсинг лога).
+- Получение IP-адресов клиента (через API, парсинг лога или гибридно: API + отложенный запрос к логу).
+- Кэш результатов получения IP (TTL, LRU, отрицательное кэширование "No IP Record").
+- Снимок всех клиентов панели одним запросом (/panel/api/inbounds/list): статус, срок, трафик.
+- Адаптивное ограничение числа одновременных запросов к панели (AIMD по задержкам и ошибкам).
+- Соединения клиентов (IP, порт) -> email из access.log (разделение общих IP, CGNAT).
+- Альтернативный источник онлайн/IP/трафика в обход панели: gRPC API самого Xray
+  (StatsService, нужен пакет grpcio; сообщения protobuf кодируются вручную).
 """
 
+import ipaddress
 import json
+import re
 import time
 from urllib.parse import quote
 import subprocess
 import os
 import shlex # Для безопасного формирования команд subprocess
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # Импортируем requests и общие модули
 try:
@@ -35,23 +47,453 @@ except ImportError:
     # import sys # sys уже импортирован выше
     # sys.exit(1) # Не выходим, пытаемся работать дальше
 
+import log_utils
+
+# gRPC API Xray - необязательная зависимость (только для stats_backend='xray_grpc')
+try:
+    import grpc
+except ImportError:
+    grpc = None
+
 # --- Константы для выбора метода получения IP ---
 IP_FETCH_API = 'api'
 IP_FETCH_LOG = 'log'
+IP_FETCH_HYBRID = 'hybrid' # API, а если он не ответил за hedge_delay - параллельно лог; побеждает первый ответ
+IP_FETCH_METHODS = (IP_FETCH_API, IP_FETCH_LOG, IP_FETCH_HYBRID)
+
+# Гибридный метод (config.json: 'ip_hedge_delay_sec')
+DEFAULT_HEDGE_DELAY = 0.5 # Секунды ожидания API до запуска запроса к логу (0 - оба источника сразу)
+HEDGE_WORKERS = 8         # Потоков для запросов гибридного метода (на клиента)
+
+# Минимальный таймаут запроса при ограничении дедлайном (секунды): меньше - запрос не отправляем
+MIN_REQUEST_TIMEOUT = 0.5
+
+# Кэш IP по умолчанию (config.json: 'ip_cache_ttl_sec', 'ip_cache_negative_ttl_sec', 'ip_cache_max_entries')
+DEFAULT_IP_CACHE_TTL = 120          # Секунды жизни найденных IP
+DEFAULT_IP_CACHE_NEGATIVE_TTL = 30  # Секунды жизни ответа "IP не найдены"
+DEFAULT_IP_CACHE_MAX_ENTRIES = 10000
+
+# Снимок клиентов панели (config.json: 'inbound_snapshot_interval_sec', 0 - не запрашивать)
+DEFAULT_INBOUND_SNAPSHOT_INTERVAL = 60 # Секунды между обновлениями снимка
+
+# Лимиты скорости в настройках клиентов панели (config.json: 'panel_limit_field', 'panel_limit_tag')
+DEFAULT_PANEL_LIMIT_FIELD = 'limitMbps' # Ключ в объекте клиента settings.clients[] (Мбит/с)
+DEFAULT_PANEL_LIMIT_TAG = 'limit'       # Метка в комментарии клиента: "limit=10", "limit: 10" ('' - не искать)
+
+# Inbound, принимающие клиентов по UDP (один неподключенный сокет на inbound, клиенты не видны в sock_diag)
+UDP_INBOUND_PROTOCOLS = ('hysteria', 'hysteria2', 'wireguard')
+UDP_STREAM_NETWORKS = ('kcp', 'quic')
+
+# Адаптивный лимит параллельных запросов к панели (config.json: 'api_latency_target_sec')
+DEFAULT_API_CONCURRENCY = 4         # Потолок лимита по умолчанию (воркер берет 'ip_fetch_workers')
+DEFAULT_API_LATENCY_TARGET = 1.0    # Секунды: ответ медленнее - признак перегрузки панели
+AIMD_OVERLOAD_BACKOFF = 0.5         # Множитель лимита при таймауте/ошибке соединения/5xx
+AIMD_LATENCY_BACKOFF = 0.9          # Множитель лимита при медленном ответе
+
+# Итог запроса для AdaptiveConcurrencyLimiter.release()
+LIMITER_OK = 'ok'               # Быстрый ответ - лимит растет
+LIMITER_OVERLOAD = 'overload'   # Таймаут, ошибка соединения, 5xx - лимит резко снижается
+LIMITER_IGNORE = 'ignore'       # Не говорит о состоянии панели (бюджет цикла, некорректный запрос)
+
+# gRPC API Xray (config.json: 'stats_backend', 'xray_api_address')
+STATS_BACKEND_PANEL = 'panel'    # HTTP API панели X-UI (XUIApiClient)
+STATS_BACKEND_XRAY = 'xray_grpc' # StatsService Xray напрямую (XrayStatsClient)
+DEFAULT_XRAY_API_ADDRESS = '127.0.0.1:62789' # Адрес API Xray в конфигурации 3x-ui по умолчанию
+XRAY_STATS_SERVICE = 'xray.app.stats.command.StatsService'
 
 # --- Вспомогательная функция для логирования ---
-def _log_api(level, message):
-    """Простое логирование API операций (для отладки)."""
-    try:
-        colors = {'info': common.Color.CYAN, 'error': common.Color.RED, 'warning': common.Color.YELLOW, 'debug': common.Color.DIM}
-        color = colors.get(level.lower(), common.Color.RESET)
-        reset_color = common.Color.RESET
-    except AttributeError: # Если common.Color не определен
-        color = reset_color = ''
+_logger = log_utils.get_logger('api')
+
+def _log_api(level, message, *args):
+    """
+    Логирование API операций через общий слой log_utils.
+    Аргументы подставляются в message (%-формат) только если уровень включен.
+    """
+    _logger.log(log_utils.LOG_LEVELS.get(level.lower(), logging.INFO), message, *args)
+
+
+class IpResolutionCache:
+    """
+    Кэш результатов получения IP по (метод, email) с TTL и вытеснением давно не использованных (LRU).
+    Пустой результат ("No IP Record") кэшируется на отдельный, более короткий срок.
+    Ошибки (None) не кэшируются. Потокобезопасен (запросы IP выполняются параллельно).
+    Состояние сериализуется через to_dict()/load() (файл хранит воркер).
+    """
+
+    def __init__(self, ttl=DEFAULT_IP_CACHE_TTL, negative_ttl=DEFAULT_IP_CACHE_NEGATIVE_TTL,
+                 max_entries=DEFAULT_IP_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # key -> (expires_at, [ip, ...])
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(user_email, method):
+        return f"{method}:{user_email}"
+
+    def get(self, user_email, method):
+        """Возвращает список IP из кэша (может быть пустым) или None при промахе."""
+        key = self._key(user_email, method)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            if entry[1]:
+                self.hits += 1
+            else:
+                self.negative_hits += 1
+            return list(entry[1])
 
-    # Выводим Info, Warn, Error всегда. Debug - опционально.
-    # TODO: Добавить флаг debug_mode для включения DEBUG логов?
-    print(f"{color}[API-{level.upper()}] {message}{reset_color}")
+    def put(self, user_email, method, ip_list):
+        """Сохраняет результат получения IP (None не сохраняется)."""
+        if ip_list is None:
+            return
+        ttl = self.ttl if ip_list else self.negative_ttl
+        if ttl <= 0:
+            return
+        key = self._key(user_email, method)
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, list(ip_list))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def take_stats(self):
+        """Возвращает счетчики попаданий/промахов с прошлого вызова и обнуляет их."""
+        with self._lock:
+            stats = {'hits': self.hits, 'negative_hits': self.negative_hits, 'misses': self.misses,
+                     'size': len(self._entries)}
+            self.hits = self.negative_hits = self.misses = 0
+        return stats
+
+    def to_dict(self):
+        now = time.time()
+        with self._lock:
+            return {'entries': [[key, expires_at, ips] for key, (expires_at, ips) in self._entries.items()
+                                if expires_at > now]}
+
+    def load(self, data):
+        """Восстанавливает непросроченные записи из to_dict() (теплый старт после перезапуска)."""
+        entries = (data or {}).get('entries')
+        if not isinstance(entries, list):
+            return
+        now = time.time()
+        with self._lock:
+            for item in entries[-self.max_entries:]:
+                if (isinstance(item, list) and len(item) == 3 and isinstance(item[0], str)
+                        and isinstance(item[1], (int, float)) and isinstance(item[2], list) and item[1] > now):
+                    self._entries[item[0]] = (item[1], item[2])
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Ограничение одновременных запросов к панели по схеме AIMD:
+    - быстрый успешный ответ: лимит += 1/лимит (примерно +1 за "поколение" запросов);
+    - таймаут (полный API_TIMEOUT, не сокращенный бюджетом цикла), ошибка соединения или 5xx:
+      лимит *= AIMD_OVERLOAD_BACKOFF;
+    - ответ медленнее latency_target: лимит *= AIMD_LATENCY_BACKOFF.
+    Снижение происходит не чаще одного раза на эпизод перегрузки: запросы, начатые до
+    последнего снижения, лимит повторно не уменьшают. Потокобезопасен; живет дольше клиента,
+    чтобы подобранный лимит не сбрасывался при повторном входе.
+    """
+
+    def __init__(self, max_limit=DEFAULT_API_CONCURRENCY, min_limit=1,
+                 latency_target=DEFAULT_API_LATENCY_TARGET):
+        self.max_limit = max(min_limit, max_limit)
+        self.min_limit = min_limit
+        self.latency_target = latency_target
+        self.limit = float(max(min_limit, (self.max_limit + 1) // 2)) # Стартуем с половины потолка
+        self.in_flight = 0
+        self._last_decrease_at = 0.0 # time.monotonic() последнего снижения
+        self._cond = threading.Condition()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.requests = 0
+        self.overloads = 0
+        self.slow = 0
+        self.decreases = 0
+        self.latency_total = 0.0
+        self.peak_in_flight = 0
+
+    def set_max_limit(self, max_limit):
+        """Меняет потолок (например, после изменения 'ip_fetch_workers')."""
+        with self._cond:
+            self.max_limit = max(self.min_limit, max_limit)
+            self.limit = min(self.limit, float(self.max_limit))
+            self._cond.notify_all()
+
+    def acquire(self, deadline=None):
+        """
+        Ждет свободный слот.
+
+        Args:
+            deadline (float, optional): Момент time.monotonic(), после которого ждать бессмысленно.
+
+        Returns:
+            float or None: Время начала запроса (передается в release()) или None, если дедлайн наступил.
+        """
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return time.monotonic()
+
+    def release(self, started, outcome):
+        """Освобождает слот и корректирует лимит по итогу запроса (LIMITER_*)."""
+        now = time.monotonic()
+        latency = now - started
+        with self._cond:
+            self.in_flight -= 1
+            if outcome != LIMITER_IGNORE:
+                self.requests += 1
+                self.latency_total += latency
+                if outcome == LIMITER_OVERLOAD or latency > self.latency_target:
+                    if outcome == LIMITER_OVERLOAD:
+                        self.overloads += 1
+                        factor = AIMD_OVERLOAD_BACKOFF
+                    else:
+                        self.slow += 1
+                        factor = AIMD_LATENCY_BACKOFF
+                    if started >= self._last_decrease_at:
+                        self.limit = max(float(self.min_limit), self.limit * factor)
+                        self._last_decrease_at = now
+                        self.decreases += 1
+                else:
+                    self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def take_stats(self):
+        """Возвращает статистику с прошлого вызова (и обнуляет счетчики)."""
+        with self._cond:
+            stats = {'limit': round(self.limit, 2), 'max_limit': self.max_limit, 'requests': self.requests,
+                     'overloads': self.overloads, 'slow': self.slow, 'decreases': self.decreases,
+                     'peak_in_flight': self.peak_in_flight,
+                     'avg_latency_s': self.latency_total / self.requests if self.requests else 0.0}
+            self._reset_stats()
+        return stats
+
+
+def _parse_limit_value(value):
+    """Лимит из поля/метки клиента: положительное число (int, если целое) или None."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str):
+        try:
+            value = float(value.strip())
+        except ValueError:
+            return None
+    if not isinstance(value, (int, float)) or not value > 0 or value == float('inf'):
+        return None
+    return int(value) if value == int(value) else value
+
+
+class InboundSnapshot:
+    """
+    Снимок клиентов всех inbound из /panel/api/inbounds/list (один запрос вместо N).
+    clients: { email: {'inbound_id', 'port', 'udp' (inbound принимает клиентов по UDP), 'inbound_enable', 'enable',
+                       'expiry_time' (мс, 0 - бессрочно), 'up', 'down', 'total' (байт, 0 - без квоты),
+                       'settings' (объект клиента из настроек inbound)} }
+    """
+
+    def __init__(self, clients, fetched_at=None):
+        self.clients = clients
+        self.fetched_at = fetched_at if fetched_at is not None else time.time()
+
+    @classmethod
+    def from_inbounds(cls, inbounds, fetched_at=None):
+        """Разбирает поле 'obj' ответа inbounds/list (некорректные элементы пропускаются)."""
+        clients = {}
+        for inbound in inbounds:
+            if not isinstance(inbound, dict):
+                continue
+            settings = inbound.get('settings')
+            if isinstance(settings, str): # Панель отдает настройки inbound JSON-строкой
+                try:
+                    settings = json.loads(settings)
+                except json.JSONDecodeError:
+                    settings = None
+            settings_clients = settings.get('clients') if isinstance(settings, dict) else None
+            udp = cls._inbound_udp(inbound, settings)
+            client_settings = {c['email']: c for c in settings_clients or []
+                               if isinstance(c, dict) and isinstance(c.get('email'), str)}
+            for stats in inbound.get('clientStats') or []:
+                if not isinstance(stats, dict) or not isinstance(stats.get('email'), str):
+                    continue
+                email = stats['email']
+                client = client_settings.get(email, {})
+                entry = {
+                    'inbound_id': inbound.get('id'),
+                    'port': inbound.get('port'),
+                    'udp': udp,
+                    'inbound_enable': inbound.get('enable', True) is not False,
+                    'enable': stats.get('enable', True) is not False and client.get('enable', True) is not False,
+                    'expiry_time': stats.get('expiryTime') or 0,
+                    'up': stats.get('up') or 0,
+                    'down': stats.get('down') or 0,
+                    'total': stats.get('total') or 0,
+                    'settings': client,
+                }
+                previous = clients.get(email)
+                # Email в панели уникален; при дубликатах предпочитаем действующую запись
+                if previous is None or not cls._entry_active(previous, time.time()):
+                    clients[email] = entry
+        return cls(clients, fetched_at)
+
+    @classmethod
+    def from_traffic(cls, traffic, fetched_at=None):
+        """
+        Снимок из счетчиков трафика {email: {'up', 'down'}} (XrayStatsClient.get_user_traffic()).
+        У Xray нет настроек клиентов панели: все клиенты активны, без порта, срока, квоты и лимитов.
+        """
+        clients = {email: {'inbound_id': None, 'port': None, 'udp': False, 'inbound_enable': True, 'enable': True,
+                           'expiry_time': 0, 'up': counters['up'], 'down': counters['down'], 'total': 0,
+                           'settings': {}}
+                   for email, counters in traffic.items()}
+        return cls(clients, fetched_at)
+
+    @staticmethod
+    def _inbound_udp(inbound, settings):
+        """
+        Принимает ли inbound клиентов по UDP: протоколы поверх UDP (Hysteria, WireGuard),
+        транспорт mKCP/QUIC в streamSettings или 'network' с udp (Shadowsocks, dokodemo-door).
+        """
+        if inbound.get('protocol') in UDP_INBOUND_PROTOCOLS:
+            return True
+        stream = inbound.get('streamSettings')
+        if isinstance(stream, str): # Как и settings, приходит JSON-строкой
+            try:
+                stream = json.loads(stream)
+            except json.JSONDecodeError:
+                stream = None
+        if isinstance(stream, dict) and stream.get('network') in UDP_STREAM_NETWORKS:
+            return True
+        network = settings.get('network') if isinstance(settings, dict) else None
+        return isinstance(network, str) and 'udp' in network.split(',')
+
+    @staticmethod
+    def _entry_active(entry, now):
+        if not entry['inbound_enable'] or not entry['enable']:
+            return False
+        expiry = entry['expiry_time']
+        # Отрицательный срок - "отсчет с первого подключения", клиент еще не истек
+        if isinstance(expiry, (int, float)) and 0 < expiry <= now * 1000:
+            return False
+        total = entry['total']
+        if isinstance(total, (int, float)) and total > 0 and entry['up'] + entry['down'] >= total:
+            return False # Квота трафика исчерпана (панель сама отключит клиента)
+        return True
+
+    def is_active(self, email, now=None):
+        """False, если клиент отключен, истек или исчерпал квоту. Неизвестный снимку клиент считается активным."""
+        entry = self.clients.get(email)
+        if entry is None:
+            return True
+        return self._entry_active(entry, time.time() if now is None else now)
+
+    def ports(self):
+        """Порты включенных inbound, к которым относятся клиенты снимка."""
+        return {entry['port'] for entry in self.clients.values()
+                if entry['inbound_enable'] and isinstance(entry['port'], int) and 0 < entry['port'] < 65536}
+
+    def udp_ports(self):
+        """Порты включенных inbound, принимающих клиентов по UDP."""
+        return {entry['port'] for entry in self.clients.values()
+                if entry['udp'] and entry['inbound_enable'] and isinstance(entry['port'], int) and 0 < entry['port'] < 65536}
+
+    def port(self, email):
+        """Порт inbound клиента или None, если он неизвестен снимку."""
+        entry = self.clients.get(email)
+        return entry['port'] if entry is not None else None
+
+    def limits(self, field=DEFAULT_PANEL_LIMIT_FIELD, tag=DEFAULT_PANEL_LIMIT_TAG):
+        """
+        Лимиты скорости из настроек клиентов: сначала поле field объекта клиента,
+        затем метка tag в комментарии ('limit=10'). Значения <= 0 и нечисловые пропускаются.
+
+        Returns:
+            dict: { email: limit_mbps }
+        """
+        pattern = re.compile(rf'(?<![\w-]){re.escape(tag)}\s*[:=]\s*(\d+(?:\.\d+)?)', re.IGNORECASE) if tag else None
+        limits = {}
+        for email, entry in self.clients.items():
+            settings = entry['settings']
+            limit = _parse_limit_value(settings.get(field)) if field else None
+            if limit is None and pattern is not None and isinstance(settings.get('comment'), str):
+                match = pattern.search(settings['comment'])
+                if match:
+                    limit = _parse_limit_value(match.group(1))
+            if limit is not None:
+                limits[email] = limit
+        return limits
+
+    def traffic(self, email):
+        """Трафик клиента {'up', 'down', 'total'} в байтах или None, если клиента нет в снимке."""
+        entry = self.clients.get(email)
+        if entry is None:
+            return None
+        return {'up': entry['up'], 'down': entry['down'], 'total': entry['total']}
+
+
+# --- Соединения клиентов из access.log Xray ---
+
+# '... from [tcp:]1.2.3.4:51234 accepted tcp:host:443 [in >> out] email: user'
+_ACCESS_LOG_CONNECTION_RE = re.compile(
+    r'\bfrom\s+(?:(?:tcp|udp):)?(\[[0-9a-fA-F:.]+\]|\d{1,3}(?:\.\d{1,3}){3}):(\d{1,5})\s+accepted\b.*?\bemail:\s*(\S+)')
+
+def parse_access_log_connections(lines):
+    """
+    Соединения клиентов из строк access.log: адрес клиента (IP, порт) -> email.
+    Более поздняя строка для того же адреса перезаписывает раннюю.
+
+    Args:
+        lines (iterable): Строки лога в порядке записи.
+
+    Returns:
+        dict: { (ip, port): email }.
+    """
+    connections = {}
+    for line in lines:
+        match = _ACCESS_LOG_CONNECTION_RE.search(line)
+        if not match:
+            continue
+        try:
+            ip = str(ipaddress.ip_address(match.group(1).strip('[]')))
+        except ValueError:
+            continue
+        connections[(ip, int(match.group(2)))] = match.group(3)
+    return connections
+
+def read_access_log_connections(log_file_path, log_read_lines):
+    """
+    Читает последние log_read_lines строк access.log и возвращает его соединения (см. parse_access_log_connections).
+
+    Returns:
+        dict or None: { (ip, port): email } или None, если лог не прочитан.
+    """
+    try:
+        result = subprocess.run(['tail', '-n', str(log_read_lines), log_file_path], capture_output=True,
+                                text=True, check=True, encoding='utf-8', errors='ignore')
+    except (OSError, subprocess.CalledProcessError) as e:
+        _log_api('error', "Не удалось прочитать лог %s для соединений клиентов: %s", log_file_path, e)
+        return None
+    return parse_access_log_connections(result.stdout.splitlines())
 
 
 class XUIApiClient:
@@ -61,7 +503,8 @@ class XUIApiClient:
     """
     def __init__(self, panel_url, username, password,
                  log_file_path="/usr/local/x-ui/access.log",
-                 log_read_lines=500):
+                 log_read_lines=500, deadline=None, ip_cache=None, hedge_delay=DEFAULT_HEDGE_DELAY,
+                 limiter=None, snapshot_interval=DEFAULT_INBOUND_SNAPSHOT_INTERVAL):
         """
         Инициализация клиента. Выполняет вход.
 
@@ -71,12 +514,96 @@ class XUIApiClient:
             password (str): Пароль пользователя панели.
             log_file_path (str): Путь к файлу access.log Xray (для метода 'log').
             log_read_lines (int): Сколько последних строк лога читать (для метода 'log').
+            deadline (float, optional): Момент time.monotonic(), после которого запросы не отправляются
+                                        (бюджет цикла воркера). None - без ограничения.
+            ip_cache (IpResolutionCache, optional): Кэш результатов get_client_ip_addresses.
+            hedge_delay (float): Для метода 'hybrid' - сколько секунд ждать ответа API
+                                 перед запуском запроса к логу (0 - запускать оба сразу).
+            limiter (AdaptiveConcurrencyLimiter, optional): Ограничение параллельных запросов к панели.
+                                                            None - без ограничения.
+            snapshot_interval (float): Срок годности снимка inbounds/list в секундах (0 - снимок не запрашивается).
         """
         self.panel_url = panel_url.rstrip('/')
         self.log_file_path = log_file_path
         self.log_read_lines = log_read_lines
+        self.deadline = deadline
+        self.ip_cache = ip_cache
+        self.hedge_delay = hedge_delay
+        self.limiter = limiter
+        self.snapshot_interval = snapshot_interval
+        self._inbound_snapshot = None
+        self._hedge_executor = None # Создается при первом запросе методом 'hybrid'
+        self._hedge_lock = threading.Lock()
+        self._hedge_stats = {'api': 0, 'log': 0, 'none': 0, 'hedged': 0}
         self.session = self._login(username, password) # Получаем сессию при инициализации
 
+    def close(self):
+        """Освобождает потоки гибридного метода (незавершенные запросы дорабатывают в фоне)."""
+        with self._hedge_lock:
+            executor, self._hedge_executor = self._hedge_executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def take_hedge_stats(self):
+        """
+        Счетчики гибридного метода с прошлого вызова (и обнуляет их):
+        'api'/'log' - чей ответ использован, 'none' - оба источника не дали IP или ошибка,
+        'hedged' - сколько раз запускался запрос к логу.
+        """
+        with self._hedge_lock:
+            stats = dict(self._hedge_stats)
+            for key in self._hedge_stats:
+                self._hedge_stats[key] = 0
+        return stats
+
+    def _request_timeout(self):
+        """
+        Таймаут очередного запроса: min(API_TIMEOUT, остаток до дедлайна).
+
+        Raises:
+            requests.exceptions.Timeout: Если до дедлайна осталось меньше MIN_REQUEST_TIMEOUT.
+        """
+        if self.deadline is None:
+            return common.API_TIMEOUT
+        remaining = self.deadline - time.monotonic()
+        if remaining < MIN_REQUEST_TIMEOUT:
+            raise requests.exceptions.Timeout("Бюджет времени цикла исчерпан")
+        return min(common.API_TIMEOUT, remaining)
+
+    def _post(self, url, session=None, **kwargs):
+        return self._request('POST', url, session=session, **kwargs)
+
+    def _request(self, http_method, url, session=None, **kwargs):
+        """
+        Запрос к панели через адаптивный ограничитель (если задан): ждет слот, а по итогу
+        (задержка, таймаут, ошибка соединения, 5xx) корректирует лимит.
+
+        Raises:
+            requests.exceptions.RequestException: Как session.request; Timeout - также при исчерпании бюджета цикла.
+        """
+        session = session or self.session
+        if self.limiter is None:
+            return session.request(http_method, url, timeout=self._request_timeout(), **kwargs)
+        started = self.limiter.acquire(self.deadline)
+        if started is None:
+            raise requests.exceptions.Timeout("Бюджет времени цикла исчерпан (ожидание слота запроса к панели)")
+        outcome = LIMITER_IGNORE # Исчерпанный бюджет и ошибки запроса не говорят о состоянии панели
+        try:
+            timeout = self._request_timeout()
+            try:
+                response = session.request(http_method, url, timeout=timeout, **kwargs)
+            except requests.exceptions.Timeout:
+                # Таймаут, сокращенный бюджетом цикла, не говорит о перегрузке панели
+                outcome = LIMITER_OVERLOAD if timeout >= common.API_TIMEOUT else LIMITER_IGNORE
+                raise
+            except requests.exceptions.ConnectionError:
+                outcome = LIMITER_OVERLOAD
+                raise
+            outcome = LIMITER_OVERLOAD if response.status_code >= 500 else LIMITER_OK
+            return response
+        finally:
+            self.limiter.release(started, outcome)
+
     def _login(self, username, password):
         """
         Выполняет вход в панель и возвращает объект сессии requests.
@@ -88,8 +615,8 @@ class XUIApiClient:
         login_data = {'username': username, 'password': password}
 
         try:
-            _log_api('debug', f"Попытка входа в API: {login_url} с пользователем '{username}'")
-            response = session.post(login_url, data=login_data, timeout=common.API_TIMEOUT)
+            _log_api('debug', "Попытка входа в API: %s с пользователем '%s'", login_url, username)
+            response = self._post(login_url, session=session, data=login_data)
             response.raise_for_status()
 
             # Проверка ответа (как в твоей функции get_xui_session)
@@ -97,43 +624,43 @@ class XUIApiClient:
                 if 'application/json' in response.headers.get('Content-Type', ''):
                     result = response.json()
                     if result.get("success"):
-                        _log_api('info', f"Успешный вход в API X-UI (JSON): {self.panel_url}")
+                        _log_api('info', "Успешный вход в API X-UI (JSON): %s", self.panel_url)
                         if '3x-ui' in session.cookies or '3x-ui=' in response.headers.get('Set-Cookie', ''):
                              return session
                         else:
-                             _log_api('warning', f"Вход в API (JSON) успешен, но куки '3x-ui' не установлены.")
+                             _log_api('warning', "Вход в API (JSON) успешен, но куки '3x-ui' не установлены.")
                              raise ConnectionError("Не удалось получить сессионные куки после успешного входа (JSON).")
                     else:
                         error_msg = result.get('msg', 'Неизвестная ошибка ответа API')
-                        _log_api('error', f"Ошибка входа в API X-UI (success=false): {error_msg}")
+                        _log_api('error', "Ошибка входа в API X-UI (success=false): %s", error_msg)
                         raise ConnectionError(f"Ошибка входа в API X-UI: {error_msg}")
                 elif '3x-ui' in session.cookies or '3x-ui=' in response.headers.get('Set-Cookie', ''):
-                     _log_api('info', f"Успешный вход в API X-UI (не-JSON ответ, но куки '3x-ui' установлены): {self.panel_url}")
+                     _log_api('info', "Успешный вход в API X-UI (не-JSON ответ, но куки '3x-ui' установлены): %s", self.panel_url)
                      return session
                 else:
-                     _log_api('error', f"Не удалось войти в API: получен не-JSON ответ и куки '3x-ui' не установлены. Status: {response.status_code}.")
+                     _log_api('error', "Не удалось войти в API: получен не-JSON ответ и куки '3x-ui' не установлены. Status: %s.", response.status_code)
                      raise ConnectionError("Не удалось войти в API: не JSON и нет куки.")
 
             except json.JSONDecodeError:
                 if '3x-ui' in session.cookies or '3x-ui=' in response.headers.get('Set-Cookie', ''):
-                     _log_api('info', f"Успешный вход в API X-UI (ответ не JSON, но куки '3x-ui' установлены): {self.panel_url}")
+                     _log_api('info', "Успешный вход в API X-UI (ответ не JSON, но куки '3x-ui' установлены): %s", self.panel_url)
                      return session
                 else:
-                     _log_api('error', f"Не удалось войти в API: ответ не JSON и куки '3x-ui' не установлены.")
+                     _log_api('error', "Не удалось войти в API: ответ не JSON и куки '3x-ui' не установлены.")
                      raise ConnectionError("Не удалось войти в API: не JSON и нет куки.")
 
         except requests.exceptions.Timeout:
-            _log_api('error', f"Таймаут ({common.API_TIMEOUT} сек) при подключении к API: {login_url}")
+            _log_api('error', "Таймаут (%s сек) при подключении к API: %s", common.API_TIMEOUT, login_url)
             raise ConnectionError(f"Таймаут при подключении к {login_url}")
         except requests.exceptions.ConnectionError as e:
-             _log_api('error', f"Ошибка соединения с API {login_url}: {e}")
+             _log_api('error', "Ошибка соединения с API %s: %s", login_url, e)
              raise ConnectionError(f"Ошибка соединения с {login_url}: {e}")
         except requests.exceptions.HTTPError as e:
              body_preview = e.response.text[:200] if hasattr(e.response, 'text') else '(нет тела)'
-             _log_api('error', f"HTTP ошибка при входе в API {login_url}: {e.response.status_code} {e.response.reason}. Body(start): {body_preview}...")
+             _log_api('error', "HTTP ошибка при входе в API %s: %s %s. Body(start): %s...", login_url, e.response.status_code, e.response.reason, body_preview)
              raise ConnectionError(f"HTTP ошибка при входе в API: {e.response.status_code}")
         except requests.exceptions.RequestException as e:
-            _log_api('error', f"Общая ошибка запроса при входе в API {login_url}: {e}")
+            _log_api('error', "Общая ошибка запроса при входе в API %s: %s", login_url, e)
             raise ConnectionError(f"Ошибка запроса при входе в API: {e}")
 
     def get_online_users_emails(self):
@@ -147,8 +674,8 @@ class XUIApiClient:
 
         online_users_url = f"{self.panel_url}/panel/api/inbounds/onlines"
         try:
-            _log_api('debug', f"Запрос списка онлайн пользователей: {online_users_url}")
-            response = self.session.post(online_users_url, timeout=common.API_TIMEOUT)
+            _log_api('debug', "Запрос списка онлайн пользователей: %s", online_users_url)
+            response = self._post(online_users_url)
             response.raise_for_status()
 
             try:
@@ -156,24 +683,64 @@ class XUIApiClient:
                 if data.get("success"):
                     online_list = data.get("obj", [])
                     if isinstance(online_list, list):
-                         _log_api('info', f"Получено {len(online_list)} онлайн пользователей из API.")
+                         _log_api('info', "Получено %d онлайн пользователей из API.", len(online_list))
                          return set(online_list)
                     else:
-                         _log_api('error', f"API вернуло некорректный формат списка онлайн ('obj' не список): {type(online_list)}")
+                         _log_api('error', "API вернуло некорректный формат списка онлайн ('obj' не список): %s", type(online_list))
                          return None # Возвращаем None при ошибке формата
                 else:
                     error_msg = data.get('msg', 'Неизвестная ошибка API')
-                    _log_api('error', f"Ошибка API при получении онлайн (success=false): {error_msg}")
+                    _log_api('error', "Ошибка API при получении онлайн (success=false): %s", error_msg)
                     return None # Возвращаем None при ошибке API
             except json.JSONDecodeError:
-                 _log_api('error', f"Не удалось декодировать JSON ответа API онлайн: {response.text[:200]}...")
+                 _log_api('error', "Не удалось декодировать JSON ответа API онлайн: %s...", response.text[:200])
                  return None # Возвращаем None при ошибке парсинга
 
         # Обработка исключений requests как в твоем коде
-        except requests.exceptions.Timeout: _log_api('error', f"Таймаут онлайн"); return None
-        except requests.exceptions.ConnectionError as e: _log_api('error', f"Ошибка соединения онлайн: {e}"); return None
-        except requests.exceptions.HTTPError as e: _log_api('error', f"HTTP ошибка онлайн: {e.response.status_code}"); return None
-        except requests.exceptions.RequestException as e: _log_api('error', f"Ошибка запроса онлайн: {e}"); return None
+        except requests.exceptions.Timeout: _log_api('error', "Таймаут онлайн"); return None
+        except requests.exceptions.ConnectionError as e: _log_api('error', "Ошибка соединения онлайн: %s", e); return None
+        except requests.exceptions.HTTPError as e: _log_api('error', "HTTP ошибка онлайн: %s", e.response.status_code); return None
+        except requests.exceptions.RequestException as e: _log_api('error', "Ошибка запроса онлайн: %s", e); return None
+
+    def get_inbounds_snapshot(self, force=False):
+        """
+        Снимок клиентов всех inbound (статус, срок, трафик) одним запросом /panel/api/inbounds/list.
+        Снимок переиспользуется, пока не старше snapshot_interval.
+
+        Args:
+            force (bool): Запросить снимок заново, даже если кэш еще свежий.
+
+        Returns:
+            InboundSnapshot or None: Снимок; при ошибке запроса - предыдущий (устаревший) снимок,
+                                     None - если снимок отключен или еще ни разу не был получен.
+        """
+        if self.snapshot_interval <= 0:
+            return None
+        cached = self._inbound_snapshot
+        if not force and cached is not None and time.time() - cached.fetched_at < self.snapshot_interval:
+            return cached
+        if not self.session:
+            _log_api('error', "Получение списка inbound: Сессия API недействительна.")
+            return cached
+
+        inbounds_url = f"{self.panel_url}/panel/api/inbounds/list"
+        try:
+            _log_api('debug', "Запрос списка inbound: %s", inbounds_url)
+            response = self._request('GET', inbounds_url)
+            response.raise_for_status()
+            data = response.json()
+            if not data.get("success") or not isinstance(data.get("obj"), list):
+                _log_api('error', "API вернуло некорректный список inbound: %s", data.get('msg', type(data.get('obj'))))
+                return cached
+        except json.JSONDecodeError:
+            _log_api('error', "Не удалось декодировать JSON списка inbound: %s...", response.text[:200])
+            return cached
+        except requests.exceptions.HTTPError as e: _log_api('error', "HTTP ошибка списка inbound: %s", e.response.status_code); return cached
+        except requests.exceptions.RequestException as e: _log_api('error', "Ошибка запроса списка inbound: %s", e); return cached
+
+        self._inbound_snapshot = InboundSnapshot.from_inbounds(data['obj'])
+        _log_api('debug', "Снимок inbound: %d inbound, %d клиентов.", len(data['obj']), len(self._inbound_snapshot.clients))
+        return self._inbound_snapshot
 
     def _get_client_ip_from_api(self, user_email):
         """
@@ -181,70 +748,70 @@ class XUIApiClient:
         Возвращает список строк IP или пустой список. None при ошибке связи/парсинга.
         """
         if not self.session:
-            _log_api('error', f"Получение IP (API) для '{user_email}': Сессия недействительна.")
+            _log_api('error', "Получение IP (API) для '%s': Сессия недействительна.", user_email)
             return None # Ошибка сессии
 
         encoded_email = quote(user_email)
         client_ips_url = f"{self.panel_url}/panel/api/inbounds/clientIps/{encoded_email}"
-        _log_api('debug', f"Запрос IP (API) для '{user_email}': {client_ips_url}")
+        _log_api('debug', "Запрос IP (API) для '%s': %s", user_email, client_ips_url)
 
         try:
-            response = self.session.post(client_ips_url, timeout=common.API_TIMEOUT)
-            _log_api('debug', f"Ответ API для IP '{user_email}': Status={response.status_code}, Body='{response.text[:100]}'")
+            response = self._post(client_ips_url)
+            _log_api('debug', "Ответ API для IP '%s': Status=%s, Body='%.100s'", user_email, response.status_code, response.text)
 
             if response.status_code == 404:
-                _log_api('debug', f"API вернуло 404 для '{user_email}'. Считаем как 'не найдено'.")
+                _log_api('debug', "API вернуло 404 для '%s'. Считаем как 'не найдено'.", user_email)
                 return [] # 404 - не ошибка связи, а "не найдено"
 
             response.raise_for_status() # Проверяем на другие ошибки (5xx, 401 и т.д.)
 
             try:
                 data = response.json()
-                _log_api('debug', f"Распарсенный JSON для IP (API) '{user_email}': {data}")
+                _log_api('debug', "Распарсенный JSON для IP (API) '%s': %s", user_email, data)
                 if data.get("success"):
                     ip_list_obj = data.get("obj")
-                    _log_api('debug', f"Поле 'obj' для IP (API) '{user_email}': {ip_list_obj} (тип: {type(ip_list_obj)})")
+                    _log_api('debug', "Поле 'obj' для IP (API) '%s': %s (тип: %s)", user_email, ip_list_obj, type(ip_list_obj))
 
                     # Обрабатываем и строку "No IP Record", и потенциальный список IP
                     if isinstance(ip_list_obj, str):
                         if "no ip record" in ip_list_obj.lower():
-                            _log_api('debug', f"API вернуло 'No IP Record' для '{user_email}'.")
+                            _log_api('debug', "API вернуло 'No IP Record' для '%s'.", user_email)
                             return [] # Нормальный ответ "не найдено"
                         else:
                             # Если вернулась строка, но это не "No IP Record", считаем, что это IP
                             valid_ip = ip_list_obj.strip()
                             if valid_ip:
-                                 _log_api('debug', f"API вернуло один IP как строку для '{user_email}': {valid_ip}")
+                                 _log_api('debug', "API вернуло один IP как строку для '%s': %s", user_email, valid_ip)
                                  return [valid_ip]
                             else:
-                                 _log_api('warning', f"API для IP '{user_email}' вернуло пустую строку в 'obj'.")
+                                 _log_api('warning', "API для IP '%s' вернуло пустую строку в 'obj'.", user_email)
                                  return []
                     elif isinstance(ip_list_obj, list):
                         valid_ips = [ip for ip in ip_list_obj if isinstance(ip, str) and ip.strip()]
-                        if valid_ips: _log_api('debug', f"API вернуло список IP для '{user_email}': {valid_ips}")
+                        if valid_ips: _log_api('debug', "API вернуло список IP для '%s': %s", user_email, valid_ips)
                         return valid_ips # Возвращаем список строк
                     else:
                         # Не строка и не список - неожиданный формат
-                        _log_api('warning', f"API для IP '{user_email}' вернуло неожиданный тип obj: {type(ip_list_obj)}")
+                        _log_api('warning', "API для IP '%s' вернуло неожиданный тип obj: %s", user_email, type(ip_list_obj))
                         return [] # Считаем как "не найдено"
                 else:
                     # success=false
                     error_msg = data.get('msg', 'Неизвестная ошибка API').lower()
                     if "client not found" not in error_msg and "клиент не найден" not in error_msg:
-                        _log_api('warning', f"Ошибка API при получении IP для '{user_email}' (success=false): {data.get('msg', 'Неизвестная ошибка')}")
+                        _log_api('warning', "Ошибка API при получении IP для '%s' (success=false): %s", user_email, data.get('msg', 'Неизвестная ошибка'))
                     else:
-                         _log_api('debug', f"API сообщило, что клиент '{user_email}' не найден.")
+                         _log_api('debug', "API сообщило, что клиент '%s' не найден.", user_email)
                     return [] # Success=false считаем как "не найдено" (не ошибка связи)
 
             except json.JSONDecodeError:
-                _log_api('error', f"Не удалось декодировать JSON ответа API IP для '{user_email}': {response.text[:200]}...")
+                _log_api('error', "Не удалось декодировать JSON ответа API IP для '%s': %s...", user_email, response.text[:200])
                 return None # Ошибка парсинга - возвращаем None
 
         # Обработка исключений requests (возвращаем None при ошибках связи/http)
-        except requests.exceptions.Timeout: _log_api('error', f"Таймаут IP (API) '{user_email}'"); return None
-        except requests.exceptions.ConnectionError as e: _log_api('error', f"Ошибка соединения IP (API) '{user_email}': {e}"); return None
-        except requests.exceptions.HTTPError as e: _log_api('error', f"HTTP ошибка IP (API) '{user_email}': {e.response.status_code}"); return None
-        except requests.exceptions.RequestException as e: _log_api('error', f"Ошибка запроса IP (API) '{user_email}': {e}"); return None
+        except requests.exceptions.Timeout: _log_api('error', "Таймаут IP (API) '%s'", user_email); return None
+        except requests.exceptions.ConnectionError as e: _log_api('error', "Ошибка соединения IP (API) '%s': %s", user_email, e); return None
+        except requests.exceptions.HTTPError as e: _log_api('error', "HTTP ошибка IP (API) '%s': %s", user_email, e.response.status_code); return None
+        except requests.exceptions.RequestException as e: _log_api('error', "Ошибка запроса IP (API) '%s': %s", user_email, e); return None
 
     def _get_client_ip_from_log(self, user_email):
         """
@@ -252,14 +819,14 @@ class XUIApiClient:
         Возвращает список с одним IP (str) или пустой список. None при ошибке доступа/парсинга.
         """
         if not os.path.exists(self.log_file_path):
-            _log_api('error', f"Парсинг лога для '{user_email}': Файл лога не найден: {self.log_file_path}")
+            _log_api('error', "Парсинг лога для '%s': Файл лога не найден: %s", user_email, self.log_file_path)
             return None # Ошибка - файл не найден
 
-        _log_api('debug', f"Парсинг лога для IP '{user_email}' из {self.log_file_path} ({self.log_read_lines} строк)")
+        _log_api('debug', "Парсинг лога для IP '%s' из %s (%s строк)", user_email, self.log_file_path, self.log_read_lines)
         try:
             # Формируем команду безопасно с помощью shlex
             tail_command_list = ['tail', '-n', str(self.log_read_lines), self.log_file_path]
-            _log_api('debug', f"Выполнение команды: {' '.join(shlex.quote(c) for c in tail_command_list)}")
+            _log_api('debug', "Выполнение команды: %s", shlex.join(tail_command_list))
 
             # Выполняем команду tail
             process = subprocess.run(
@@ -280,71 +847,458 @@ class XUIApiClient:
                     # Ищем "from IP:PORT" - обычно это 2 и 3 части строки
                     if len(parts) >= 4 and parts[2] == 'from' and ':' in parts[3]:
                         ip_port = parts[3] # Берем четвертый элемент
-                        ip = ip_port.split(':')[0]
+                        # 'tcp:IP:PORT', '[IPv6]:PORT' - адрес до последнего ':' без префикса сети и скобок
+                        for network_prefix in ('tcp:', 'udp:'):
+                            if ip_port.startswith(network_prefix):
+                                ip_port = ip_port[len(network_prefix):]
+                        ip = ip_port.rpartition(':')[0].strip('[]')
                         # Простая валидация IP (наличие точки или двоеточия)
                         if '.' in ip or ':' in ip:
                             found_ip = ip
-                            _log_api('debug', f"Найден IP '{found_ip}' в логе для '{user_email}' в строке: {line.strip()}")
+                            _log_api('debug', "Найден IP '%s' в логе для '%s' в строке: %s", found_ip, user_email, line.strip())
                             break # Нашли самый свежий, выходим
                         else:
-                           _log_api('warning', f"Некорректный IP '{ip}' извлечен из строки лога: {line.strip()}")
+                           _log_api('warning', "Некорректный IP '%s' извлечен из строки лога: %s", ip, line.strip())
                     else:
                          # Строка содержит email, но формат не стандартный 'from IP:PORT'
-                         _log_api('warning', f"Не удалось извлечь 'IP:PORT' после 'from' из строки лога с email '{user_email}': {line.strip()}")
+                         _log_api('warning', "Не удалось извлечь 'IP:PORT' после 'from' из строки лога с email '%s': %s", user_email, line.strip())
 
 
             if found_ip:
-                _log_api('info', f"IP найден через парсинг лога для '{user_email}': {found_ip}")
+                _log_api('debug', "IP найден через парсинг лога для '%s': %s", user_email, found_ip)
                 return [found_ip] # Возвращаем список с одним IP
             else:
-                _log_api('info', f"IP для '{user_email}' не найден в последних {self.log_read_lines} строках лога.")
+                _log_api('debug', "IP для '%s' не найден в последних %s строках лога.", user_email, self.log_read_lines)
                 return [] # Не нашли - возвращаем пустой список
 
         except FileNotFoundError:
-             _log_api('error', f"Ошибка парсинга лога: команда 'tail' не найдена. Убедитесь, что она установлена и доступна в PATH.")
+             _log_api('error', "Ошибка парсинга лога: команда 'tail' не найдена. Убедитесь, что она установлена и доступна в PATH.")
              return None # Ошибка - нет tail
         except subprocess.CalledProcessError as e:
             # tail может вернуть ошибку, если файл не существует или нет прав
-            _log_api('error', f"Ошибка выполнения команды tail для {self.log_file_path}: {e}. Stderr: {e.stderr}")
+            _log_api('error', "Ошибка выполнения команды tail для %s: %s. Stderr: %s", self.log_file_path, e, e.stderr)
             return None # Ошибка выполнения tail
         except Exception as e:
-            _log_api('error', f"Непредвиденная ошибка при парсинге лога {self.log_file_path} для '{user_email}': {e}")
+            _log_api('error', "Непредвиденная ошибка при парсинге лога %s для '%s': %s", self.log_file_path, user_email, e)
             return None # Другая ошибка
 
+    def _get_client_ip_hedged(self, user_email):
+        """
+        [Внутренний метод] Гибридное получение IP: запрос к API, а если он не ответил
+        за hedge_delay (или ответил без IP / с ошибкой) - параллельно поиск в логе.
+        Используется первый непустой ответ; пустой список - только если оба источника пусты.
+        Проигравший запрос не прерывается и завершается в фоне.
+
+        Returns:
+            list or None: Как у get_client_ip_addresses; None, если оба источника вернули ошибку.
+        """
+        with self._hedge_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS,
+                                                          thread_name_prefix='xsl-hedge')
+            executor = self._hedge_executor
+
+        api_future = executor.submit(self._get_client_ip_from_api, user_email)
+        sources = {api_future: 'api'}
+        pending = {api_future}
+        if self.hedge_delay > 0:
+            wait(pending, timeout=self.hedge_delay)
+
+        def start_log_lookup():
+            future = executor.submit(self._get_client_ip_from_log, user_email)
+            sources[future] = 'log'
+            pending.add(future)
+
+        winner, result = None, None
+        if not api_future.done(): # API не успел за hedge_delay
+            start_log_lookup()
+        while winner is None and pending:
+            done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+            pending.intersection_update(not_done)
+            for future in sorted(done, key=sources.get): # При одновременном ответе приоритет у API
+                try:
+                    value = future.result()
+                except Exception as e:
+                    _log_api('error', "Ошибка запроса IP (%s) для '%s': %s", sources[future], user_email, e)
+                    value = None
+                if value:
+                    winner, result = sources[future], value
+                    break
+                if value is not None:
+                    result = value # Пустой ответ: запоминаем, но ждем второй источник
+            if winner is None and len(sources) == 1: # API ответил без IP или с ошибкой
+                start_log_lookup()
+
+        log_started = len(sources) > 1
+        with self._hedge_lock:
+            self._hedge_stats[winner or 'none'] += 1
+            if log_started:
+                self._hedge_stats['hedged'] += 1
+        if winner is not None:
+            _log_api('debug', "Гибридный метод для '%s': ответ от '%s'", user_email, winner)
+        return result
+
     def get_client_ip_addresses(self, user_email, method=IP_FETCH_API):
         """
         Получает список текущих IP-адресов для указанного пользователя,
-        используя выбранный метод (API или парсинг лога).
+        используя выбранный метод (API, парсинг лога или гибридный).
 
         Args:
             user_email (str): Email клиента.
-            method (str): Метод получения IP ('api' или 'log').
+            method (str): Метод получения IP ('api', 'log' или 'hybrid').
                           По умолчанию 'api'.
 
         Returns:
             list or None: Список строк IP-адресов при успехе (может быть пустым, если IP не найдены).
                           None при серьезной ошибке (проблемы с сессией, доступом к логу, парсингом JSON и т.д.).
         """
-        _log_api('info', f"Запрос IP для '{user_email}' методом '{method}'")
+        if self.ip_cache is not None:
+            cached = self.ip_cache.get(user_email, method)
+            if cached is not None:
+                _log_api('debug', "IP для '%s' из кэша (метод '%s'): %s", user_email, method, cached)
+                return cached
+
+        _log_api('debug', "Запрос IP для '%s' методом '%s'", user_email, method)
 
-        if not self.session and method == IP_FETCH_API:
-             _log_api('error', "Сессия API недействительна, метод 'api' недоступен.")
+        if not self.session and method in (IP_FETCH_API, IP_FETCH_HYBRID):
+             _log_api('error', "Сессия API недействительна, метод '%s' недоступен.", method)
              return None
 
         if method == IP_FETCH_API:
             result = self._get_client_ip_from_api(user_email)
         elif method == IP_FETCH_LOG:
             result = self._get_client_ip_from_log(user_email)
+        elif method == IP_FETCH_HYBRID:
+            result = self._get_client_ip_hedged(user_email)
         else:
-            _log_api('error', f"Неизвестный метод получения IP: '{method}'. Используйте '{IP_FETCH_API}' или '{IP_FETCH_LOG}'.")
+            _log_api('error', "Неизвестный метод получения IP: '%s'. Используйте одно из: %s.", method, ', '.join(IP_FETCH_METHODS))
             return None # Неверный метод
 
         # Логируем финальный результат
         if result is None:
-            _log_api('error', f"Не удалось получить IP для '{user_email}' методом '{method}' из-за ошибки.")
+            _log_api('error', "Не удалось получить IP для '%s' методом '%s' из-за ошибки.", user_email, method)
         elif not result: # Пустой список
-            _log_api('info', f"IP для '{user_email}' не найдены методом '{method}'.")
+            _log_api('debug', "IP для '%s' не найдены методом '%s'.", user_email, method)
+        else:
+            _log_api('debug', "Успешно получены IP для '%s' методом '%s': %s", user_email, method, result)
+
+        if self.ip_cache is not None:
+            self.ip_cache.put(user_email, method, result)
+        return result
+
+
+# --- gRPC API Xray (StatsService) ---
+# Сообщения xray.app.stats.command (app/stats/command/command.proto) кодируются вручную,
+# чтобы не требовать сгенерированных *_pb2 модулей и пакета protobuf.
+
+def _pb_varint(value):
+    """Кодирует неотрицательное целое в varint."""
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def _pb_string(number, text):
+    """Поле типа string (wire type 2)."""
+    data = text.encode('utf-8')
+    return _pb_varint(number << 3 | 2) + _pb_varint(len(data)) + data
+
+def _pb_bool(number, value):
+    """Поле типа bool (wire type 0); False не кодируется (значение по умолчанию)."""
+    return _pb_varint(number << 3) + b'\x01' if value else b''
+
+def _pb_fields(data):
+    """
+    Разбирает сообщение protobuf в список (номер поля, значение):
+    varint -> int (int64 со знаком), length-delimited -> bytes. Поля fixed32/fixed64 пропускаются.
+
+    Raises:
+        ValueError: Если сообщение повреждено.
+    """
+    fields = []
+    pos, size = 0, len(data)
+
+    def read_varint():
+        nonlocal pos
+        result = shift = 0
+        while True:
+            if pos >= size:
+                raise ValueError("Обрезанный varint")
+            byte = data[pos]
+            pos += 1
+            result |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return result
+            shift += 7
+
+    while pos < size:
+        key = read_varint()
+        number, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value = read_varint()
+            fields.append((number, value - (1 << 64) if value >= 1 << 63 else value))
+        elif wire_type == 2:
+            length = read_varint()
+            if pos + length > size:
+                raise ValueError("Обрезанное поле")
+            fields.append((number, data[pos:pos + length]))
+            pos += length
+        elif wire_type in (1, 5):
+            pos += 8 if wire_type == 1 else 4
         else:
-            _log_api('info', f"Успешно получены IP для '{user_email}' методом '{method}': {result}")
+            raise ValueError(f"Неподдерживаемый wire type {wire_type}")
+    return fields
+
+def _pb_stats(data):
+    """QueryStatsResponse/GetStatsResponse -> [(name, value), ...] (поле 1 - Stat{name=1, value=2})."""
+    stats = []
+    for number, value in _pb_fields(data):
+        if number == 1 and isinstance(value, bytes):
+            name, counter = '', 0
+            for stat_number, stat_value in _pb_fields(value):
+                if stat_number == 1 and isinstance(stat_value, bytes):
+                    name = stat_value.decode('utf-8', 'replace')
+                elif stat_number == 2 and isinstance(stat_value, int):
+                    counter = stat_value
+            stats.append((name, counter))
+    return stats
+
+def _xray_user_email(stat_name):
+    """'user>>>email>>>...' -> email (или None для счетчиков inbound/outbound)."""
+    parts = stat_name.split('>>>')
+    return parts[1] if len(parts) >= 2 and parts[0] == 'user' and parts[1] else None
+
+
+class XrayStatsClient:
+    """
+    Источник онлайн пользователей, их IP и счетчиков трафика напрямую из Xray
+    через gRPC StatsService (в обход HTTP API панели). Интерфейс совпадает с XUIApiClient
+    в части, нужной воркеру. Требует в конфигурации Xray: API с StatsService,
+    статистику пользователей (policy statsUserUplink/Downlink) и statsUserOnline.
+
+    IP всех онлайн пользователей запрашиваются одной пачкой параллельных вызовов
+    в get_online_users_emails() по одному HTTP/2 соединению. Счетчики трафика (uplink/downlink)
+    воркер получает через get_inbounds_snapshot(), как и у панели.
+    """
+
+    def __init__(self, api_address=DEFAULT_XRAY_API_ADDRESS, deadline=None,
+                 snapshot_interval=DEFAULT_INBOUND_SNAPSHOT_INTERVAL):
+        """
+        Args:
+            api_address (str): host:port gRPC API Xray.
+            deadline (float, optional): Момент time.monotonic(), после которого вызовы не отправляются.
+            snapshot_interval (float): Срок годности снимка трафика в секундах (0 - не запрашивать).
+
+        Raises:
+            ConnectionError: Если нет пакета grpcio или API Xray недоступен.
+        """
+        if grpc is None:
+            raise ConnectionError("Для stats_backend='xray_grpc' нужен пакет grpcio (pip install grpcio)")
+        self.api_address = api_address
+        self.deadline = deadline
+        # Атрибуты, которые воркер выставляет любому клиенту (у Xray нет аналогов)
+        self.session = True
+        self.hedge_delay = 0
+        self.snapshot_interval = snapshot_interval
+        self.limiter = None
+        self._stubs = {}
+        self._inbound_snapshot = None
+        self._online_ips = {} # {email: [ip, ...] или None} по последнему запросу онлайн
+        self.channel = grpc.insecure_channel(api_address)
+        try:
+            grpc.channel_ready_future(self.channel).result(timeout=self._call_timeout())
+        except grpc.FutureTimeoutError:
+            self.channel.close()
+            _log_api('error', "API Xray недоступен: %s", api_address)
+            raise ConnectionError(f"API Xray недоступен: {api_address}")
+        _log_api('info', "Подключение к API Xray: %s", api_address)
 
+    def close(self):
+        self.channel.close()
+
+    def take_hedge_stats(self):
+        return {'api': 0, 'log': 0, 'none': 0, 'hedged': 0}
+
+    def get_inbounds_snapshot(self, force=False):
+        """
+        Снимок трафика пользователей (InboundSnapshot.from_traffic) одним вызовом QueryStats.
+        Снимок переиспользуется, пока не старше snapshot_interval.
+
+        Returns:
+            InboundSnapshot or None: Снимок; при ошибке вызова - предыдущий снимок,
+                                     None - если снимок отключен или еще ни разу не был получен.
+        """
+        if self.snapshot_interval <= 0:
+            return None
+        cached = self._inbound_snapshot
+        if not force and cached is not None and time.time() - cached.fetched_at < self.snapshot_interval:
+            return cached
+        traffic = self.get_user_traffic()
+        if traffic is None:
+            return cached
+        self._inbound_snapshot = InboundSnapshot.from_traffic(traffic)
+        _log_api('debug', "Снимок трафика из API Xray: %d пользователей.", len(traffic))
+        return self._inbound_snapshot
+
+    def _call_timeout(self):
+        """Таймаут вызова: min(API_TIMEOUT, остаток до дедлайна); ConnectionError, если бюджет исчерпан."""
+        if self.deadline is None:
+            return common.API_TIMEOUT
+        remaining = self.deadline - time.monotonic()
+        if remaining < MIN_REQUEST_TIMEOUT:
+            raise ConnectionError("Бюджет времени цикла исчерпан")
+        return min(common.API_TIMEOUT, remaining)
+
+    def _stub(self, method):
+        stub = self._stubs.get(method)
+        if stub is None:
+            # Без сериализаторов gRPC передает и возвращает bytes как есть
+            stub = self._stubs[method] = self.channel.unary_unary(f"/{XRAY_STATS_SERVICE}/{method}")
+        return stub
+
+    def _call(self, method, request=b''):
+        return self._stub(method)(request, timeout=self._call_timeout())
+
+    def _call_many(self, method, requests_by_key):
+        """
+        Параллельные вызовы одного метода. Возвращает {key: bytes ответа или grpc.RpcError}.
+        """
+        timeout = self._call_timeout()
+        stub = self._stub(method)
+        futures = {key: stub.future(request, timeout=timeout) for key, request in requests_by_key.items()}
+        results = {}
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except grpc.RpcError as e:
+                results[key] = e
+        return results
+
+    def _online_users_fallback(self):
+        """
+        Для версий Xray без GetAllOnlineUsers: пользователи из счетчиков трафика,
+        онлайн - у кого GetStatsOnline > 0.
+        """
+        emails = {_xray_user_email(name) for name, _ in _pb_stats(self._call('QueryStats', _pb_string(1, 'user>>>')))}
+        emails.discard(None)
+        requests_by_email = {email: _pb_string(1, f"user>>>{email}>>>online") for email in emails}
+        online = set()
+        for email, response in self._call_many('GetStatsOnline', requests_by_email).items():
+            if isinstance(response, bytes) and any(value > 0 for _, value in _pb_stats(response)):
+                online.add(email)
+        return online
+
+    def get_online_users_emails(self):
+        """
+        Множество email онлайн пользователей (GetAllOnlineUsers) и пачка их IP (GetStatsOnlineIpList).
+
+        Returns:
+            set or None: Email онлайн пользователей; None при ошибке.
+        """
+        try:
+            try:
+                response = self._call('GetAllOnlineUsers')
+                online = set()
+                for number, value in _pb_fields(response):
+                    if number == 1 and isinstance(value, bytes):
+                        name = value.decode('utf-8', 'replace')
+                        online.add(_xray_user_email(name) or name)
+            except grpc.RpcError as e:
+                if e.code() != grpc.StatusCode.UNIMPLEMENTED:
+                    raise
+                _log_api('debug', "GetAllOnlineUsers не поддерживается этой версией Xray, перебор счетчиков.")
+                online = self._online_users_fallback()
+            online.discard('')
+            _log_api('info', "Получено %d онлайн пользователей из API Xray.", len(online))
+            self._online_ips = self._fetch_online_ips(online)
+            return online
+        except grpc.RpcError as e:
+            _log_api('error', "Ошибка API Xray при получении онлайн: %s %s", e.code(), e.details())
+        except ValueError as e:
+            _log_api('error', "Некорректный ответ API Xray при получении онлайн: %s", e)
+        except ConnectionError as e:
+            _log_api('error', "Онлайн из API Xray: %s", e)
+        return None
+
+    def _fetch_online_ips(self, emails):
+        """{email: [ip, ...]} для всех пользователей одной пачкой; None для пользователей с ошибкой вызова."""
+        if not emails:
+            return {}
+        requests_by_email = {email: _pb_string(1, f"user>>>{email}>>>online") for email in emails}
+        result = {}
+        for email, response in self._call_many('GetStatsOnlineIpList', requests_by_email).items():
+            result[email] = self._parse_ip_list(email, response)
         return result
+
+    @staticmethod
+    def _parse_ip_list(email, response):
+        """GetStatsOnlineIpListResponse{name=1, ips=2 map<string,int64>} -> [ip, ...], свежие первыми."""
+        if isinstance(response, grpc.RpcError):
+            if response.code() == grpc.StatusCode.NOT_FOUND:
+                return [] # Пользователь уже не онлайн
+            _log_api('error', "Ошибка API Xray IP для '%s': %s", email, response.code())
+            return None
+        try:
+            last_seen = {}
+            for number, value in _pb_fields(response):
+                if number == 2 and isinstance(value, bytes):
+                    ip, seen = None, 0
+                    for entry_number, entry_value in _pb_fields(value):
+                        if entry_number == 1 and isinstance(entry_value, bytes):
+                            ip = entry_value.decode('utf-8', 'replace')
+                        elif entry_number == 2 and isinstance(entry_value, int):
+                            seen = entry_value
+                    if ip:
+                        last_seen[ip] = seen
+        except ValueError as e:
+            _log_api('error', "Некорректный ответ API Xray IP для '%s': %s", email, e)
+            return None
+        return sorted(last_seen, key=lambda ip: (-last_seen[ip], ip))
+
+    def get_client_ip_addresses(self, user_email, method=IP_FETCH_API):
+        """
+        IP пользователя из пачки, полученной вместе с онлайн-списком (или отдельным вызовом).
+        Параметр method игнорируется: источник всегда StatsService.
+
+        Returns:
+            list or None: Список IP (может быть пустым); None при ошибке.
+        """
+        if user_email in self._online_ips:
+            return self._online_ips[user_email]
+        try:
+            response = self._call('GetStatsOnlineIpList', _pb_string(1, f"user>>>{user_email}>>>online"))
+        except grpc.RpcError as e:
+            response = e
+        except ConnectionError as e:
+            _log_api('error', "IP из API Xray для '%s': %s", user_email, e)
+            return None
+        return self._parse_ip_list(user_email, response)
+
+    def get_user_traffic(self, reset=False):
+        """
+        Счетчики трафика всех пользователей одним вызовом QueryStats.
+
+        Args:
+            reset (bool): Обнулить счетчики в Xray после чтения.
+
+        Returns:
+            dict or None: { email: {'up': байт, 'down': байт} }; None при ошибке.
+        """
+        try:
+            stats = _pb_stats(self._call('QueryStats', _pb_string(1, 'user>>>') + _pb_bool(2, reset)))
+        except (grpc.RpcError, ValueError, ConnectionError) as e:
+            _log_api('error', "Ошибка получения трафика из API Xray: %s", e)
+            return None
+        traffic = {}
+        for name, value in stats:
+            parts = name.split('>>>')
+            if len(parts) == 4 and parts[0] == 'user' and parts[2] == 'traffic':
+                direction = {'uplink': 'up', 'downlink': 'down'}.get(parts[3])
+                if direction:
+                    traffic.setdefault(parts[1], {'up': 0, 'down': 0})[direction] = value
+        return traffic